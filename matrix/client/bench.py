@@ -0,0 +1,194 @@
+"""
+Load test of a deployed repo through the client api:
+    upload_files -> call -> request_status (polling) -> download_file
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import tempfile
+import threading
+import time
+from .request import Client
+
+
+PHASES = ["upload_files", "call", "request_status", "download_file"]
+DONE_STATUSES = ["SUCCESS", "FAILURE"]
+
+
+def percentile(values, q):
+    """
+        q-th percentile (0-100) of values with linear interpolation, None if values is empty
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * q / 100
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def _summary(values):
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+def _one_request(client, repo_name, files, text, poll_interval, timeout, download, output_dir):
+    timings = {}
+    phase = None
+    try:
+        phase = "upload_files"
+        inputs = {}
+        if text is not None:
+            inputs["text"] = text
+        if files:
+            start = time.perf_counter()
+            inputs["file_ids"] = client.upload_files(files)
+            timings[phase] = time.perf_counter() - start
+        
+        phase = "call"
+        start = time.perf_counter()
+        task_id = client.call({"repo_name": repo_name, "inputs": inputs}, quiet=True)["task_id"]
+        timings[phase] = time.perf_counter() - start
+
+        phase = "request_status"
+        start = time.perf_counter()
+        while True:
+            status = client.request_status(task_id)
+            if status.get("status") in DONE_STATUSES:
+                break
+            if time.perf_counter() - start > timeout:
+                raise RuntimeError(f"Task {task_id} timed out after {timeout}s")
+            time.sleep(poll_interval)
+        timings[phase] = time.perf_counter() - start
+        if status.get("status") != "SUCCESS":
+            raise RuntimeError(f"Task {task_id} failed: {status}")
+
+        if download:
+            phase = "download_file"
+            start = time.perf_counter()
+            for file_info in status.get("result", None) or []:
+                if isinstance(file_info, dict) and "url" in file_info:
+                    client.download_file(file_info, output_dir=output_dir, quiet=True)
+            timings[phase] = time.perf_counter() - start
+        return {"ok": True, "timings": timings}
+    except Exception as e:
+        return {"ok": False, "timings": timings, "phase": phase, "error": str(e)}
+
+
+def run_benchmark(client, repo_name, files=None, text=None, requests=100, concurrency=8, rate=None, poll_interval=0.2, timeout=300, download=True, output_dir=None):
+    """
+     Drive `requests` requests through the client with `concurrency` parallel workers
+     
+     Args:
+     	 client: a matrix.client.request.Client
+     	 repo_name: author_username/repo_name of the repo under test
+     	 files: list of files uploaded for each request
+     	 text: text input of each request
+     	 requests: total number of requests
+     	 concurrency: number of requests in flight at the same time
+     	 rate: requests started per second, None starts them as fast as the concurrency allows,
+     	 	 the requests are paced by one thread, a request waits for a free worker if all `concurrency` are busy
+     	 poll_interval: seconds between request_status calls
+     	 timeout: seconds after which a pending task counts as an error
+     	 download: if True, the outputs are downloaded and timed
+     	 output_dir: where downloaded files are saved, a temporary directory by default
+     
+     Returns: 
+     	 report dictionary with latency percentiles per phase and end to end, throughput and error rate
+    """
+    temp_dir = None
+    if output_dir is None:
+        temp_dir = tempfile.TemporaryDirectory()
+        output_dir = temp_dir.name
+    
+    lock = threading.Lock()
+    results = []
+    start_time = time.perf_counter()
+
+    def job(index):
+        job_start = time.perf_counter()
+        result = _one_request(client, repo_name, files, text, poll_interval, timeout, download, output_dir)
+        result["latency"] = time.perf_counter() - job_start
+        with lock:
+            results.append(result)
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            if rate:
+                # the workers never sleep, this thread submits each request at its start time
+                futures = []
+                for index in range(requests):
+                    delay = start_time + index / rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    futures.append(executor.submit(job, index))
+                for future in futures:
+                    future.result()
+            else:
+                list(executor.map(job, range(requests)))
+    finally:
+        if temp_dir is not None:
+            temp_dir.cleanup()
+    
+    duration = time.perf_counter() - start_time
+    succeeded = [r for r in results if r["ok"]]
+    failed = [r for r in results if not r["ok"]]
+
+    errors_by_phase = {}
+    for r in failed:
+        errors_by_phase[r["phase"]] = errors_by_phase.get(r["phase"], 0) + 1
+    
+    return {
+        "repo_name": repo_name,
+        "requests": requests,
+        "concurrency": concurrency,
+        "rate": rate,
+        "duration_s": duration,
+        "throughput_rps": len(succeeded) / duration if duration else None,
+        "error_rate": len(failed) / len(results) if results else None,
+        "errors_by_phase": errors_by_phase,
+        "errors": sorted({r["error"] for r in failed})[:10],
+        "latency": _summary([r["latency"] for r in succeeded]),
+        "phases": {phase: _summary([r["timings"][phase] for r in results if phase in r["timings"]]) for phase in PHASES},
+    }
+
+
+def print_report(report):
+    def fmt(value, spec=".1f", scale=1000):
+        return "N/A" if value is None else f"{value*scale:{spec}}"
+    
+    print(f"repo: {report['repo_name']}, requests: {report['requests']}, concurrency: {report['concurrency']}, rate: {report['rate']}")
+    print(f"duration: {report['duration_s']:.2f}s, throughput: {fmt(report['throughput_rps'], '.2f', 1)} req/s, error rate: {fmt(report['error_rate'], '.2%', 1)}")
+    if report["errors_by_phase"]:
+        print(f"errors by phase: {report['errors_by_phase']}")
+        for error in report["errors"]:
+            print(f"    {error}")
+    print(f"{'phase (ms)':<20}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    rows = [(phase, report["phases"][phase]) for phase in PHASES] + [("end to end", report["latency"])]
+    for name, s in rows:
+        print(f"{name:<20}{s['count']:>8}{fmt(s['mean']):>10}{fmt(s['p50']):>10}{fmt(s['p95']):>10}{fmt(s['p99']):>10}{fmt(s['max']):>10}")
+
+
+def bench_main(api_key, repo_name, files=None, text=None, server_uri=None, mock=False, **kwargs):
+    """
+        entry point of `matrix-admin --bench`, runs against the local mock server if mock is True
+    """
+    server = None
+    if mock:
+        from .mock_server import start_mock_server
+        server, server_uri = start_mock_server()
+        print(f"Started mock server at {server_uri}")
+    try:
+        client = Client(api_key, repo_name, server_uri=server_uri)
+        report = run_benchmark(client, repo_name, files=files, text=text, **kwargs)
+    finally:
+        if server is not None:
+            server.shutdown()
+    print_report(report)
+    return report
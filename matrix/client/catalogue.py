@@ -0,0 +1,311 @@
+"""
+Client-side cache of the repo list of the matrix server, kept in memory and on disk, revalidated with ETag/Last-Modified
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import requests
+from .server import *
+from ..utils.logging import get_logger
+
+
+logger = get_logger(__name__)
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "matrix")
+
+_NAME_KEYS = ["repo_name", "name", "full_name"]
+_AUTHOR_KEYS = ["author_username", "author", "username", "owner"]
+
+
+def _first(repo, keys):
+    for key in keys:
+        value = repo.get(key, None)
+        if isinstance(value, dict):
+            value = value.get("username", None) or value.get("name", None)
+        if value:
+            return str(value)
+    return None
+
+
+def iter_json_array(chunks):
+    """
+        yields the items of a json array read from an iterable of byte chunks, one item at a time,
+        the whole document is never held as one string
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pending = b""
+    started = False
+    for chunk in chunks:
+        # a multi byte character could be split between two chunks
+        pending += chunk
+        try:
+            buffer += pending.decode("utf-8")
+            pending = b""
+        except UnicodeDecodeError as e:
+            buffer += pending[:e.start].decode("utf-8")
+            pending = pending[e.start:]
+
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position >= len(buffer):
+                break
+            if not started:
+                if buffer[position] != "[":
+                    raise ValueError("the document is not a json array")
+                started = True
+                position += 1
+                continue
+            if buffer[position] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # the item is not complete yet, wait for the next chunk
+                break
+            following = end
+            while following < len(buffer) and buffer[following] in " \t\r\n":
+                following += 1
+            if following >= len(buffer) or buffer[following] not in ",]":
+                # an item is complete only before , or ], a number could go on in the next chunk ("12" of "123", "4." of "4.5")
+                break
+            yield item
+            position = end
+        buffer = buffer[position:]
+    if started:
+        raise ValueError("unexpected end of the json array")
+
+
+class RepoCatalogue:
+    """
+        The repo list of a matrix server with lookup by name and author
+
+        the list is fetched once and served from memory for ttl seconds, then revalidated with If-None-Match/If-Modified-Since,
+        the server answers 304 if nothing changed. If cache_dir is given (e.g. CACHE_DIR), a copy is kept there,
+        so a new process starts from it.
+        If the server is not reachable, the stale list is served with a warning.
+
+        Responses are parsed as a stream, a json array is decoded item by item, and paginated responses
+        ({"results": [...], "next": url}) are followed page by page
+    """
+
+    def __init__(self, server_uri=None, ttl=300, cache_dir=None, page_size=None, timeout=30) -> None:
+        """
+            server_uri: the address of the matrix server, default is SERVER_URI
+            ttl: seconds the list is used without asking the server
+            cache_dir: directory of the on-disk copy, e.g. CACHE_DIR, None keeps the list in memory only
+            page_size: asked from the server if it paginates the list
+        """
+        self.server_uri = server_uri or SERVER_URI
+        self.ttl = ttl
+        self.page_size = page_size
+        self.timeout = timeout
+        self.cache_path = None
+        if cache_dir is not None:
+            digest = hashlib.sha1(self.server_uri.encode("utf-8")).hexdigest()[:12]
+            self.cache_path = os.path.join(cache_dir, f"repo_list-{digest}.json")
+
+        self._lock = threading.Lock()
+        self._repos = None
+        self._by_name = {}
+        self._by_author = {}
+        self._fetched_at = 0.0
+        self._etag = None
+        self._last_modified = None
+
+    def _index(self, repos):
+        by_name, by_author = {}, {}
+        for repo in repos:
+            if not isinstance(repo, dict):
+                continue
+            name = _first(repo, _NAME_KEYS)
+            author = _first(repo, _AUTHOR_KEYS)
+            if name and "/" in name and author is None:
+                author = name.split("/", 1)[0]
+            if author:
+                by_author.setdefault(author, []).append(repo)
+            if name:
+                by_name.setdefault(name, repo)
+                short = name.split("/", 1)[-1]
+                by_name.setdefault(short, repo)
+                if author and "/" not in name:
+                    by_name[f"{author}/{name}"] = repo
+        self._repos, self._by_name, self._by_author = repos, by_name, by_author
+
+    def _load_disk(self):
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, "r") as f:
+                cached = json.loads(f.read())
+            repos, fetched_at = cached["repos"], float(cached["fetched_at"])
+            if not isinstance(repos, list):
+                raise TypeError(f"repos is a {type(repos).__name__}")
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            # truncated, corrupt or written by another version, fetched again
+            logger.warning(f"Ignoring the repo list cache {self.cache_path}: {e!r}")
+            return
+        self._index(repos)
+        self._fetched_at = fetched_at
+        self._etag = cached.get("etag", None)
+        self._last_modified = cached.get("last_modified", None)
+
+    def _save_disk(self):
+        if self.cache_path is None:
+            return
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        temp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(json.dumps({
+                "server_uri": self.server_uri,
+                "fetched_at": self._fetched_at,
+                "etag": self._etag,
+                "last_modified": self._last_modified,
+                "repos": self._repos,
+            }))
+        os.replace(temp_path, self.cache_path)
+
+    def _iter_pages(self, resp):
+        """
+            yields the repos of the response and of the following pages
+        """
+        next_url = yield from self._iter_page(resp)
+        while next_url:
+            with requests.get(next_url, stream=True, timeout=self.timeout) as page:
+                if page.status_code != 200:
+                    raise RuntimeError(f"Failed to fetch the repo list page {next_url}, ERR_CODE: {page.status_code}")
+                next_url = yield from self._iter_page(page)
+
+    def _iter_page(self, resp):
+        """
+            yields the repos of one response, returns the url of the next page or None
+        """
+        chunks = resp.iter_content(chunk_size=64 * 1024)
+        first = b""
+        for chunk in chunks:
+            first += chunk
+            if first.strip():
+                break
+
+        def body():
+            yield first
+            yield from chunks
+
+        if first.lstrip()[:1] == b"[":
+            yield from iter_json_array(body())
+            return None
+
+        page = json.loads(b"".join(body()))
+        yield from page.get("results", [])
+        return page.get("next", None)
+
+    def _fetch(self):
+        headers = {}
+        if self._repos is not None:
+            if self._etag:
+                headers["If-None-Match"] = self._etag
+            if self._last_modified:
+                headers["If-Modified-Since"] = self._last_modified
+        params = {"page_size": self.page_size} if self.page_size else None
+
+        with requests.get(f"{self.server_uri}{REPO_LIST_URI}", headers=headers, params=params, stream=True, timeout=self.timeout) as resp:
+            if resp.status_code == 304:
+                self._fetched_at = time.time()
+                self._save_disk()
+                return False
+            if resp.status_code != 200:
+                raise RuntimeError(f"Failed to fetch the repo list, ERR_CODE: {resp.status_code}, \nDetails: {resp.content}")
+
+            repos = list(self._iter_pages(resp))
+            self._etag = resp.headers.get("ETag", None)
+            self._last_modified = resp.headers.get("Last-Modified", None)
+
+        self._index(repos)
+        self._fetched_at = time.time()
+        self._save_disk()
+        return True
+
+    def refresh(self, force=False):
+        """
+            makes sure the list is at most ttl seconds old, force=True revalidates with the server now
+
+            Returns:
+                True if a new list was downloaded
+        """
+        with self._lock:
+            if self._repos is None:
+                self._load_disk()
+            if not force and self._repos is not None and time.time() - self._fetched_at < self.ttl:
+                return False
+            try:
+                return self._fetch()
+            except (requests.RequestException, RuntimeError) as e:
+                if self._repos is None:
+                    raise
+                logger.warning(f"Could not revalidate the repo list, using the cached one: {e}")
+                return False
+
+    def invalidate(self):
+        """
+            drops the in-memory and the on-disk copy
+        """
+        with self._lock:
+            self._repos = None
+            self._by_name, self._by_author = {}, {}
+            self._fetched_at = 0.0
+            self._etag = self._last_modified = None
+            if self.cache_path is not None and os.path.exists(self.cache_path):
+                os.remove(self.cache_path)
+
+    @property
+    def repos(self):
+        """
+            the list of repos as returned by the server
+        """
+        self.refresh()
+        return self._repos
+
+    def get(self, name, default=None):
+        """
+            the repo with the name, "author_username/repo_name" or only "repo_name"
+        """
+        self.refresh()
+        return self._by_name.get(name, default)
+
+    def by_author(self, author):
+        """
+            the repos of the author
+        """
+        self.refresh()
+        return list(self._by_author.get(author, []))
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __iter__(self):
+        return iter(self.repos)
+
+    def __len__(self):
+        return len(self.repos)
+
+
+_CATALOGUES = {}
+_CATALOGUES_LOCK = threading.Lock()
+
+
+def get_catalogue(server_uri=None, cache_dir=None, **kwargs):
+    """
+        the shared RepoCatalogue of the server and cache_dir, created on first use with the given kwargs (see RepoCatalogue)
+        cache_dir: None keeps the list in memory only, give CACHE_DIR to share it between processes
+    """
+    server_uri = server_uri or SERVER_URI
+    key = (server_uri, cache_dir)
+    with _CATALOGUES_LOCK:
+        if key not in _CATALOGUES:
+            _CATALOGUES[key] = RepoCatalogue(server_uri, cache_dir=cache_dir, **kwargs)
+        return _CATALOGUES[key]
@@ -0,0 +1,204 @@
+"""
+A local stand-in for the matrix API server, used to test and benchmark the client without the real server
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from .server import *
+from .sse import format_event
+
+
+DOWNLOAD_URI = "/repo/download/"
+
+
+class MockState:
+    """
+        latency: seconds added to every request
+        task_duration: seconds a task stays PENDING before SUCCESS
+        error_rate: probability of answering a request with status 500
+        output: bytes returned by the download endpoint
+        repos: the repo list, answered with an ETag, paginated if the request has a page_size
+        batching: if False, the batch endpoint answers 404 like a server without it
+        max_batch_items: batches with more items are answered with 413
+        stream_outputs: partial outputs sent by the stream endpoint, stream_interval seconds apart
+    """
+    def __init__(self, latency=0.0, task_duration=0.1, error_rate=0.0, output=b"matrix", repos=None, batching=True, max_batch_items=1000,
+                 stream_outputs=None, stream_interval=0.05) -> None:
+        self.latency = latency
+        self.task_duration = task_duration
+        self.error_rate = error_rate
+        self.output = output
+        self.tasks = {}
+        self.repos = repos or []
+        self.batching = batching
+        self.max_batch_items = max_batch_items
+        self.submissions = {"single": 0, "batch": 0}
+        self.stream_outputs = stream_outputs if stream_outputs is not None else [f"partial {i} " for i in range(5)]
+        self.stream_interval = stream_interval
+        self.repo_list_requests = 0
+        self.lock = threading.Lock()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    state: MockState = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def _before(self):
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        if self.state.error_rate and random.random() < self.state.error_rate:
+            self._send_json(500, {"detail": "mock error"})
+            return False
+        return True
+
+    def _send_repo_list(self, query):
+        with self.state.lock:
+            self.state.repo_list_requests += 1
+            repos = list(self.state.repos)
+        etag = '"' + hashlib.sha1(json.dumps(repos, sort_keys=True).encode("utf-8")).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        
+        if "page_size" not in query:
+            body = repos
+        else:
+            page_size = int(query["page_size"][0])
+            page = int(query.get("page", ["1"])[0])
+            host = f"http://{self.headers.get('Host')}"
+            has_next = page * page_size < len(repos)
+            body = {
+                "count": len(repos),
+                "next": f"{host}{REPO_LIST_URI}?page_size={page_size}&page={page + 1}" if has_next else None,
+                "results": repos[(page - 1) * page_size:page * page_size],
+            }
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_stream(self):
+        """
+            server-sent events over chunked transfer encoding, one `partial` event per output and an `end` event
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, output in enumerate(self.state.stream_outputs):
+            if self.state.stream_interval:
+                time.sleep(self.state.stream_interval)
+            self._write_chunk(format_event(output, event="partial", id=i))
+        self._write_chunk(format_event({}, event="end"))
+        self._write_chunk(b"")
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        if not self._before():
+            return
+        if parsed.path == REPO_LIST_URI:
+            self._send_repo_list(parse_qs(parsed.query))
+        elif parsed.path == DOWNLOAD_URI:
+            content = self.state.output
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        else:
+            self._send_json(404, {"detail": "not found"})
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        body = self._read_body()
+        if not self._before():
+            return
+        if parsed.path == UPLOAD_FILES_URI:
+            count = max(1, body.count(b'name="files"'))
+            self._send_json(201, {"file_indices": [str(uuid.uuid4()) for _ in range(count)]})
+        elif parsed.path == MODEL_REQUEST_URI:
+            task_id = str(uuid.uuid4())
+            with self.state.lock:
+                self.state.tasks[task_id] = time.time()
+                self.state.submissions["single"] += 1
+            self._send_json(200, {"task_id": task_id})
+        elif parsed.path == MODEL_STREAM_URI:
+            self._send_stream()
+        elif parsed.path == MODEL_BATCH_REQUEST_URI and self.state.batching:
+            batch = json.loads(body or b"{}").get("requests", [])
+            if len(batch) > self.state.max_batch_items:
+                self._send_json(413, {"detail": f"at most {self.state.max_batch_items} requests per batch"})
+                return
+            task_ids = [str(uuid.uuid4()) for _ in batch]
+            with self.state.lock:
+                for task_id in task_ids:
+                    self.state.tasks[task_id] = time.time()
+                self.state.submissions["batch"] += 1
+            self._send_json(200, {"task_ids": task_ids})
+        elif parsed.path == REQUEST_RESULT_URI:
+            task_id = json.loads(body or b"{}").get("task_id")
+            with self.state.lock:
+                created = self.state.tasks.get(task_id, None)
+            if created is None:
+                self._send_json(404, {"detail": "task not found"})
+            elif time.time() - created < self.state.task_duration:
+                self._send_json(200, {"status": "PENDING"})
+            else:
+                host = f"http://{self.headers.get('Host')}"
+                url = f"{host}{DOWNLOAD_URI}?task_id={task_id}&output_id={uuid.uuid4()}"
+                self._send_json(200, {"status": "SUCCESS", "result": [{"type": "text/plain", "url": url}]})
+        else:
+            self._send_json(404, {"detail": "not found"})
+
+
+def start_mock_server(host="127.0.0.1", port=0, **state_kwargs):
+    """
+     Start the mock server in a background thread
+     
+     Args:
+     	 host: host to bind
+     	 port: port to bind, 0 picks a free port
+     	 **state_kwargs: see MockState, latency, task_duration, error_rate, output, repos, batching, max_batch_items,
+     	     stream_outputs, stream_interval
+     
+     Returns: 
+     	 tuple of (server, server_uri), call server.shutdown() to stop it
+    """
+    handler = type("Handler", (MockHandler,), {"state": MockState(**state_kwargs)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{server.server_address[0]}:{server.server_address[1]}"
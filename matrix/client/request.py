@@ -4,43 +4,139 @@ import os
 import json
 from urllib.parse import urlparse, parse_qs
 import mimetypes
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ..utils import metrics, tracing
+from ..utils.errors import HTTPError
+from .catalogue import get_catalogue
+from .sse import iter_events
 
 
+CLIENT_SECONDS = metrics.histogram("matrix_client_request_seconds", "Duration of the client api calls", ["method"])
+CLIENT_ERRORS = metrics.counter("matrix_client_errors", "Failed client api calls", ["method"])
 
-def get_repo_list(pprint=False):
+# status codes of a server without the batch endpoint
+_BATCH_UNSUPPORTED = [404, 405, 501]
+# the batch is larger than the server accepts
+_BATCH_TOO_LARGE = 413
+
+
+def _instrumented(func):
+    method = func.__name__
+    
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            with CLIENT_SECONDS.labels(method=method).time(), tracing.start_span(f"client.{method}"):
+                return func(*args, **kwargs)
+        except Exception:
+            CLIENT_ERRORS.labels(method=method).inc()
+            raise
+    return wrapper
+
+
+@_instrumented
+def get_repo_list(pprint=False, server_uri=None, refresh=False, cache_dir=None):
     """
-    check status of your request
-    task_id: id of your request
+    list of the repos of the matrix server
+    server_uri: the address of the matrix server, default is SERVER_URI
+    refresh: if True, revalidate the list with the server now
+    cache_dir: if given (e.g. matrix.client.catalogue.CACHE_DIR), the list is also cached on disk and shared between processes
+    NOTE: the list is cached in memory and revalidated after 5 minutes,
+            use get_catalogue(server_uri) to look up repos by name or author
     """
-    url = f"{SERVER_URI}{REPO_LIST_URI}"
-    
-    resp = requests.get(url)
-    
-    if resp.status_code != 200:
-        raise RuntimeError(f"Failed to fetch teh status, ERR_CODE: {resp.status_code}, \nDetails: {resp.json()}")
+    catalogue = get_catalogue(server_uri, cache_dir=cache_dir)
+    catalogue.refresh(force=refresh)
+    repos = catalogue.repos
     
     if pprint:
         import pprint
         pp = pprint.PrettyPrinter(indent=4)
-        pp.pprint(resp.json())
+        pp.pprint(repos)
 
-    return resp.json()
+    return repos
     
 
+class _RateLimiter:
+    """
+        spaces the calls of wait() 1/rate seconds apart, shared between threads
+    """
+    def __init__(self, rate) -> None:
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+    
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class TaskHandle:
+    """
+    The task of one item of Client.call_many
+    index: position of the item in the inputs of call_many
+    task_id: id of the task, None if the submission failed, see error
+    """
+    def __init__(self, client, index, task_id=None, error=None) -> None:
+        self.client = client
+        self.index = index
+        self.task_id = task_id
+        self.error = error
+    
+    @property
+    def ok(self):
+        return self.task_id is not None
+    
+    def status(self):
+        if not self.ok:
+            raise RuntimeError(f"Item {self.index} was not submitted: {self.error}")
+        return self.client.request_status(self.task_id)
+    
+    def wait(self, poll_interval=0.5, timeout=None):
+        """
+        polls the status until the task is SUCCESS or FAILURE and returns the last status
+        """
+        start = time.monotonic()
+        while True:
+            status = self.status()
+            if status.get("status") in ["SUCCESS", "FAILURE"]:
+                return status
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise RuntimeError(f"Task {self.task_id} timed out after {timeout}s")
+            time.sleep(poll_interval)
+    
+    def __repr__(self) -> str:
+        return f"TaskHandle(index={self.index}, task_id={self.task_id}, error={self.error})"
+
+
 class Client:
     """
     Class for client api connection
     """
-    def __init__(self, api_key, repository_name) -> None:
-        
+    def __init__(self, api_key, repository_name, server_uri=None) -> None:
+        """
+        server_uri: the address of the matrix server, default is SERVER_URI, e.g. the address of a local mock server for testing
+        """
         self.api_key = api_key
         self.repository_name = repository_name
+        self.server_uri = server_uri or SERVER_URI
+        # None until the first call_many finds out if the server has the batch endpoint
+        self.batch_supported = None
 
+    @_instrumented
     def upload_files(self, files_path):
         """
         files_path: path to files that you wish to be uploaded, any type of file can be uploaded
         """
-        url = f"{SERVER_URI}{UPLOAD_FILES_URI}"
+        url = f"{self.server_uri}{UPLOAD_FILES_URI}"
 
         files = []
         for path in files_path:
@@ -50,9 +146,9 @@ class Client:
             
         resp = requests.post(
             url,
-            headers={
+            headers=tracing.inject({
                         "Authorization":f"Bearer {self.api_key}"
-                    }, 
+                    }), 
             files=files)
         
         if resp.status_code != 201:
@@ -60,7 +156,8 @@ class Client:
         
         return resp.json()["file_indices"]
 
-    def call(self, data):
+    @_instrumented
+    def call(self, data, quiet=False):
         """
         calls the api for your data
         data:
@@ -69,56 +166,210 @@ class Client:
                 inputs: dict, {"text":text, "file_ids":[file_id1, file_id2, ....]}
             }
             NOTE: repo_name is the name of the api repository you wish to be called
+            NOTE: a trace is started for the call and sent with the `traceparent` header
+        quiet: if True, the request id is not printed
         """
-        url = f"{SERVER_URI}{MODEL_REQUEST_URI}"
-        resp = requests.post(
-            url, 
-            json=data,
-            headers={
-                        "Authorization":f"Bearer {self.api_key}"
-                    })
+        result = self._submit(MODEL_REQUEST_URI, data)
+        request_id = result["task_id"]
+        span = tracing.current_span()
+        if span is not None:
+            span.set_attribute("matrix.task_id", request_id)
+        if not quiet:
+            trace = f", trace_id={span.context.trace_id}" if span is not None else ""
+            print(f"Request is Running with request_id={request_id}{trace}")
+        return result
+    
+    def _submit(self, uri, data, max_retries=3):
+        """
+        posts data and returns the json answer, 429 (too many requests) is retried after the Retry-After of the server
+        raises HTTPError with the status code of the server otherwise
+        """
+        for attempt in range(max_retries + 1):
+            resp = requests.post(
+                f"{self.server_uri}{uri}", 
+                json=data,
+                headers=tracing.inject({
+                            "Authorization":f"Bearer {self.api_key}"
+                        }))
+            if resp.status_code != 429 or attempt == max_retries:
+                break
+            time.sleep(float(resp.headers.get("Retry-After", 2 ** attempt)))
         
         if resp.status_code!=200:
-            raise RuntimeError(f"Request faild, ERR_CODE : {resp.status_code}, \nDetails: {resp.json()}")
-        
-        request_id = resp.json()["task_id"]
-        print(f"Request is Running with request_id={request_id}")
+            raise HTTPError(f"Request faild, ERR_CODE : {resp.status_code}, \nDetails: {resp.content}", resp.status_code)
         return resp.json()
+    
+    def _submit_batch(self, batch):
+        """
+        returns the task ids of the batch, or None if the server has no batch endpoint
+        a batch too large for the server (413) is split in halves, which are sent one after the other
+        """
+        try:
+            task_ids = self._submit(MODEL_BATCH_REQUEST_URI, {"requests": batch})["task_ids"]
+        except HTTPError as e:
+            if e.status_code in _BATCH_UNSUPPORTED:
+                return None
+            if e.status_code == _BATCH_TOO_LARGE and len(batch) > 1:
+                half = len(batch) // 2
+                first = self._submit_batch(batch[:half])
+                if first is None:
+                    return None
+                second = self._submit_batch(batch[half:])
+                if second is None:
+                    # the first half is already submitted, only the rest is sent with single calls
+                    second = [self._submit(MODEL_REQUEST_URI, payload)["task_id"] for payload in batch[half:]]
+                return first + second
+            raise
+        if len(task_ids) != len(batch):
+            raise RuntimeError(f"The server returned {len(task_ids)} task ids for a batch of {len(batch)}")
+        return task_ids
+
+    @_instrumented
+    def call_many(self, repo_name, inputs_list, max_batch_items=100, max_batch_bytes=1024**2, concurrency=4, rate=None, raise_on_error=True):
+        """
+        calls the api for many inputs, the inputs are sent in batches instead of one request each
+        repo_name: author_username/repo_name of the repo
+        inputs_list: list of inputs, each like the inputs of call(), {"text":text, "file_ids":[file_id1, ...]}
+        max_batch_items, max_batch_bytes: limits of the number of items and the json size of one batch
+        concurrency: number of requests in flight
+        rate: http requests started per second, None is unlimited
+        raise_on_error: if False, failed items are returned with handle.error set instead of raising
+        NOTE: if the server has no batch endpoint, the items are sent with concurrent single calls
+        
+        Returns:
+            list of TaskHandle in the order of inputs_list
+        """
+        payloads = [{"repo_name": repo_name, "inputs": inputs} for inputs in inputs_list]
+        batches = []
+        batch, batch_bytes = [], 0
+        for index, payload in enumerate(payloads):
+            size = len(json.dumps(payload))
+            if batch and (len(batch) >= max_batch_items or batch_bytes + size > max_batch_bytes):
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append(index)
+            batch_bytes += size
+        if batch:
+            batches.append(batch)
+        
+        handles = [TaskHandle(self, index) for index in range(len(payloads))]
+        limiter = _RateLimiter(rate)
+        
+        def send_one(index):
+            limiter.wait()
+            try:
+                handles[index].task_id = self._submit(MODEL_REQUEST_URI, payloads[index])["task_id"]
+            except Exception as e:
+                handles[index].error = str(e)
+        
+        def send_batch(indices):
+            if self.batch_supported is False:
+                for i in indices:
+                    send_one(i)
+                return
+            limiter.wait()
+            try:
+                task_ids = self._submit_batch([payloads[i] for i in indices])
+            except Exception as e:
+                for i in indices:
+                    handles[i].error = str(e)
+                return
+            if task_ids is None:
+                self.batch_supported = False
+                for i in indices:
+                    send_one(i)
+                return
+            self.batch_supported = True
+            for i, task_id in zip(indices, task_ids):
+                handles[i].task_id = task_id
+        
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            remaining = batches
+            if self.batch_supported is None and batches:
+                # the first batch finds out if the server supports batching
+                send_batch(batches[0])
+                remaining = batches[1:]
+            
+            if self.batch_supported is False:
+                list(executor.map(send_one, [i for indices in remaining for i in indices]))
+            else:
+                list(executor.map(send_batch, remaining))
+        
+        failed = [handle for handle in handles if not handle.ok]
+        if failed and raise_on_error:
+            raise RuntimeError(f"{len(failed)} of {len(handles)} items failed, first error: {failed[0].error}")
+        return handles
+
+    def stream(self, data, timeout=None):
+        """
+        calls the api for your data and yields the partial outputs as the model produces them
+        data: same as call()
+        timeout: seconds to wait for the next partial output
+        NOTE: the server sends server-sent events, `partial` events are yielded, `error` raises and `end` finishes
+        
+        Example:
+            for partial in client.stream({"repo_name": repo_name, "inputs": {"text": prompt}}):
+                print(partial, end="")
+        """
+        # the span and the duration cover the whole stream, until the last partial output
+        with CLIENT_SECONDS.labels(method="stream").time(), tracing.start_span("client.stream"):
+            headers = tracing.inject({
+                "Authorization":f"Bearer {self.api_key}",
+                "Accept": "text/event-stream",
+            })
+            try:
+                with requests.post(f"{self.server_uri}{MODEL_STREAM_URI}", json=data, headers=headers, stream=True, timeout=timeout) as resp:
+                    if resp.status_code != 200:
+                        raise HTTPError(f"Request faild, ERR_CODE : {resp.status_code}, \nDetails: {resp.content}", resp.status_code)
+                    for event, payload in iter_events(resp.iter_lines(chunk_size=None)):
+                        if event == "error":
+                            raise RuntimeError(f"The request failed while streaming, \nDetails: {payload}")
+                        elif event == "end":
+                            return
+                        elif event in ["partial", "message"]:
+                            yield payload
+            except Exception:
+                CLIENT_ERRORS.labels(method="stream").inc()
+                raise
 
+    @_instrumented
     def request_status(self, task_id):
         """
         check status of your request
         task_id: id of your request
         """
-        url = f"{SERVER_URI}{REQUEST_RESULT_URI}"
+        url = f"{self.server_uri}{REQUEST_RESULT_URI}"
         
         resp = requests.post(
             url, 
             json={"task_id":task_id},
-            headers={
+            headers=tracing.inject({
                         "Authorization":f"Bearer {self.api_key}"
-                    })
+                    }))
         
         if resp.status_code != 200:
             raise RuntimeError(f"Failed to fetch teh status, ERR_CODE: {resp.status_code}, \nDetails: {resp.content}")
         
         return resp.json()
     
-    def download_file(self, file_info):
+    @_instrumented
+    def download_file(self, file_info, output_dir=None, quiet=False):
         """
         Download files from file url returned as result of your request (in case of SUCCESS)
         file_info= {
             'type': 'image/png', 
             'url': 'https://api.matrixai.name/repo/download/?task_id=2fdc1bd8-1de2-471b-a193-7700b30f731a&output_id=92bf6594-547c-3e6a-a3a2-57156bd20dcf'
         }
+        output_dir: the directory to save the file in, default is the current directory
+        quiet: if True, the path of the saved file is not printed
         """
         
         file_url = file_info["url"]
         resp = requests.get(
             file_url, 
-            headers={
+            headers=tracing.inject({
                         "Authorization":f"Bearer {self.api_key}"
-                    })
+                    }))
         
         if resp.status_code != 200:
             raise RuntimeError(f"Failed to download the file, ERR_CODE: {resp.status_code}")
@@ -141,9 +392,13 @@ class Client:
             file_extension = '.bin'
         
         file_name = f"{file_id}{file_extension}"
+        if output_dir is not None:
+            file_name = os.path.join(output_dir, file_name)
         with open(file_name, 'wb') as f:
             f.write(resp.content)
         
-        print(f"Saved file to {file_name}")
+        if not quiet:
+            print(f"Saved file to {file_name}")
+        return file_name
         
 
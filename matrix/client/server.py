@@ -1,5 +1,7 @@
 SERVER_URI = "https://api.matrix-ai.app"
 UPLOAD_FILES_URI = "/upload/files/"
 MODEL_REQUEST_URI = "/repo/model/"
+MODEL_BATCH_REQUEST_URI = "/repo/model/batch/"
+MODEL_STREAM_URI = "/repo/model/stream/"
 REQUEST_RESULT_URI = "/repo/results/"
 REPO_LIST_URI = "/repo/list/"
@@ -0,0 +1,47 @@
+"""
+Server-sent events (text/event-stream), used to stream partial outputs of a request
+"""
+
+import json
+
+
+def format_event(data, event=None, id=None):
+    """
+        encodes one event, data is sent as json
+    """
+    lines = []
+    if id is not None:
+        lines.append(f"id: {id}")
+    if event is not None:
+        lines.append(f"event: {event}")
+    for line in json.dumps(data).splitlines():
+        lines.append(f"data: {line}")
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+def iter_events(lines):
+    """
+        parses the lines of an event stream, yields (event, data) tuples, event is "message" if not given
+        and data is the decoded json
+    """
+    event, data = None, []
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.rstrip("\r\n")
+        if not line:
+            if data:
+                yield event or "message", json.loads("\n".join(data))
+            event, data = None, []
+        elif line.startswith(":"):
+            # comment, used as keep-alive
+            continue
+        else:
+            field, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            if field == "event":
+                event = value
+            elif field == "data":
+                data.append(value)
+    if data:
+        yield event or "message", json.loads("\n".join(data))
@@ -1,22 +1,94 @@
 
 import pkg_resources
-import shutil
+import ast
 import os
+import re
 from zipfile import ZipFile
 
-FRAMEWORKS = ["pt", "tf", "oth"]
+FRAMEWORKS = ["pt", "tf", "onnx", "oth"]
 
-def update_dockerfile(cwd, framework):
-    matrix_dir = pkg_resources.resource_filename("matrix", '')
+# the variable of the project settings.py holding the build arguments of the Dockerfile
+BUILD_ARGS_SETTING = "DOCKER_BUILD_ARGS"
+
+DOCKERIGNORE = [".matrix_temp", "__pycache__", "*.pyc", ".git", "results", "output", "error", ".env"]
+
+
+def generate_dockerfile(framework, build_args=None):
+    """
+     Generate the Dockerfile of the given framework from the templates
+     
+     Args:
+     	 framework: one of FRAMEWORKS
+     	 build_args: dict of the pinned build arguments, e.g. {"TORCH_VERSION": "2.2.2", "BASE_IMAGE": "..."}
+     	 	 these replace the default values of the ARG lines of the template, usually read from the project settings
+     
+     Returns: 
+     	 the content of the Dockerfile
+    """
     if framework not in FRAMEWORKS:
         raise RuntimeError(f"Framework must be one of these: {FRAMEWORKS}")
     
-    if framework=="pt":
-        shutil.copy2(src=os.path.join(matrix_dir, "templates", "Dockerfile-pt"), dst=os.path.join(cwd, "Dockerfile"))
-    elif framework=="tf":
-        shutil.copy2(src=os.path.join(matrix_dir, "templates", "Dockerfile-tf"), dst=os.path.join(cwd, "Dockerfile"))
-    else:
-        shutil.copy2(src=os.path.join(matrix_dir, "templates", "Dockerfile-oth"), dst=os.path.join(cwd, "Dockerfile"))
+    matrix_dir = pkg_resources.resource_filename("matrix", '')
+    with open(os.path.join(matrix_dir, "templates", f"Dockerfile-{framework}"), "r") as f:
+        content = f.read()
+    
+    for name, value in (build_args or {}).items():
+        pattern = re.compile(rf"^ARG {re.escape(name)}=.*$", re.MULTILINE)
+        if not pattern.search(content):
+            raise RuntimeError(f"Dockerfile-{framework} has no build argument {name}")
+        content = pattern.sub(lambda _: f"ARG {name}={value}", content)
+    return content
+
+
+def read_build_args(project_dir):
+    """
+     Read DOCKER_BUILD_ARGS of the settings.py of the project, e.g. DOCKER_BUILD_ARGS = {"TORCH_VERSION": "2.2.2"}
+     settings.py is parsed, not imported, so its dependencies do not need to be installed
+     
+     Returns: 
+     	 the dict of build arguments, empty if settings.py or the variable does not exist
+    """
+    path = os.path.join(project_dir, "settings.py")
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read(), filename=path)
+    
+    build_args = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == BUILD_ARGS_SETTING for t in node.targets):
+            try:
+                build_args = ast.literal_eval(node.value)
+            except ValueError:
+                raise RuntimeError(f"{BUILD_ARGS_SETTING} in {path} must be a dict of constants")
+    if not isinstance(build_args, dict):
+        raise RuntimeError(f"{BUILD_ARGS_SETTING} in {path} must be a dict, got {type(build_args).__name__}")
+    return {str(name): str(value) for name, value in build_args.items()}
+
+
+def write_dockerfile(project_dir, framework, build_args=None):
+    """
+        writes the generated Dockerfile and a .dockerignore (if missing) to the project directory
+        the weights directory is created, since the Dockerfile copies it in its own layer
+    """
+    with open(os.path.join(project_dir, "Dockerfile"), "w") as f:
+        f.write(generate_dockerfile(framework, build_args=build_args))
+    
+    dockerignore = os.path.join(project_dir, ".dockerignore")
+    if not os.path.exists(dockerignore):
+        with open(dockerignore, "w") as f:
+            f.write("\n".join(DOCKERIGNORE) + "\n")
+    
+    os.makedirs(os.path.join(project_dir, "weights"), exist_ok=True)
+
+
+def update_dockerfile(cwd, framework, build_args=None):
+    """
+        regenerates the Dockerfile of the project, build_args default to DOCKER_BUILD_ARGS of its settings.py
+    """
+    if build_args is None:
+        build_args = read_build_args(cwd)
+    write_dockerfile(cwd, framework, build_args=build_args)
 
 
 def setup_project(cwd):
@@ -30,7 +102,7 @@ def setup_project(cwd):
     if action.lower() in ["yes", "y"]:
         use_pipeline = True
 
-    framework = input("What framework are you going to use? enter (`pt` for pytorch), (`tf` for tensorflow), (`oth` for others) ")
+    framework = input("What framework are you going to use? enter (`pt` for pytorch), (`tf` for tensorflow), (`onnx` for onnx runtime), (`oth` for others) ")
     if framework not in FRAMEWORKS:
         raise RuntimeError(f"Enter one of these pleae: {FRAMEWORKS}")
     
@@ -43,12 +115,7 @@ def setup_project(cwd):
     
     with ZipFile(zipfile_path, 'r') as zip: 
         zip.extractall(path=project_dir) 
-    if framework=="pt":
-        shutil.copy2(src=os.path.join(matrix_dir, "templates", "Dockerfile-pt"), dst=os.path.join(project_dir, "Dockerfile"))
-    elif framework=="tf":
-        shutil.copy2(src=os.path.join(matrix_dir, "templates", "Dockerfile-tf"), dst=os.path.join(project_dir, "Dockerfile"))
-    else:
-        shutil.copy2(src=os.path.join(matrix_dir, "templates", "Dockerfile-oth"), dst=os.path.join(project_dir, "Dockerfile"))
+    update_dockerfile(project_dir, framework)
 
 
     print("******************************************************************")
@@ -1,21 +1,61 @@
-from subprocess import Popen, PIPE
 import os
+import shlex
 from .server import *
+from ..utils.process import run_command, parse_docker_build_timings, print_build_timings
 import requests
 
 
 
 
-def build_local(docker_path, tag="test:latest"):
-    command = f"sudo docker build {docker_path}  --tag {tag}"
+def build_local(docker_path, tag="test:latest", cache_from=None, cache_to=None, build_args=None, timeout=None):
+    """
+     Build the image of the project with BuildKit, so the pip/apt cache mounts of the Dockerfile are used
+     
+     Args:
+     	 docker_path: the project directory containing the Dockerfile
+     	 tag: the tag of the image
+     	 cache_from: list of cache sources, e.g. ["type=registry,ref=user/app:cache"] or ["user/app:latest"]
+     	 cache_to: cache destination, e.g. "type=local,dest=.matrix_temp/build_cache", uses docker buildx
+     	 build_args: dict of build arguments, e.g. {"TORCH_VERSION": "2.2.2"}
+     	 timeout: seconds after which the build is killed
+     
+     NOTE: the output is logged to .matrix_temp/build.log and the duration of each step is printed
+     
+     Returns: 
+     	 list of the build steps with their durations
+    """
+    os.makedirs(os.path.join(docker_path, "weights"), exist_ok=True)
+    
+    # plain progress prints the duration of each step
+    options = ["--progress=plain"]
+    for source in cache_from or []:
+        options.append(f"--cache-from {shlex.quote(source)}")
+    for name, value in (build_args or {}).items():
+        options.append(f"--build-arg {shlex.quote(f'{name}={value}')}")
+    
+    if cache_to:
+        # exporting the cache needs buildx, --load keeps the image in the local docker images
+        options.append(f"--cache-to {shlex.quote(cache_to)}")
+        command = f"sudo docker buildx build --load {' '.join(options)} {docker_path} --tag {tag}"
+    else:
+        # inline cache metadata lets other builds use this image with --cache-from
+        options.append("--build-arg BUILDKIT_INLINE_CACHE=1")
+        command = f"sudo DOCKER_BUILDKIT=1 docker build {' '.join(options)} {docker_path} --tag {tag}"
     print("running command->", command)
-    p = Popen(command, shell=True, stdout=PIPE, stderr=PIPE, universal_newlines=True, bufsize=1000)
-    for line in p.stdout:
-        print(line)
-    out, err = p.communicate()
-    # err = err.decode("utf-8")
-    if err!="":
-        raise RuntimeError( "Test Error->\n {err}")
+    
+    log_dir = os.path.join(docker_path, ".matrix_temp")
+    os.makedirs(log_dir, exist_ok=True)
+    result = run_command(command, log_path=os.path.join(log_dir, "build.log"), timeout=timeout)
+    
+    timings = parse_docker_build_timings(result)
+    if timings:
+        print_build_timings(timings)
+    
+    if result.timed_out:
+        raise RuntimeError(f"Build timed out after {timeout}s")
+    if result.returncode != 0:
+        raise RuntimeError(f"Build Error->\n {result.stderr}")
+    return timings
 
 def build_request(repo_name, token):
 
@@ -5,6 +5,12 @@ import hashlib
 from tqdm import tqdm
 import json
 from zipfile import ZipFile
+from ..utils import metrics
+
+
+UPLOAD_BYTES = metrics.counter("matrix_upload_repo_bytes", "Bytes of repo archives uploaded by upload_repo")
+UPLOAD_SECONDS = metrics.histogram("matrix_upload_repo_seconds", "Duration of upload_repo", buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800))
+UPLOAD_CHUNK_SECONDS = metrics.histogram("matrix_upload_repo_chunk_seconds", "Duration of uploading one chunk in upload_repo")
 
 
 def delete_repo(repo_name, token=None):
@@ -67,6 +73,11 @@ def zipify(directory_path, zip_path):
 
 
 def upload_repo(cwd, token=None, settings=None):
+    with UPLOAD_SECONDS.time():
+        return _upload_repo(cwd, token=token, settings=settings)
+
+
+def _upload_repo(cwd, token=None, settings=None):
     if token is None:
         raise RuntimeError("You need to provide a token authentication")
     
@@ -147,38 +158,42 @@ def upload_repo(cwd, token=None, settings=None):
             }
             """
             
-            resp = requests.post(
-                url = url,
-                headers={
-                    "Content-Range": "bytes {}-{}/{}".format(offset, offset + len(chunk) - 1, total),
-                    "Authorization":f"Bearer {token}"
-                },
-                files={'file': chunk}
-            )
+            with UPLOAD_CHUNK_SECONDS.time():
+                resp = requests.post(
+                    url = url,
+                    headers={
+                        "Content-Range": "bytes {}-{}/{}".format(offset, offset + len(chunk) - 1, total),
+                        "Authorization":f"Bearer {token}"
+                    },
+                    files={'file': chunk}
+                )
 
             if resp.status_code==200:
                 resp_json = resp.json()
                 upload_id = resp_json["upload_id"]
                 offset = resp_json["offset"]
+                UPLOAD_BYTES.inc(len(chunk))
                 with open(history_file, "w") as f:
                     f.write(json.dumps({"upload_id":upload_id, "offset": offset}))
             else:
                 raise RuntimeError(f"Upload Failed with {resp.status_code}")
         else:
             if index==offset:
-                resp = requests.post(
-                    url = url,
-                    headers={
-                        "Content-Range": "bytes {}-{}/{}".format(offset, offset + len(chunk) - 1, total),
-                        "Authorization":f"Bearer {token}"
-                    },
-                    data={"upload_id": upload_id},
-                    files={'file': chunk}
-                )
+                with UPLOAD_CHUNK_SECONDS.time():
+                    resp = requests.post(
+                        url = url,
+                        headers={
+                            "Content-Range": "bytes {}-{}/{}".format(offset, offset + len(chunk) - 1, total),
+                            "Authorization":f"Bearer {token}"
+                        },
+                        data={"upload_id": upload_id},
+                        files={'file': chunk}
+                    )
                 
                 if resp.status_code==200:
                     resp_json = resp.json()
                     offset = resp_json["offset"]
+                    UPLOAD_BYTES.inc(len(chunk))
                     with open(history_file, "w") as f:
                         f.write(json.dumps({"upload_id":upload_id, "offset": offset}))
                 else:
@@ -1,62 +1,371 @@
-from subprocess import Popen, PIPE
-import importlib.util as implib
+from subprocess import PIPE, run
+from concurrent.futures import ThreadPoolExecutor
+from packaging.requirements import Requirement, InvalidRequirement
+from packaging.utils import canonicalize_name
 from ..utils.logging import logging
-from ..utils.loaders import auto_file_loader
+from ..utils.versions import importlib_metadata
+from ..utils.loaders import auto_file_loader, load_payload_inputs
+from ..utils.process import run_command
+from ..utils.transport import new_payload_dir, write_payload
+import hashlib
+import json
 import os
+import re
+import shutil
+import sys
+import time
+import uuid
 
-def read_requirements(path="requirements.txt"):
+def _installed_distributions():
+    """
+        {normalized distribution name: version} of the installed distributions, read in a single pass
+    """
+    installed = {}
+    for dist in importlib_metadata.distributions():
+        name = dist.metadata["Name"]
+        if name:
+            installed.setdefault(canonicalize_name(name), dist.version)
+    return installed
 
+
+def _parse_requirement_line(line):
+    """
+        returns a Requirement, the raw line if it is a url/path without a name, or None if nothing should be installed
+    """
+    line = line.split(" #")[0].strip()
+    if not line or line.startswith("#"):
+        return None
+    editable = re.match(r"(-e|--editable)(\s+|=)", line)
+    if editable:
+        # checked like the same requirement without -e, it is installed from its url (not in editable mode)
+        line = line[editable.end():].strip()
+    elif line.startswith("-"):
+        # -r, --index-url, ... options are not resolved here
+        logging.warning(f"Skipping requirement option `{line}`")
+        return None
+    
+    egg = re.search(r"#egg=([\w\-\.]+)", line)
+    if egg and "://" in line:
+        # git+https://...#egg=name
+        return Requirement(f"{egg.group(1)} @ {line.split('#')[0]}")
+    try:
+        return Requirement(line)
+    except InvalidRequirement:
+        return line
+
+
+def find_missing_requirements(path="requirements.txt"):
+    """
+     Parse the requirements file (PEP 508) and compare it with the installed distributions
+     
+     Args:
+     	 path: path to the requirements file
+     
+     Returns: 
+     	 list of requirement strings that are not installed or whose installed version does not match
+    """
     with open(path, "r") as f:
-        requirements = f.read().splitlines()
+        lines = f.read().splitlines()
     
-    if not requirements:
+    if not lines:
         raise RuntimeError("Requirements.txt is empty!")
     
-    for r in requirements:
-        if "-e " not in r: #and len(r.split("-"))==1:
-            rclean = r.split("==")[0]
-            rclean = rclean.split(">=")[0]
-            rclean = rclean.split("<=")[0]
-            _pkg_available = implib.find_spec(rclean) is not None
-            if not _pkg_available:
-                print(f"{r} is not installed, starting to install...")
-                p = Popen(f"pip install {r}", shell=True, stdout=PIPE, stderr=PIPE)
-                out, err = p.communicate()
-                err = err.decode("utf-8")
-                if err!="":
-                    raise RuntimeError( "Package could not be installed, ERROR->\n {err}")
-
-def test_main(cwd, image, device, framework, types_):
-    input_dir = os.path.join(cwd, "samples")
-    inputs = auto_file_loader(input_dir, types_)
+    installed = _installed_distributions()
+    missing = []
+    for line in lines:
+        requirement = _parse_requirement_line(line)
+        if requirement is None:
+            continue
+        if isinstance(requirement, str):
+            # a url or a path without a name, it can not be checked
+            missing.append(requirement)
+            continue
+        if requirement.marker is not None and not requirement.marker.evaluate():
+            continue
+        
+        got_ver = installed.get(canonicalize_name(requirement.name), None)
+        if got_ver is None:
+            # "name @ url" for urls, pip installs them like the original line
+            missing.append(str(requirement))
+        elif requirement.specifier and not requirement.specifier.contains(got_ver, prereleases=True):
+            missing.append(str(requirement))
+    return missing
 
-    if not inputs:
-        raise RuntimeError(f"No samples provided for automatic testing")
+
+def read_requirements(path="requirements.txt", wheel_dir=None, no_index=False):
+    """
+     Install the missing requirements of the requirements file with one pip call
+     
+     Args:
+     	 path: path to the requirements file
+     	 wheel_dir: a local directory of wheels to install from (pip --find-links)
+     	 no_index: if True, only wheel_dir is used, PyPI is not contacted
+     
+     Returns: 
+     	 list of the installed requirements
+    """
+    missing = find_missing_requirements(path)
+    if not missing:
+        return []
     
-    if set(types_) != set(list(inputs.keys())):
-        raise RuntimeError(f"Wrong inputs has been loaded! check auto_file_loader")
+    print(f"{', '.join(missing)} not installed, starting to install...")
+    command = [sys.executable, "-m", "pip", "install"]
+    if wheel_dir is not None:
+        command += ["--find-links", wheel_dir]
+    if no_index:
+        command.append("--no-index")
+    p = run(command + missing, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    if p.returncode != 0:
+        raise RuntimeError(f"Package could not be installed, ERROR->\n {p.stderr}")
+    return missing
+
+
+TEST_CACHE_FILE = os.path.join(".matrix_temp", "test_cache.json")
+REPORT_FILE = "test_report.json"
+TRANSPORTS = ["files", "shm"]
+
+# runs the command given after the timeout inside the container and prints its peak memory, python3 exists in every matrix image
+# on timeout the whole process group is killed, killing the `docker exec` client does not stop the command in the container
+_MEASURE_SCRIPT = """
+import os, resource, signal, subprocess, sys
+timeout = float(sys.argv[1]) or None
+p = subprocess.Popen(sys.argv[2:], start_new_session=True)
+try:
+    r = p.wait(timeout=timeout)
+except subprocess.TimeoutExpired:
+    os.killpg(p.pid, signal.SIGKILL)
+    p.wait()
+    print('MATRIX_TIMEOUT', flush=True)
+    r = 124
+print('MATRIX_MAXRSS_KB', resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+sys.exit(r)
+"""
+# seconds the `docker exec` client gets on top of the timeout enforced in the container
+_TIMEOUT_GRACE = 10
+
+
+def _list_cases(input_dir):
+    """
+        samples/ with files is a single case, samples/ with sub directories has one case per sub directory
+    """
+    sub_dirs = sorted(entry.name for entry in os.scandir(input_dir) if entry.is_dir() and not entry.name.startswith("."))
+    if sub_dirs:
+        return sub_dirs
+    return ["."]
+
+
+def _hash_dir(path):
+    md5_hash = hashlib.md5()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            md5_hash.update(os.path.relpath(file_path, path).encode("utf-8"))
+            with open(file_path, "rb") as f:
+                while chunk := f.read(1024*1024):
+                    md5_hash.update(chunk)
+    return md5_hash.hexdigest()
+
+
+def _image_digest(image):
+    p = run(["sudo", "docker", "image", "inspect", "--format", "{{.Id}}", image], stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    if p.returncode != 0:
+        raise RuntimeError(f"Image {image} not found, build it first ->\n {p.stderr}")
+    return p.stdout.strip()
+
+
+def _load_cache(cwd):
+    path = os.path.join(cwd, TEST_CACHE_FILE)
+    if os.path.exists(path):
+        try:
+            with open(path, "r") as f:
+                return json.loads(f.read())
+        except Exception:
+            return {}
+    return {}
+
+
+def _save_cache(cwd, cache):
+    path = os.path.join(cwd, TEST_CACHE_FILE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(json.dumps(cache, indent=4))
+
+
+def _run_case(container, case, framework, device, log_dir, timeout):
+    input_dir = "/app/data" if case=="." else f"/app/data/{case}"
+    output_dir = "/app/results" if case=="." else f"/app/results/{case}"
+    command = [
+        "sudo", "docker", "exec", container, "python3", "-c", _MEASURE_SCRIPT, str(timeout or 0),
+        "python3", "main.py", "--input_dir", input_dir, "--output_dir", output_dir, "--device", str(device), "--framework", framework
+    ]
+    log_path = os.path.join(log_dir, f"test_{'samples' if case=='.' else case}.log")
+    result = run_command(command, log_path=log_path, timeout=timeout + _TIMEOUT_GRACE if timeout else None, echo=False)
+    latency = result.duration
+    
+    peak_memory = None
+    timed_out = result.timed_out
+    stdout_lines = []
+    for line in result.stdout.splitlines():
+        if line.startswith("MATRIX_MAXRSS_KB"):
+            peak_memory = int(line.split()[1]) * 1024
+        elif line.startswith("MATRIX_TIMEOUT"):
+            timed_out = True
+        else:
+            stdout_lines.append(line)
+
+    return {
+        "case": case,
+        "passed": result.ok and not timed_out,
+        "timed_out": timed_out,
+        "latency_s": latency,
+        "peak_memory_bytes": peak_memory,
+        "stdout": "\n".join(stdout_lines),
+        "stderr": result.stderr,
+    }
+
+
+def test_main(cwd, image, device, framework, types_, workers=1, use_cache=True, timeout=None, transport="files"):
+    """
+     Test the built image on the samples inside one warm container and write a performance report
+     
+     Args:
+     	 cwd: the project directory
+     	 image: the docker tag of the built image
+     	 device: "cpu" or -1 to test on cpu, otherwise the gpu index
+     	 framework: pt, tf or oth
+     	 types_: the INPUT_TYPES of the project
+     	 workers: number of cases that run concurrently inside the container
+     	 use_cache: if True, cases that passed before with the same inputs, image, device, framework and transport are skipped
+     	 timeout: seconds after which a case is killed and fails
+     	 transport: "files" mounts samples/ into the container, "shm" decodes the samples once on the host and
+     	            hands them over as shared memory payloads (matrix.utils.transport), auto_file_loader maps them without a copy
+     
+     NOTE: samples/ could contain the inputs directly (one case) or one sub directory of inputs per case
+            the report is written to results/test_report.json and the output of each case to .matrix_temp/logs/
+     
+     Returns: 
+     	 the report as a dictionary
+    """
+    if transport not in TRANSPORTS:
+        raise RuntimeError(f"transport should be one of {TRANSPORTS}, got {transport}")
+    input_dir = os.path.join(cwd, "samples")
+    cases = _list_cases(input_dir)
+    
+    loaded = {}
+    for case in cases:
+        case_dir = os.path.join(input_dir, case)
+        # videos and other inputs which are not arrays are kept as paths for a payload, and loaded inside the container
+        inputs = load_payload_inputs(case_dir, types_) if transport == "shm" else auto_file_loader(case_dir, types_)
+        loaded[case] = inputs
+
+        if not inputs:
+            raise RuntimeError(f"No samples provided for automatic testing in {case_dir}")
+        
+        if set(types_) != set(list(inputs.keys())):
+            raise RuntimeError(f"Wrong inputs has been loaded for {case_dir}! check auto_file_loader")
     
     # if install:
     #     read_requirements(path=requirements)
     
-    
     output_dir = os.path.join(cwd, "results")
     os.makedirs(output_dir, exist_ok=True)
+    for case in cases:
+        os.makedirs(os.path.join(output_dir, case), exist_ok=True)
+    
+    digest = _image_digest(image)
+    cache = _load_cache(cwd) if use_cache else {}
+    
+    to_run = []
+    skipped = []
+    for case in cases:
+        key = f"{image}:{device}:{framework}:{transport}:{case}"
+        input_hash = _hash_dir(os.path.join(input_dir, case))
+        cached = cache.get(key, None)
+        if cached and cached["image"]==digest and cached["inputs"]==input_hash and cached["result"]["passed"]:
+            print(f"Skipping case `{case}`, inputs and image are unchanged")
+            skipped.append(cached["result"])
+        else:
+            to_run.append((case, key, input_hash))
+    
+    results = []
+    total_time = 0.0
+    if to_run:
+        weights_dir = os.path.join(cwd, "weights")
+        log_dir = os.path.join(cwd, ".matrix_temp", "logs")
+        os.makedirs(log_dir, exist_ok=True)
+        container = f"matrix-test-{uuid.uuid4().hex[:12]}"
+        gpus = [] if device in [-1, "cpu"] else ["--gpus", "all"]
+        data_mounts = ["--mount", f"type=bind,source={input_dir},target=/app/data/"]
+        payload_root = None
+        if transport == "shm":
+            payload_root = new_payload_dir("matrix-test")
+            for case, _, _ in to_run:
+                write_payload(os.path.join(payload_root, case), loaded[case])
+            # generic, pdf and FileRef inputs are paths on the host, they stay valid if samples/ is mounted at the same path
+            data_mounts = [
+                "--mount", f"type=bind,source={payload_root},target=/app/data/",
+                "--mount", f"type=bind,source={input_dir},target={input_dir},readonly",
+            ]
+        command = [
+            "sudo", "docker", "run", "-d", "--rm", "--name", container, *gpus,
+            *data_mounts,
+            "--mount", f"type=bind,source={output_dir},target=/app/results/",
+            "--mount", f"type=bind,source={weights_dir},target=/app/weights/",
+            "--entrypoint", "sleep", image, "infinity"
+        ]
+        print("running command->", " ".join(command))
+        p = run(command, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+        if p.returncode != 0:
+            if payload_root is not None:
+                shutil.rmtree(payload_root, ignore_errors=True)
+            raise RuntimeError(f"Test Error, could not start the container->\n {p.stderr}")
+        
+        try:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                futures = [executor.submit(_run_case, container, case, framework, device, log_dir, timeout) for case, _, _ in to_run]
+                results = [future.result() for future in futures]
+            total_time = time.perf_counter() - start
+        finally:
+            run(["sudo", "docker", "rm", "-f", container], stdout=PIPE, stderr=PIPE)
+            if payload_root is not None:
+                shutil.rmtree(payload_root, ignore_errors=True)
+        
+        for (case, key, input_hash), result in zip(to_run, results):
+            print(f"---------------- case `{case}` ----------------")
+            print(result["stdout"])
+            cache[key] = {"image": digest, "inputs": input_hash, "result": result}
+        _save_cache(cwd, cache)
+
+    report = {
+        "image": image,
+        "image_digest": digest,
+        "device": str(device),
+        "workers": workers,
+        "transport": transport,
+        "cases": results + skipped,
+        "skipped": [result["case"] for result in skipped],
+        "total_time_s": total_time,
+        "throughput_cases_per_s": len(results) / total_time if total_time else None,
+    }
+    with open(os.path.join(output_dir, REPORT_FILE), "w") as f:
+        f.write(json.dumps(report, indent=4))
+    
+    print(f"{'case':<30}{'passed':<10}{'latency(s)':<15}{'peak memory(MB)':<15}")
+    for result in report["cases"]:
+        memory = f"{result['peak_memory_bytes'] / 1024**2:.1f}" if result["peak_memory_bytes"] else "N/A"
+        print(f"{result['case']:<30}{str(result['passed']):<10}{result['latency_s']:<15.3f}{memory:<15}")
+    if report["throughput_cases_per_s"]:
+        print(f"throughput: {report['throughput_cases_per_s']:.3f} cases/s")
+    
+    failed = [result for result in results if not result["passed"]]
+    if failed:
+        errors = "\n".join(f"case `{result['case']}`:\n{result['stderr']}" for result in failed)
+        raise RuntimeError(f"Test Error->\n {errors}")
     
-    weights_dir = os.path.join(cwd, "weights")
-    if device in [-1, "cpu"]:
-        command = f"sudo docker run --mount type=bind,source={input_dir},target=/app/data/ --mount type=bind,source={output_dir},target=/app/results/ --mount type=bind,source={weights_dir},target=/app/weights/ {image} python3 main.py --input_dir /app/data --output_dir /app/results --device {device} --framework {framework}"
-    else:
-        command = f"sudo docker run --gpus all --mount type=bind,source={input_dir},target=/app/data/ --mount type=bind,source={output_dir},target=/app/results/ --mount type=bind,source={weights_dir},target=/app/weights/ {image} python3 main.py --input_dir /app/data --output_dir /app/results --device {device} --framework {framework}"
-    
-    print("running command->", command)
-    p = Popen(command, shell=True, stdout=PIPE, stderr=PIPE, universal_newlines=True)
-    for line in p.stdout:
-        print(line)
-    out, err = p.communicate()
-    print(p.returncode)
-    # err = err.decode("utf-8")
-    if p.returncode and err!="":
-        if not ("warning" in err.lower()):
-            raise RuntimeError( f"Test Error->\n {err}")
+    for result in results:
+        if result["stderr"]:
+            logging.warning(f"case `{result['case']}` stderr->\n {result['stderr']}")
     
+    return report
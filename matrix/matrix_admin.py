@@ -3,12 +3,23 @@
 import argparse
 import os
 from matrix.manager.admin import setup_project
+from matrix.client.bench import bench_main
 
 def parse_cmd() -> dict:
     parser = argparse.ArgumentParser(
                         prog='Matrix Project Admin',
                         description='This script is Matrix Admin and it is used to do different task related for matrix including creating a new project')
     parser.add_argument('--startproject', action='store_true', help="If given, it will setup a project")
+    parser.add_argument('--bench', action='store_true', help="If given, it will load test a deployed repo")
+    parser.add_argument('--repo_name', default=None, help="bench: author_username/repo_name of the repo under test")
+    parser.add_argument('--api_key', default=os.getenv("MATRIX_TOKEN"), help="bench: api key, default is MATRIX_TOKEN env var")
+    parser.add_argument('--files', nargs='*', default=None, help="bench: files uploaded with each request")
+    parser.add_argument('--text', default=None, help="bench: text input of each request")
+    parser.add_argument('--requests', type=int, default=100, help="bench: total number of requests")
+    parser.add_argument('--concurrency', type=int, default=8, help="bench: number of requests in flight")
+    parser.add_argument('--rate', type=float, default=None, help="bench: requests started per second")
+    parser.add_argument('--server_uri', default=None, help="bench: address of the server, default is the matrix server")
+    parser.add_argument('--mock', action='store_true', help="bench: run against a local mock server")
     args = parser.parse_args()
     
     return vars(args)
@@ -18,3 +29,17 @@ def main():
 
     if cmds["startproject"]:
         setup_project(os.getcwd())
+    elif cmds["bench"]:
+        if not cmds["repo_name"]:
+            raise RuntimeError("--repo_name is required for --bench")
+        bench_main(
+            api_key=cmds["api_key"],
+            repo_name=cmds["repo_name"],
+            files=cmds["files"],
+            text=cmds["text"],
+            server_uri=cmds["server_uri"],
+            mock=cmds["mock"],
+            requests=cmds["requests"],
+            concurrency=cmds["concurrency"],
+            rate=cmds["rate"],
+        )
@@ -1,9 +1,25 @@
 from contextlib import contextmanager
-from .utils.auxiliary import is_tf_available, is_torch_available, is_sklearn_available
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import copy
+import inspect
+import os
+import tempfile
+import time
+from .utils.auxiliary import is_tf_available, is_torch_available, is_sklearn_available, is_onnxruntime_available
 from typing import Any, Dict, List, Optional, Tuple, Union
 from abc import ABC, abstractmethod
 from packaging import version
-from .utils.logging import logging
+from .utils.logging import logging, get_logger
+from .utils.execution import PRECISIONS, CompiledModel, apply_execution_modes, autocast_context, make_example_inputs, warm_up_model
+from .utils.weights import load_weights_into_model
+from .utils.onnx_runtime import ensure_quantized, load_onnx_model
+from .utils.errors import DeadlineExceeded
+from .utils import metrics, tracing
+from .utils.writers import OutputWriter
+from .utils.transport import write_payload
+from .utils.loaders import auto_file_loader, SUPPORTED_TYPES
+from .preprocessing import BufferArena, bucket_indices, default_size
 
 
 GenericTensor = Union[List["GenericTensor"], "torch.Tensor", "tf.Tensor"]
@@ -15,10 +31,29 @@ if is_tf_available():
 if is_torch_available():
     import torch
 
+
+logger = get_logger(__name__)
+
+RUN_SECONDS = metrics.histogram("matrix_pipeline_run_seconds", "Duration of AbstractModel.run")
+STAGE_SECONDS = metrics.histogram("matrix_pipeline_stage_seconds", "Duration of each stage of AbstractModel.run", ["stage"])
+RUN_TOTAL = metrics.counter("matrix_pipeline_runs", "Calls of AbstractModel.run", ["status"])
+RUN_IN_FLIGHT = metrics.gauge("matrix_pipeline_in_flight", "Calls of AbstractModel.run in progress")
+FIRST_OUTPUT_SECONDS = metrics.histogram("matrix_pipeline_first_output_seconds", "Time from AbstractModel.run_stream to its first partial output")
+STREAM_CHUNKS = metrics.counter("matrix_pipeline_stream_chunks", "Partial outputs yielded by AbstractModel.run_stream")
+READY = metrics.gauge("matrix_pipeline_ready", "1 once AbstractModel.warm_up finished")
+
 class AbstractModel(ABC):
     """
         NOTE: Override init() in order to use __init__ functionality method if needed
 
+        NOTE: device could be a list of devices, e.g. [0, 1, 2, 3], the model is replicated on each device
+                and calls of run() from different threads are scheduled between the replicas,
+                use device_scheduling="round_robin" or "least_loaded" keyword argument to choose the policy
+                self.model and self.device always refer to the replica used by the current call
+
+        NOTE: with framework="onnx", loaded_model is the path of a .onnx file (see matrix.utils.onnx_runtime.export_onnx)
+                or an OnnxModel, self.model(inputs) runs the onnxruntime session and returns numpy arrays
+
         Parameters:
             params: dict, containing any param to initialize the model, params like device, ...
                 {"param1":value1, "param2":value2, ...}
@@ -40,8 +75,8 @@ class AbstractModel(ABC):
     """
 
     def __init__(self, loaded_model, device, framework, **kwargs) -> None:
-        if not (is_torch_available() or is_tf_available() or is_sklearn_available()):
-            raise logging.warning("At least needs torch, tensorflow or sklearn installed")
+        if not (is_torch_available() or is_tf_available() or is_sklearn_available() or is_onnxruntime_available()):
+            raise logging.warning("At least needs torch, tensorflow, onnxruntime or sklearn installed")
         
         if framework=="pt":
             if not is_torch_available():
@@ -49,40 +84,485 @@ class AbstractModel(ABC):
         elif framework=="tf":
             if not is_tf_available():
                 raise RuntimeError("Framework set to tensorflow but tensorflow is not available")
+        elif framework=="onnx":
+            if not is_onnxruntime_available():
+                raise RuntimeError("Framework set to onnx but onnxruntime is not available")
         
-        self.model = loaded_model
         self.framework = framework
         self.kwargs = kwargs # a dictionary of given keyword arguments, {embeddings:embeddings, sanitizer:sanitizer, ...}
         
-        # initiating the device
+        # the replica used by the current thread, see replica_scope()
+        self._local = threading.local()
+        self._replica_lock = threading.Lock()
+        
+        # a list of devices replicates the model on each device, requests are scheduled between the replicas
+        # device_scheduling: "round_robin" or "least_loaded"
+        self.device_scheduling = kwargs.get("device_scheduling", "round_robin")
+        if self.device_scheduling not in ["round_robin", "least_loaded"]:
+            raise RuntimeError(f"device_scheduling must be `round_robin` or `least_loaded`, got {self.device_scheduling}")
+        
+        if isinstance(device, (list, tuple)):
+            if len(device)==0:
+                raise RuntimeError("The given list of devices is empty")
+            devices = [self._parse_device(d) for d in device]
+        else:
+            devices = [self._parse_device(device)]
+        
+        # execution modes, usually set in the project settings and given as keyword arguments
+        # precision: "fp32", "fp16" or "bf16" -> autocast in forward (pytorch)
+        # compile_mode: pt-> "torch_compile" or "torchscript", tf-> "tf_function" or "xla"
+        # channels_last: if True, the model and 4D inputs use channels-last memory format (pytorch)
+        # example_inputs or example_input_shape: used to trace and warm up the model at load time
+        self.precision = kwargs.get("precision", "fp32") or "fp32"
+        self.compile_mode = kwargs.get("compile_mode", None)
+        self.channels_last = bool(kwargs.get("channels_last", False)) and self.framework == "pt"
+        if self.precision not in PRECISIONS:
+            raise RuntimeError(f"precision must be one of {PRECISIONS}, got {self.precision}")
+        if self.precision != "fp32" and self.framework != "pt":
+            logger.warning("precision is only applied to pytorch models, for tensorflow set the mixed precision policy before building the model")
+        
+        if self.framework == "onnx" and isinstance(loaded_model, str):
+            # quantized once here, the sessions of every device load the same file
+            loaded_model = ensure_quantized(loaded_model, kwargs.get("onnx_quantize", False))
+        
+        replicas = []
+        for i, d in enumerate(devices):
+            if i > 0 and d in devices[:i]:
+                # the same device shares the same weights
+                replicas.append(replicas[devices.index(d)])
+            elif self.framework == "onnx":
+                replicas.append(self._load_onnx(loaded_model, d))
+            elif i > 0 and self.framework == "pt":
+                replicas.append(self._apply_execution_modes(self._place_model(copy.deepcopy(loaded_model), d), d))
+            elif self.framework == "pt":
+                replicas.append(self._apply_execution_modes(self._place_model(loaded_model, d), d))
+            elif i == 0:
+                replicas.append(self._apply_execution_modes(loaded_model, d))
+            else:
+                # tensorflow places the variables on creation, the replicas share the model and ops are placed by device_placement()
+                replicas.append(replicas[0])
+        
+        self.replicas = replicas
+        self.devices = devices
+        
+        # reusable buffers for preprocess, see matrix.preprocessing, the buffers of a run are recycled by the next run
+        self.buffer_arena = BufferArena(max_bytes=kwargs.get("arena_max_bytes", 1024**3))
+        self._in_flight = [0] * len(devices)
+        self._next_replica = 0
+        
+        # set by warm_up(), see ready
+        self._ready = threading.Event()
+        self.warmup_report = None
+    
+    def _parse_device(self, device):
+        """
+            converts int, str or torch.device to the device used by the framework
+            pt -> torch.device, tf -> int (-1 for cpu)
+        """
         try:
             d = int(device)
             device = d
-        except ValueError:
+        except (ValueError, TypeError):
             pass
 
         if isinstance(device, str) and (device is None or device=="" or "cpu" in device.lower()):
             device = -1
         
-
         if self.framework == "pt":
             if isinstance(device, torch.device):
-                self.device = device
+                pass
             elif isinstance(device, str):
-                self.device = torch.device(device)
+                device = torch.device(device)
             elif device < 0:
-                self.device = torch.device("cpu")
+                device = torch.device("cpu")
             else:
-                self.device = torch.device(f"cuda:{device}")
+                device = torch.device(f"cuda:{device}")
                 
-            if self.device.type=="cuda":
-                if not torch.cuda.is_available():
-                    raise RuntimeError("Torch Device type set to cuda but cuda is not available")
-                self.model.to(device)
-            self.model.eval()
+            if device.type=="cuda" and not torch.cuda.is_available():
+                raise RuntimeError("Torch Device type set to cuda but cuda is not available")
             
-        elif self.framework == "tf":
-            self.device = device if device>=0 else -1
+        elif self.framework in ["tf", "onnx"]:
+            device = device if device>=0 else -1
+        
+        return device
+    
+    def _place_model(self, model, device):
+        if device.type=="cuda":
+            model.to(device)
+        weights_path = self.kwargs.get("weights_path", None)
+        if weights_path:
+            load_weights_into_model(model, weights_path, strict=self.kwargs.get("weights_strict", True))
+        model.eval()
+        return model
+    
+    def _load_onnx(self, model, device):
+        """
+            loaded_model of the onnx framework is the path of a .onnx file or an OnnxModel, one session per device
+            configured with onnx_intra_op_threads, onnx_inter_op_threads, onnx_graph_optimization
+            and onnx_io_binding keyword arguments, see matrix.utils.onnx_runtime
+            NOTE: with onnx_quantize the path is already the quantized file, see __init__
+        """
+        if isinstance(model, str):
+            return load_onnx_model(
+                model, device, 
+                intra_op_threads=self.kwargs.get("onnx_intra_op_threads", None),
+                inter_op_threads=self.kwargs.get("onnx_inter_op_threads", None),
+                graph_optimization=self.kwargs.get("onnx_graph_optimization", "all"),
+                io_binding=self.kwargs.get("onnx_io_binding", False),
+            )
+        return model.to(device) if hasattr(model, "to") else model
+    
+    def load_weights(self, path, strict=True):
+        """
+            Load the weights of a checkpoint (.safetensors, .npz, torch checkpoint) into the model of every replica,
+            tensors are copied one by one from the memory-mapped file to the device of the model
+            NOTE: give weights_path (and weights_strict) as keyword arguments to load them on instantiation
+            NOTE: a torchscript model is frozen with its weights as constants, it is compiled again from the eager model
+        """
+        if self.framework != "pt":
+            raise RuntimeError("load_weights is only supported for pytorch models, use the framework loader instead")
+        loaded = {}
+        replicas = []
+        for replica, device in zip(self.replicas, self.devices):
+            if id(replica) not in loaded:
+                model = replica._eager if isinstance(replica, CompiledModel) else replica
+                load_weights_into_model(model, path, strict=strict)
+                if isinstance(replica, CompiledModel) and replica.is_compiled and self.compile_mode == "torchscript":
+                    model = self._apply_execution_modes(model, device)
+                else:
+                    model = replica
+                loaded[id(replica)] = model
+            replicas.append(loaded[id(replica)])
+        self.replicas = replicas
+    
+    def _apply_execution_modes(self, model, device):
+        if self.compile_mode is None and not self.channels_last:
+            return model
+        example_inputs = make_example_inputs(
+            self.framework, device, 
+            example_inputs=self.kwargs.get("example_inputs", None), 
+            example_input_shape=self.kwargs.get("example_input_shape", None)
+        )
+        return apply_execution_modes(
+            model, self.framework, device, 
+            precision=self.precision, 
+            compile_mode=self.compile_mode, 
+            channels_last=self.channels_last,
+            example_inputs=example_inputs
+        )
+    
+    def execution_context(self):
+        """
+            autocast context for the forward pass if precision is set to fp16 or bf16, otherwise a no-op context
+        """
+        return autocast_context(self.framework, self.device, self.precision)
+    
+    @property
+    def model(self):
+        """
+            the model of the replica used by the current thread, the first replica outside of run()
+        """
+        return self.replicas[getattr(self._local, "replica", None) or 0]
+    
+    @model.setter
+    def model(self, value):
+        # setting the model drops the other replicas
+        self.replicas = [value]
+        self.devices = self.devices[:1] if hasattr(self, "devices") else [None]
+        self._in_flight = [0]
+    
+    @property
+    def device(self):
+        """
+            the device of the replica used by the current thread, the first device outside of run()
+        """
+        return self.devices[getattr(self._local, "replica", None) or 0]
+    
+    @device.setter
+    def device(self, value):
+        self.devices = [value] + self.devices[1:] if hasattr(self, "devices") else [value]
+    
+    def _acquire_replica(self):
+        with self._replica_lock:
+            if self.device_scheduling == "least_loaded":
+                index = min(range(len(self.replicas)), key=lambda i: self._in_flight[i])
+            else:
+                index = self._next_replica % len(self.replicas)
+                self._next_replica = index + 1
+            self._in_flight[index] += 1
+        return index
+    
+    def _release_replica(self, index):
+        with self._replica_lock:
+            self._in_flight[index] -= 1
+    
+    @contextmanager
+    def replica_scope(self):
+        """
+        Context Manager that binds one replica to the current thread, self.model and self.device refer to this replica inside it.
+        run() uses this, so concurrent calls of run() from different threads are spread over the devices
+        Nested scopes reuse the replica of the outer scope
+        """
+        index = getattr(self._local, "replica", None)
+        if index is not None or len(self.replicas)==1:
+            yield index or 0
+            return
+        
+        index = self._acquire_replica()
+        self._local.replica = index
+        try:
+            yield index
+        finally:
+            self._local.replica = None
+            self._release_replica(index)
+    
+    @contextmanager
+    def _bound_replica(self, index):
+        """
+            binds the replica index to the current thread for the block, run_stream() binds it for each step,
+            so the generator can be consumed from any thread
+        """
+        previous = getattr(self._local, "replica", None)
+        self._local.replica = index
+        try:
+            yield
+        finally:
+            self._local.replica = previous
+    
+    @property
+    def output_writer(self):
+        """
+            OutputWriter of the output_dir keyword argument, created on first use
+            configured with output_writer_workers, output_max_pending and output_fsync keyword arguments
+        """
+        # warm-up writes to its own temporary writer, only in its thread
+        writer = getattr(self._local, "output_writer", None) or getattr(self, "_output_writer", None)
+        if writer is None:
+            with self._replica_lock:
+                writer = getattr(self, "_output_writer", None)
+                if writer is None:
+                    output_dir = self.kwargs.get("output_dir", None)
+                    if output_dir is None:
+                        raise RuntimeError("output_writer needs the output_dir keyword argument")
+                    writer = self._make_output_writer(output_dir)
+                    self._output_writer = writer
+        return writer
+    
+    def _make_output_writer(self, output_dir):
+        return OutputWriter(
+            output_dir,
+            workers=self.kwargs.get("output_writer_workers", 2),
+            max_pending=self.kwargs.get("output_max_pending", 16),
+            fsync=self.kwargs.get("output_fsync", "none"),
+        )
+    
+    def flush_outputs(self):
+        """
+            waits until every output handed to self.output_writer is written
+        """
+        writer = getattr(self._local, "output_writer", None) or getattr(self, "_output_writer", None)
+        if writer is not None:
+            writer.flush()
+    
+    @property
+    def ready(self):
+        """
+            True once warm_up() finished, a server should report readiness (and receive traffic) only after this
+        """
+        return self._ready.is_set()
+    
+    def wait_until_ready(self, timeout=None):
+        """
+            blocks until warm_up() finished or timeout seconds passed, returns self.ready
+        """
+        return self._ready.wait(timeout)
+    
+    def _warmup_inputs(self, inputs):
+        if inputs is None:
+            inputs = self.kwargs.get("warmup_inputs", None)
+        if inputs is None:
+            samples_dir = self.kwargs.get("warmup_samples_dir", "samples")
+            if os.path.isdir(samples_dir):
+                inputs = auto_file_loader(samples_dir, self.kwargs.get("input_types", SUPPORTED_TYPES)) or None
+        return inputs
+    
+    @staticmethod
+    def _resize_batch(inputs, batch_size):
+        if batch_size is None:
+            return inputs
+        batch = {}
+        for key, items in inputs.items():
+            if isinstance(items, list) and items:
+                items = (items * (batch_size // len(items) + 1))[:batch_size]
+            batch[key] = items
+        return batch
+    
+    def _synchronize(self):
+        if self.framework == "pt" and isinstance(self.device, torch.device) and self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+    
+    @contextmanager
+    def _warmup_outputs(self, postprocess_params):
+        """
+            the output writer of the current thread and the output_dir of postprocess_params point to a temporary directory,
+            warm-up outputs are thrown away, concurrent run() calls in other threads keep writing to output_dir
+        """
+        with tempfile.TemporaryDirectory(prefix="matrix-warmup-") as temp_dir:
+            writer = self._make_output_writer(temp_dir)
+            self._local.output_writer = writer
+            try:
+                yield {**postprocess_params, "output_dir": temp_dir} if "output_dir" in postprocess_params else postprocess_params
+            finally:
+                self._local.output_writer = None
+                writer.close()
+    
+    def _warm_up(self, inputs, preprocess_params, forward_params, postprocess_params, batch_sizes, iterations):
+        inputs = self._warmup_inputs(inputs)
+        steps = []
+        start = time.perf_counter()
+        if inputs is None:
+            example_inputs = self.kwargs.get("example_inputs", None)
+            if example_inputs is None and self.kwargs.get("example_input_shape", None) is None:
+                logger.warning("warm_up found no inputs, give warmup_inputs, example_inputs or a samples directory, the model is marked ready without warm up")
+            else:
+                # synthetic inputs, only the model is warmed up
+                for index, device in enumerate(self.devices):
+                    example_inputs = make_example_inputs(
+                        self.framework, device, 
+                        example_inputs=self.kwargs.get("example_inputs", None), 
+                        example_input_shape=self.kwargs.get("example_input_shape", None)
+                    )
+                    for iteration in range(iterations):
+                        step_start = time.perf_counter()
+                        warm_up_model(self.replicas[index], self.framework, device, self.precision, example_inputs)
+                        steps.append({"replica": index, "device": str(device), "batch_size": None, "iteration": iteration, "forward_s": time.perf_counter() - step_start})
+        else:
+            with self._warmup_outputs(postprocess_params) as postprocess_params:
+                for index, device in enumerate(self.devices):
+                    # warm_up pins each replica in turn, replica_scope() inside reuses it
+                    self._local.replica = index
+                    try:
+                        for batch_size in batch_sizes:
+                            batch = self._resize_batch(inputs, batch_size)
+                            for iteration in range(iterations):
+                                step = {"replica": index, "device": str(device), "batch_size": batch_size, "iteration": iteration}
+                                step_start = time.perf_counter()
+                                model_inputs = self.preprocess(batch, **preprocess_params)
+                                step["preprocess_s"] = time.perf_counter() - step_start
+                                
+                                step_start = time.perf_counter()
+                                model_outputs = self._call_forward(model_inputs, forward_params)
+                                self._synchronize()
+                                step["forward_s"] = time.perf_counter() - step_start
+                                
+                                step_start = time.perf_counter()
+                                self.post_process(model_outputs, **postprocess_params)
+                                self.flush_outputs()
+                                step["post_process_s"] = time.perf_counter() - step_start
+                                steps.append(step)
+                    finally:
+                        self._local.replica = None
+        
+        self.warmup_report = {"total_s": time.perf_counter() - start, "steps": steps}
+        self._ready.set()
+        READY.set(1)
+        for step in steps:
+            timings = ", ".join(f"{k[:-2]}={v*1000:.1f}ms" for k, v in step.items() if k.endswith("_s"))
+            logger.info(f"warm up replica {step['replica']} ({step['device']}) batch_size={step['batch_size']} iteration {step['iteration']}: {timings}")
+        logger.info(f"warm up finished in {self.warmup_report['total_s']:.2f}s, the model is ready")
+        return self.warmup_report
+    
+    def warm_up(self, inputs=None, preprocess_params=None, forward_params=None, postprocess_params=None, batch_sizes=None, iterations=None, background=False):
+        """
+            Runs preprocess -> _forward -> post_process on every replica before the first request, so lazy initialisation,
+            kernel selection, allocator growth and compilation are paid here and not by the first requests.
+            self.ready is set when it finishes
+            
+            Args:
+                inputs: a dict of inputs like run(), default is the warmup_inputs keyword argument, then the files
+                    of the warmup_samples_dir keyword argument ("samples" by default) loaded with auto_file_loader,
+                    if none is found, only the model is warmed up on example_inputs or example_input_shape
+                preprocess_params, forward_params, postprocess_params: same as run()
+                batch_sizes: the list items of inputs are repeated to each batch size, default is the warmup_batch_sizes
+                    keyword argument, or the inputs as they are
+                iterations: passes per batch size and replica, default is the warmup_iterations keyword argument or 2
+                background: if True, warm up in a daemon thread and return it, use wait_until_ready()
+            
+            NOTE: outputs of post_process go to a temporary directory that is removed afterwards
+            
+            Returns:
+                the warm-up report {"total_s": seconds, "steps": [timings of each pass]}, or the thread if background
+        """
+        args = (
+            inputs, preprocess_params or {}, forward_params or {}, postprocess_params or {}, 
+            batch_sizes or self.kwargs.get("warmup_batch_sizes", None) or [None], 
+            iterations or self.kwargs.get("warmup_iterations", 2)
+        )
+        if not background:
+            return self._warm_up(*args)
+        
+        def target():
+            try:
+                self._warm_up(*args)
+            except Exception:
+                logger.exception("warm up failed, the model is not ready")
+        
+        thread = threading.Thread(target=target, name="matrix-warmup", daemon=True)
+        thread.start()
+        return thread
+    
+    def run_bucketed(self, inputs, preprocess_params, forward_params, postprocess_params, key=None, boundaries=None, size_fn=None):
+        """
+            Runs the inputs of one type in buckets of similar size, so padding happens only inside a bucket
+            and a compiled/traced model sees a small set of shapes
+
+            Args:
+                inputs, preprocess_params, forward_params, postprocess_params: same as run()
+                key: the input type to bucket, e.g. "text" or "image", default is the bucket_key keyword argument
+                boundaries: sorted bucket sizes, lengths (ints) or resolutions ((height, width) tuples),
+                    default is the bucket_boundaries keyword argument
+                size_fn: callable(item) -> size, default len() for texts/sequences and shape[:2] for images
+            
+            NOTE: run() is called once per bucket with inputs[key] holding the items of the bucket and
+                    preprocess_params["bucket_size"] the boundary of the bucket, pad to it in preprocess(), e.g.
+                    pad_sequences(tokens, max_length=bucket_size) or pad_images(images, bucket_size)
+                    the other input types are passed to every bucket unchanged
+            NOTE: post_process() must return a list with one output per item of the bucket
+
+            Returns:
+                list of outputs in the order of inputs[key]
+        """
+        key = key or self.kwargs.get("bucket_key", None)
+        boundaries = boundaries or self.kwargs.get("bucket_boundaries", None)
+        if key is None or not boundaries:
+            raise RuntimeError("run_bucketed needs a key and boundaries, or bucket_key and bucket_boundaries keyword arguments")
+        if key not in inputs:
+            raise RuntimeError(f"`{key}` is not in the inputs")
+        
+        items = inputs[key]
+        outputs = [None] * len(items)
+        for boundary, indices in bucket_indices(items, boundaries, size_fn=size_fn or default_size):
+            bucket_inputs = {**inputs, key: [items[i] for i in indices]}
+            bucket_outputs = self.run(bucket_inputs, {**preprocess_params, "bucket_size": boundary}, forward_params, postprocess_params)
+            if not isinstance(bucket_outputs, (list, tuple)) or len(bucket_outputs) != len(indices):
+                raise RuntimeError("post_process must return a list with one output per input when run_bucketed is used")
+            for index, output in zip(indices, bucket_outputs):
+                outputs[index] = output
+        return outputs
+    
+    def parallel_run(self, inputs_list, preprocess_params, forward_params, postprocess_params):
+        """
+            Run a list of inputs concurrently on the replicas, one thread per replica
+            
+            Returns:
+                list of outputs in the order of inputs_list
+        """
+        with ThreadPoolExecutor(max_workers=len(self.replicas)) as executor:
+            futures = [
+                executor.submit(self.run, inputs, preprocess_params, forward_params, postprocess_params) 
+                for inputs in inputs_list
+            ]
+            return [future.result() for future in futures]
             
     @contextmanager
     def device_placement(self):
@@ -123,6 +603,10 @@ class AbstractModel(ABC):
 
             NOTE: **preprocess_parameters give you the flexibility to specify any arguments
                     these preprocess_parameters are the same as the one passed to the run function
+            
+            NOTE: matrix.preprocessing has batched helpers that write into reusable buffers of self.buffer_arena, e.g.
+                    batch = batch_images(input_["image"], size=(224, 224), mean=MEAN, std=STD, arena=self.buffer_arena)
+                    the buffers are recycled when run() returns, do not return them from post_process
             Return:
                 the return values is the user choice, the return values usually is used as forward input
                 if model has multiple inputs, use dict to return them
@@ -153,42 +637,94 @@ class AbstractModel(ABC):
         )
         return inference_context
 
-    def _ensure_tensor_on_device(self, inputs, device):
-
+    def _ensure_tensor_on_device(self, inputs, device, memory_format=None, keep_dtype=False):
+        """
+            moves the tensors to the device
+            memory_format: if given, 4D tensors are converted to it, e.g. torch.channels_last
+            keep_dtype: if False, fp16/bf16 tensors moved to cpu are upcast to fp32
+        """
         if isinstance(inputs, dict):
-            return {name: self._ensure_tensor_on_device(tensor, device) for name, tensor in inputs.items()}
+            return {name: self._ensure_tensor_on_device(tensor, device, memory_format, keep_dtype) for name, tensor in inputs.items()}
         elif isinstance(inputs, list):
-            return [self._ensure_tensor_on_device(item, device) for item in inputs]
+            return [self._ensure_tensor_on_device(item, device, memory_format, keep_dtype) for item in inputs]
         elif isinstance(inputs, tuple):
-            return tuple([self._ensure_tensor_on_device(item, device) for item in inputs])
+            return tuple([self._ensure_tensor_on_device(item, device, memory_format, keep_dtype) for item in inputs])
         elif isinstance(inputs, torch.Tensor):
-            if device == torch.device("cpu") and inputs.dtype in {torch.float16, torch.bfloat16}:
+            if not keep_dtype and device == torch.device("cpu") and inputs.dtype in {torch.float16, torch.bfloat16}:
                 inputs = inputs.float()
-            return inputs.to(device)
+            inputs = inputs.to(device)
+            if memory_format is not None and inputs.dim() == 4:
+                inputs = inputs.contiguous(memory_format=memory_format)
+            return inputs
         else:
             return inputs
 
+    @property
+    def execution_modes_enabled(self):
+        """
+            True if precision, compile_mode or channels_last is set, run() then goes through _forward()
+        """
+        return self.precision != "fp32" or self.compile_mode is not None or self.channels_last
+    
+    def _call_forward(self, model_inputs, forward_params):
+        """
+            forward() as it was always called, inside execution_context(), the device handling of _forward() is used
+            only when an execution mode is turned on
+        """
+        if self.execution_modes_enabled:
+            return self._forward(model_inputs, **forward_params)
+        with self.execution_context():
+            return self.forward(model_inputs, **forward_params)
+    
     def _forward(self, model_inputs, **forward_params):
         """
-            this will run the forward function that you implemented and also handles the device 
-            if handle_device is set to True when calling the 'run' function
-            if handle_device is False, you need to handle inference mode inside forward() function
+            runs the forward function that you implemented with the replica and the device handled:
+            pt-> inference mode, the inputs are moved to the device (channels-last 4D tensors with channels_last)
+                and the outputs to cpu, forward runs in execution_context()
+            tf-> device_placement(), "training": False is added to dict inputs
         """
         if self.framework in ["pt", "tf"]:
-            with self.device_placement():
+            with self.replica_scope(), self.device_placement():
                 if self.framework == "tf":
-                    model_inputs["training"] = False
+                    if isinstance(model_inputs, dict):
+                        model_inputs["training"] = False
                     model_outputs = self.forward(model_inputs, **forward_params)
                 else:
                     inference_context = self.get_inference_context()
                     with inference_context():
-                        model_inputs = self._ensure_tensor_on_device(model_inputs, device=self.device)
-                        model_outputs = self.forward(model_inputs, **forward_params)
+                        model_inputs = self._ensure_tensor_on_device(
+                            model_inputs, 
+                            device=self.device,
+                            memory_format=torch.channels_last if self.channels_last else None,
+                            keep_dtype=self.precision!="fp32"
+                        )
+                        with self.execution_context():
+                            model_outputs = self.forward(model_inputs, **forward_params)
                         model_outputs = self._ensure_tensor_on_device(model_outputs, device=torch.device("cpu"))
 
             return model_outputs
+        elif self.framework == "onnx":
+            with self.replica_scope():
+                return self.forward(model_inputs, **forward_params)
         else:
             return self.forward(model_inputs, **forward_params)
+    
+    @contextmanager
+    def _forward_context(self):
+        """
+            the context of _call_forward(), run_stream() enters it for each step of a generator
+        """
+        if not self.execution_modes_enabled:
+            with self.execution_context():
+                yield
+        elif self.framework == "pt":
+            with self.device_placement(), self.get_inference_context()(), self.execution_context():
+                yield
+        elif self.framework == "tf":
+            with self.device_placement():
+                yield
+        else:
+            yield
         
     @abstractmethod
     def post_process(self, outputs_, *f_args, **f_kwargs):
@@ -215,10 +751,19 @@ class AbstractModel(ABC):
                     # name could be anything, but the extension should be a valid image extension
                     file_name = "name.jpg" # or "name.png"
                     cv2.imwrite(file_name, image)
+
+            NOTE: self.output_writer encodes and writes the outputs in the background, post_process returns without waiting:
+                    self.output_writer.write_text("name.txt", text)
+                    self.output_writer.write_image("name.png", image) # RGB numpy array
+                run() waits for the writes at its end, give output_flush="none" to let them overlap with the next request
+                and call self.flush_outputs() when the outputs must be on disk
+            
+            NOTE: with output_transport="shm", the returned outputs (arrays, strings, dicts of them) are also written to output_dir
+                as a shared payload, a runner on the same host reads them with matrix.utils.transport.read_payload without a copy
         """
         raise NotImplementedError("post_process not implemented")
 
-    def run(self, inputs, preprocess_params, forward_params, postprocess_params):
+    def run(self, inputs, preprocess_params, forward_params, postprocess_params, deadline=None, stream=False):
         """
             Run the model and save the output. This is the entry point for the model to be executed.
             
@@ -227,16 +772,157 @@ class AbstractModel(ABC):
                 preprocess_params: Dictionary of preprocessing parameters. These are used to preprocess the model's inputs before it is called.
                 forward_params: Dictionary of forward processing parameters. These are used to forward the model's inputs.
                 postprocess_params: Dictionary of postprocessing parameters. These are used to save the model's outputs after it is called.
+                deadline: time.monotonic() after which the request is useless, DeadlineExceeded is raised instead of
+                    starting preprocess or forward, see matrix.scheduler.Scheduler
+                stream: if True, returns run_stream(), a generator of partial outputs
             
             Returns: 
                 A dictionary of outputs generated by the preprocessed model's output
         """
+        if stream:
+            return self.run_stream(inputs, preprocess_params, forward_params, postprocess_params, deadline=deadline)
         if inputs is not None and len(inputs)==0:
             raise RuntimeError("the `inputs` dict is empty")
-        model_inputs = self.preprocess(inputs, **preprocess_params)
-        model_outputs = self.forward(model_inputs, **forward_params)
-        model_outputs = self.post_process(model_outputs, **postprocess_params)
+        with self._run_scope(), self.replica_scope(), self.buffer_arena.scope():
+            model_inputs = self._preprocess_stage(inputs, preprocess_params, deadline)
+            model_outputs = self._forward_stage(model_inputs, forward_params)
+            model_outputs = self._post_process_stage(model_outputs, postprocess_params)
+            self._finish_outputs(model_outputs)
         return model_outputs
+    
+    def run_stream(self, inputs, preprocess_params, forward_params, postprocess_params, deadline=None):
+        """
+            Run the model and yield partial outputs as soon as they are produced, e.g. tokens of a text generation or video frames
+            
+            forward() and post_process() could be generators:
+                forward() yields chunks -> post_process() is called on each chunk, its outputs are yielded
+                post_process() yields   -> each of its outputs is yielded
+                neither                 -> the output of post_process() is yielded once, like run()
+            
+            Example:
+                def forward(self, inputs):
+                    for token in self.model.generate(inputs):
+                        yield token
+                
+                for partial in pipeline.run_stream(inputs, {}, {}, {}):
+                    send(partial)
+            
+            NOTE: the replica and the preprocess buffers are held until the generator is exhausted or closed, close it if you stop early
+            NOTE: with output_transport="shm", the list of partial outputs is written to output_dir at the end
+            
+            Returns:
+                a generator of partial outputs
+        """
+        if inputs is not None and len(inputs)==0:
+            raise RuntimeError("the `inputs` dict is empty")
+        
+        index = self._acquire_replica() if len(self.replicas) > 1 else 0
+        buffers = []
+        start = time.perf_counter()
+        first = True
+        try:
+            with self._run_scope() as span:
+                # spans of the steps are children of the run span, whatever thread consumes the generator
+                parent = span.context
+                with self._stream_step(index, buffers):
+                    model_inputs = self._preprocess_stage(inputs, preprocess_params, deadline, parent=parent)
+                    model_outputs = self._forward_stage(model_inputs, forward_params, parent=parent)
+                
+                chunks = model_outputs if inspect.isgenerator(model_outputs) else iter([model_outputs])
+                
+                def partial_outputs():
+                    for chunk in chunks:
+                        if self.framework == "pt" and self.execution_modes_enabled:
+                            chunk = self._ensure_tensor_on_device(chunk, device=torch.device("cpu"))
+                        outputs = self._post_process_stage(chunk, postprocess_params, parent=parent)
+                        if inspect.isgenerator(outputs):
+                            yield from outputs
+                        else:
+                            yield outputs
+                
+                iterator = partial_outputs()
+                collected = [] if self._output_transport() == "shm" else None
+                while True:
+                    # every step of forward/post_process runs with the replica, the buffers and the forward context bound
+                    with self._stream_step(index, buffers), self._forward_context():
+                        try:
+                            output = next(iterator)
+                        except StopIteration:
+                            break
+                    if first:
+                        FIRST_OUTPUT_SECONDS.observe(time.perf_counter() - start)
+                        first = False
+                    STREAM_CHUNKS.inc()
+                    if collected is not None:
+                        collected.append(output)
+                    yield output
+                
+                with self._stream_step(index, buffers):
+                    self._finish_outputs(collected)
+        finally:
+            self.buffer_arena.release_all(buffers)
+            if len(self.replicas) > 1:
+                self._release_replica(index)
+    
+    @contextmanager
+    def _stream_step(self, index, buffers):
+        with self._bound_replica(index), self.buffer_arena.tracking(buffers):
+            yield
+    
+    @contextmanager
+    def _run_scope(self):
+        """
+            metrics and the pipeline.run span of one call of run() or run_stream()
+        """
+        status = "error"
+        start = time.perf_counter()
+        RUN_IN_FLIGHT.inc()
+        try:
+            with tracing.start_span("pipeline.run") as span:
+                yield span
+            status = "ok"
+        except DeadlineExceeded:
+            status = "expired"
+            raise
+        except GeneratorExit:
+            status = "closed"
+            raise
+        finally:
+            RUN_IN_FLIGHT.dec()
+            RUN_TOTAL.labels(status=status).inc()
+            RUN_SECONDS.observe(time.perf_counter() - start)
+    
+    def _preprocess_stage(self, inputs, preprocess_params, deadline, parent=None):
+        self._check_deadline(deadline)
+        with STAGE_SECONDS.labels(stage="preprocess").time(), tracing.start_span("pipeline.preprocess", parent=parent):
+            model_inputs = self.preprocess(inputs, **preprocess_params)
+        self._check_deadline(deadline)
+        return model_inputs
+    
+    def _forward_stage(self, model_inputs, forward_params, parent=None):
+        with STAGE_SECONDS.labels(stage="forward").time(), tracing.start_span("pipeline.forward", parent=parent):
+            return self._call_forward(model_inputs, forward_params)
+    
+    def _post_process_stage(self, model_outputs, postprocess_params, parent=None):
+        with STAGE_SECONDS.labels(stage="post_process").time(), tracing.start_span("pipeline.post_process", parent=parent):
+            return self.post_process(model_outputs, **postprocess_params)
+    
+    def _output_transport(self):
+        return self.kwargs.get("output_transport", "files") if self.kwargs.get("output_dir", None) else "files"
+    
+    def _finish_outputs(self, model_outputs):
+        """
+            waits for the output writer, unless output_flush="none", and writes the outputs as a shared payload with output_transport="shm"
+        """
+        if self.kwargs.get("output_flush", "run") != "none":
+            self.flush_outputs()
+        if self._output_transport() == "shm":
+            write_payload(self.kwargs["output_dir"], model_outputs)
+    
+    @staticmethod
+    def _check_deadline(deadline):
+        if deadline is not None and time.monotonic() > deadline:
+            raise DeadlineExceeded(f"the deadline passed {time.monotonic() - deadline:.3f}s ago")
 
 
 
@@ -0,0 +1,272 @@
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+import threading
+import gc
+import os
+from .utils.auxiliary import is_torch_available
+from .utils.logging import get_logger
+
+
+if is_torch_available():
+    import torch
+
+
+logger = get_logger(__name__)
+
+
+def _nbytes(array):
+    try:
+        return int(array.nbytes)
+    except Exception:
+        return 0
+
+
+def _device_key(framework, device):
+    if framework == "pt":
+        return str(device)
+    elif framework in ["tf", "onnx"]:
+        return "cpu" if device == -1 else f"gpu:{device}"
+    return "cpu"
+
+
+def _replica_memory(model, framework, device):
+    """
+        (host_bytes, {device key: bytes}) of the weights of one replica
+    """
+    # a CompiledModel shares the weights of its eager model
+    model = getattr(model, "_eager", model)
+    host, devices = 0, {}
+    key = _device_key(framework, device)
+    if framework == "pt" and isinstance(model, torch.nn.Module):
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            size = tensor.numel() * tensor.element_size()
+            if tensor.device.type == "cpu":
+                host += size
+            else:
+                devices[str(tensor.device)] = devices.get(str(tensor.device), 0) + size
+    elif framework in ["tf", "onnx"]:
+        if framework == "tf" and hasattr(model, "variables"):
+            # from the shape and dtype, reading the values would copy every gpu variable to the host
+            size = sum(int(v.shape.num_elements()) * v.dtype.size for v in model.variables)
+        elif framework == "onnx" and hasattr(model, "path"):
+            # the weights of the session are roughly the size of the file it loaded, the quantized one if quantized
+            size = os.path.getsize(model.path)
+        else:
+            size = 0
+        if key == "cpu":
+            host += size
+        elif size:
+            devices[key] = size
+    else:
+        # sklearn and other models, sum up the numpy arrays held by the estimator
+        for value in getattr(model, "__dict__", {}).values():
+            host += _nbytes(value)
+    return host, devices
+
+
+def estimate_model_memory(pipeline):
+    """
+     Estimate the memory used by the weights of a loaded AbstractModel, summed over its replicas
+     
+     Args:
+     	 pipeline: an AbstractModel instance
+     
+     Returns: 
+     	 tuple of (host_bytes, {device key: bytes}), the device keys are the keys of ModelPool.device_memory_budget
+    """
+    replicas = getattr(pipeline, "replicas", [pipeline.model])
+    devices = getattr(pipeline, "devices", [pipeline.device] * len(replicas))
+    host, device_bytes = 0, {}
+    seen = set()
+    for model, device in zip(replicas, devices):
+        # replicas on the same device share the same model
+        if id(model) in seen:
+            continue
+        seen.add(id(model))
+        replica_host, replica_devices = _replica_memory(model, pipeline.framework, device)
+        host += replica_host
+        for key, size in replica_devices.items():
+            device_bytes[key] = device_bytes.get(key, 0) + size
+    return host, device_bytes
+
+
+class _Entry:
+    def __init__(self, factory):
+        self.factory = factory
+        self.pipeline = None
+        self.host_bytes = 0
+        # {device key: bytes}
+        self.device_bytes = {}
+        self.lock = threading.Lock()
+
+
+class ModelPool:
+    """
+        Keeps several AbstractModel instances resident in one process and evicts the least recently used
+        ones when the memory budgets are exceeded. Evicted models are reloaded lazily on the next `get`
+
+        Parameters:
+            host_memory_budget: int, maximum bytes of weights kept in host memory, None means no limit
+            device_memory_budget: dict, {"cuda:0": bytes, ...} maximum bytes of weights kept on each device
+                the keys are str(device) for pytorch and "gpu:{index}" for tensorflow and onnx,
+                the replicas of a model on several devices count on each of them
+
+        Example Usage:
+            pool = ModelPool(host_memory_budget=8*1024**3, device_memory_budget={"cuda:0": 20*1024**3})
+            pool.register("author/repo", lambda: Pipeline(load_model(configs), 0, "pt", **configs))
+            pipeline = pool.get("author/repo")
+            outputs = pipeline.run(inputs, preprocess_params, forward_params, postprocess_params)
+    """
+
+    def __init__(self, host_memory_budget: Optional[int] = None, device_memory_budget: Optional[Dict[str, int]] = None) -> None:
+        self.host_memory_budget = host_memory_budget
+        self.device_memory_budget = device_memory_budget or {}
+        self._entries: Dict[str, _Entry] = {}
+        # resident models, the last one is the most recently used
+        self._resident: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    def register(self, name: str, factory: Callable[[], Any]) -> None:
+        """
+            name: the name used to fetch the model, usually the repo name
+            factory: callable with no argument that returns a loaded AbstractModel instance
+        """
+        with self._lock:
+            evicted = self._evict(name)
+            self._entries[name] = _Entry(factory)
+        if evicted:
+            self._release_memory()
+
+    def unregister(self, name: str) -> None:
+        with self._lock:
+            evicted = self._evict(name)
+            self._entries.pop(name, None)
+        if evicted:
+            self._release_memory()
+
+    def get(self, name: str):
+        """
+            Return the model registered with the given name, loading it if it is not resident
+            concurrent calls for the same model share one load
+            NOTE: the returned model stays usable even if it is evicted meanwhile, it is freed once its last user drops it
+        """
+        while True:
+            with self._lock:
+                if name not in self._entries:
+                    raise RuntimeError(f"Model {name} is not registered in the pool")
+                entry = self._entries[name]
+                pipeline = entry.pipeline
+                if pipeline is not None:
+                    self._resident.move_to_end(name)
+                    return pipeline
+
+            evicted = []
+            with entry.lock:
+                with self._lock:
+                    pipeline = entry.pipeline
+                if pipeline is None:
+                    logger.info(f"Loading model {name}")
+                    pipeline = entry.factory()
+                    host, devices = estimate_model_memory(pipeline)
+                    with self._lock:
+                        if self._entries.get(name, None) is entry:
+                            entry.pipeline = pipeline
+                            entry.host_bytes = host
+                            entry.device_bytes = devices
+                            self._resident[name] = entry
+                            evicted = self._evict_over_budget(keep=name)
+            if evicted:
+                self._release_memory()
+            if pipeline is not None:
+                return pipeline
+
+    def evict(self, name: str) -> None:
+        """
+            Unload the model, it will be reloaded on the next `get`
+        """
+        with self._lock:
+            evicted = self._evict(name)
+        if evicted:
+            self._release_memory()
+
+    def _evict(self, name):
+        """
+            drops the model from the pool, the caller holds the lock and calls _release_memory after releasing it
+        """
+        entry = self._resident.pop(name, None)
+        if entry is None:
+            return False
+        logger.info(f"Evicting model {name}")
+        entry.pipeline = None
+        entry.host_bytes = 0
+        entry.device_bytes = {}
+        return True
+
+    @staticmethod
+    def _release_memory():
+        # outside of the pool lock, a full collection can take a while
+        gc.collect()
+        if is_torch_available() and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def resident(self):
+        """
+            Return the names of resident models, from the least to the most recently used
+        """
+        with self._lock:
+            return list(self._resident.keys())
+
+    def memory_usage(self):
+        """
+            Return the estimated memory of the resident models:
+                {"host": bytes, "devices": {"cuda:0": bytes, ...}}
+        """
+        with self._lock:
+            host = sum(entry.host_bytes for entry in self._resident.values())
+            devices = {}
+            for entry in self._resident.values():
+                for device, size in entry.device_bytes.items():
+                    devices[device] = devices.get(device, 0) + size
+            return {"host": host, "devices": devices}
+
+    def _over_budget(self):
+        """
+            the budgets which are exceeded, "host" and/or device keys
+        """
+        usage = self.memory_usage()
+        over = []
+        if self.host_memory_budget is not None and usage["host"] > self.host_memory_budget:
+            over.append("host")
+        for device, budget in self.device_memory_budget.items():
+            if usage["devices"].get(device, 0) > budget:
+                over.append(device)
+        return over
+
+    def _evict_over_budget(self, keep):
+        """
+            evicts the least recently used models which use the memory over budget, returns their names
+        """
+        evicted = []
+        while True:
+            over = self._over_budget()
+            if not over:
+                return evicted
+            for budget in over:
+                # only the models which use the memory of this budget, from the least recently used
+                candidates = [
+                    name for name, entry in self._resident.items()
+                    if name != keep and (entry.host_bytes if budget == "host" else entry.device_bytes.get(budget, 0))
+                ]
+                if candidates:
+                    self._evict(candidates[0])
+                    evicted.append(candidates[0])
+                    break
+            else:
+                logger.warning(f"Model {keep} alone exceeds the memory budget of {over}")
+                return evicted
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,308 @@
+"""
+Batched preprocessing primitives that write into preallocated, reusable buffers
+
+    arena = BufferArena()
+    with arena.scope():
+        batch = batch_images(inputs["image"], size=(224, 224), mean=MEAN, std=STD, arena=arena)
+        tensor = to_tensor(batch, device)
+
+Inside AbstractModel, use self.buffer_arena, run() opens a scope for every call,
+so the buffers of a call are recycled by the next one
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+import threading
+from .utils.auxiliary import is_numpy_available, is_torch_available
+
+
+if is_numpy_available():
+    import numpy as np
+
+if is_torch_available():
+    import torch
+
+
+class BufferArena:
+    """
+        Pool of numpy buffers keyed by (shape, dtype, pinned), acquired buffers are given back
+        with release() or at the end of the enclosing scope()
+
+        Parameters:
+            max_bytes: maximum bytes of free buffers kept for reuse, the rest is left to the garbage collector
+    """
+
+    def __init__(self, max_bytes=1024**3) -> None:
+        self.max_bytes = max_bytes
+        self._free = defaultdict(list)
+        self._free_bytes = 0
+        # pinned buffers are numpy views of pinned torch tensors, the tensor must stay alive with the array
+        self._owners = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def acquire(self, shape, dtype="float32", pinned=False, track=True):
+        """
+            returns an uninitialized array of the given shape and dtype, reused if a free one exists
+            pinned: allocate in page-locked memory (needs torch and cuda) for faster, asynchronous copies to the gpu
+            track: if False, the buffer is not released by the enclosing scope, release() it yourself
+        """
+        shape = tuple(int(s) for s in shape)
+        dtype = np.dtype(dtype)
+        pinned = pinned and is_torch_available() and torch.cuda.is_available()
+        key = (shape, dtype.str, pinned)
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                array = free.pop()
+                self._free_bytes -= array.nbytes
+            else:
+                array = None
+        
+        if array is None:
+            if pinned:
+                tensor = torch.empty(shape, dtype=torch.from_numpy(np.empty(0, dtype=dtype)).dtype, pin_memory=True)
+                array = tensor.numpy()
+                self._owners[id(array)] = tensor
+            else:
+                array = np.empty(shape, dtype=dtype)
+        
+        scopes = getattr(self._local, "scopes", None)
+        if track and scopes:
+            scopes[-1].append((key, array))
+        return array
+
+    def release(self, array, _key=None):
+        key = _key or (array.shape, array.dtype.str, id(array) in self._owners)
+        with self._lock:
+            if self._free_bytes + array.nbytes > self.max_bytes:
+                self._owners.pop(id(array), None)
+                return
+            self._free[key].append(array)
+            self._free_bytes += array.nbytes
+
+    @contextmanager
+    def scope(self):
+        """
+            buffers acquired inside the scope (by this thread) are released when it ends
+            NOTE: do not keep references to these buffers after the scope
+        """
+        buffers = []
+        try:
+            with self.tracking(buffers):
+                yield self
+        finally:
+            self.release_all(buffers)
+
+    @contextmanager
+    def tracking(self, buffers):
+        """
+            buffers acquired inside the block (by this thread) are added to the list `buffers`, release them with release_all,
+            a scope spanning several threads (e.g. the steps of a generator) tracks the same list in each step
+        """
+        if getattr(self._local, "scopes", None) is None:
+            self._local.scopes = []
+        self._local.scopes.append(buffers)
+        try:
+            yield self
+        finally:
+            self._local.scopes.pop()
+
+    def release_all(self, buffers):
+        for key, array in buffers:
+            self.release(array, _key=key)
+        buffers.clear()
+
+    def clear(self):
+        with self._lock:
+            self._free.clear()
+            self._owners.clear()
+            self._free_bytes = 0
+
+
+def _output(shape, dtype, out, arena, pinned=False):
+    if out is not None:
+        if tuple(out.shape) != tuple(shape):
+            raise RuntimeError(f"out has shape {tuple(out.shape)}, expected {tuple(shape)}")
+        return out
+    if arena is not None:
+        return arena.acquire(shape, dtype, pinned=pinned)
+    return np.empty(shape, dtype=dtype)
+
+
+def stack_into(arrays, out=None, arena=None, dtype=None, pinned=False):
+    """
+        stacks same-shape arrays into one (preallocated) batch without intermediate copies
+    """
+    if len(arrays)==0:
+        raise RuntimeError("Nothing to stack")
+    first = np.asarray(arrays[0])
+    batch = _output((len(arrays),) + first.shape, dtype or first.dtype, out, arena, pinned)
+    for i, array in enumerate(arrays):
+        batch[i] = array
+    return batch
+
+
+def pad_sequences(sequences, max_length=None, pad_value=0, dtype="int64", out=None, arena=None, pinned=False):
+    """
+     Pads a list of 1D sequences (e.g. token ids) into one (batch, max_length) array
+     
+     Returns: 
+     	 tuple of (batch, lengths), lengths is an int64 array of the original lengths
+    """
+    lengths = np.fromiter((len(s) for s in sequences), dtype=np.int64, count=len(sequences))
+    max_length = int(max_length or (lengths.max() if len(lengths) else 0))
+    batch = _output((len(sequences), max_length), dtype, out, arena, pinned)
+    batch.fill(pad_value)
+    for i, sequence in enumerate(sequences):
+        n = min(len(sequence), max_length)
+        batch[i, :n] = sequence[:n]
+    return batch, np.minimum(lengths, max_length)
+
+
+def batch_images(images, size=None, mean=None, std=None, scale=1/255, layout="NCHW", dtype="float32", out=None, arena=None, pinned=False, interpolation=None):
+    """
+     Resize, normalize and convert a list of HWC images (e.g. auto_file_loader images) into one batch
+     each image is resized straight into a reusable uint8 staging buffer, then one vectorized pass
+     does the dtype conversion, normalization and layout change into the output buffer
+     
+     Args:
+     	 images: list of HWC uint8 numpy arrays, RGB like auto_file_loader returns them
+     	 size: (height, width) of the batch, None requires all images to have the same size
+     	 mean, std: per channel values applied after scaling, e.g. imagenet (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)
+     	 scale: multiplier applied first, 1/255 maps uint8 to [0, 1]
+     	 layout: "NCHW" or "NHWC"
+     	 dtype: dtype of the batch
+     	 out: a preallocated output of the right shape
+     	 arena: BufferArena used for the staging and output buffers
+     	 pinned: allocate the output in pinned memory, see BufferArena.acquire
+     	 interpolation: cv2 interpolation flag, default cv2.INTER_LINEAR
+     
+     Returns: 
+     	 the batch as a numpy array
+    """
+    if len(images)==0:
+        raise RuntimeError("No images given")
+    if layout not in ["NCHW", "NHWC"]:
+        raise RuntimeError(f"layout must be NCHW or NHWC, got {layout}")
+    
+    first = images[0]
+    channels = first.shape[2] if first.ndim == 3 else 1
+    height, width = size if size is not None else first.shape[:2]
+    n = len(images)
+
+    if arena is not None:
+        staging = arena.acquire((n, height, width, channels), first.dtype, track=False)
+    else:
+        staging = np.empty((n, height, width, channels), first.dtype)
+    for i, image in enumerate(images):
+        if image.ndim == 2:
+            image = image[:, :, None]
+        if image.shape[:2] == (height, width):
+            staging[i] = image
+        else:
+            import cv2
+            resized = cv2.resize(image, (width, height), interpolation=cv2.INTER_LINEAR if interpolation is None else interpolation)
+            staging[i] = resized.reshape(height, width, channels)
+    
+    if layout == "NCHW":
+        shape = (n, channels, height, width)
+        source = staging.transpose(0, 3, 1, 2)
+        channel_shape = (1, channels, 1, 1)
+    else:
+        shape = (n, height, width, channels)
+        source = staging
+        channel_shape = (1, 1, 1, channels)
+    
+    batch = _output(shape, dtype, out, arena, pinned)
+    # one pass for the conversion and the layout change, the rest is in place
+    np.multiply(source, scale, out=batch, casting="unsafe")
+    if mean is not None:
+        np.subtract(batch, np.asarray(mean, dtype=batch.dtype).reshape(channel_shape), out=batch)
+    if std is not None:
+        np.multiply(batch, (1 / np.asarray(std, dtype=batch.dtype)).reshape(channel_shape), out=batch)
+    
+    if arena is not None:
+        arena.release(staging)
+    return batch
+
+
+def to_tensor(array, device=None, non_blocking=True):
+    """
+        wraps the array as a torch tensor without a copy and moves it to the device
+        non_blocking copies are asynchronous when the array is in pinned memory
+    """
+    tensor = torch.from_numpy(array)
+    if device is not None:
+        tensor = tensor.to(device, non_blocking=non_blocking)
+    return tensor
+
+
+def pad_images(images, size, pad_value=0, out=None, arena=None, pinned=False):
+    """
+        places HWC images at the top left of a (n, height, width, channels) batch filled with pad_value, no resizing
+        size: (height, width), must be at least as large as every image
+    """
+    first = images[0]
+    channels = first.shape[2] if first.ndim == 3 else 1
+    height, width = size
+    batch = _output((len(images), height, width, channels), first.dtype, out, arena, pinned)
+    batch.fill(pad_value)
+    for i, image in enumerate(images):
+        h, w = image.shape[:2]
+        if h > height or w > width:
+            raise RuntimeError(f"Image of size {(h, w)} does not fit in {size}")
+        batch[i, :h, :w] = image.reshape(h, w, channels)
+    return batch
+
+
+def _fits(size, boundary):
+    if isinstance(boundary, (tuple, list)):
+        return all(s <= b for s, b in zip(size, boundary))
+    return size <= boundary
+
+
+def default_size(item):
+    """
+        size of an input for bucketing: (height, width) for arrays with 2 or more dimensions, len() otherwise
+    """
+    shape = getattr(item, "shape", None)
+    if shape is not None and len(shape) >= 2:
+        return tuple(int(s) for s in shape[:2])
+    return len(item)
+
+
+def bucket_indices(items, boundaries, size_fn=default_size):
+    """
+     Group items into buckets, each item goes to the smallest boundary it fits in
+     
+     Args:
+     	 items: list of inputs, e.g. strings, token lists or images
+     	 boundaries: sorted bucket sizes, ints (lengths) or (height, width) tuples (resolutions)
+     	 size_fn: callable(item) -> int or (height, width), default uses len() or the image shape
+     
+     Returns: 
+     	 list of (boundary, [indices]) in the order of boundaries, items larger than every boundary
+     	 are grouped in a last bucket whose boundary is their maximum size
+    """
+    boundaries = [tuple(b) if isinstance(b, (tuple, list)) else b for b in boundaries]
+    groups = {b: [] for b in boundaries}
+    overflow = []
+    for index, item in enumerate(items):
+        size = size_fn(item)
+        for boundary in boundaries:
+            if _fits(size, boundary):
+                groups[boundary].append(index)
+                break
+        else:
+            overflow.append((index, size))
+    
+    buckets = [(b, indices) for b, indices in groups.items() if indices]
+    if overflow:
+        sizes = [size for _, size in overflow]
+        if isinstance(sizes[0], tuple):
+            largest = tuple(max(dims) for dims in zip(*sizes))
+        else:
+            largest = max(sizes)
+        buckets.append((largest, [index for index, _ in overflow]))
+    return buckets
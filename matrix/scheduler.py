@@ -0,0 +1,182 @@
+from concurrent.futures import Future
+import heapq
+import itertools
+import threading
+import time
+from .utils.errors import DeadlineExceeded, RequestRejected
+from .utils.logging import get_logger
+from .utils import metrics
+
+
+logger = get_logger(__name__)
+
+# priority classes, lower runs first
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+SCHEDULER_REQUESTS = metrics.counter("matrix_scheduler_requests", "Requests handled by the Scheduler", ["status", "priority"])
+QUEUE_DEPTH = metrics.gauge("matrix_scheduler_queue_depth", "Requests waiting in the Scheduler queue")
+QUEUE_SECONDS = metrics.histogram("matrix_scheduler_queue_seconds", "Time a request waited in the Scheduler queue", ["priority"])
+
+
+class _Request:
+    def __init__(self, args, priority, deadline):
+        self.args = args
+        self.priority = priority
+        self.deadline = deadline
+        self.future = Future()
+        self.enqueued = time.monotonic()
+
+
+class Scheduler:
+    """
+        Admission control in front of AbstractModel.run: a bounded priority queue served by a fixed number of workers
+
+        - requests of a higher priority class run first, inside a class the earliest deadline runs first
+        - when the queue is full, a new request replaces the queued request of the lowest priority and latest deadline
+            if that one has a lower priority class, otherwise it is rejected at once with RequestRejected (load shedding)
+        - requests whose deadline passed while queued are dropped with DeadlineExceeded, run() checks the deadline
+            again after preprocess, so forward is never spent on an expired request
+        - served, rejected, expired and failed requests are counted in matrix_scheduler_requests
+
+        Parameters:
+            pipeline: a loaded AbstractModel instance
+            workers: number of requests run concurrently, default is the number of replicas of the pipeline
+            max_queue: number of requests waiting at most
+            default_timeout: seconds from submission to the deadline of requests submitted without one, None is no deadline
+
+        Example Usage:
+            scheduler = Scheduler(pipeline, max_queue=32, default_timeout=2.0)
+            future = scheduler.submit(inputs, preprocess_params, forward_params, postprocess_params, priority="high")
+            outputs = future.result()
+    """
+
+    def __init__(self, pipeline, workers=None, max_queue=64, default_timeout=None) -> None:
+        self.pipeline = pipeline
+        self.workers = workers or len(getattr(pipeline, "replicas", [None]))
+        self.max_queue = max_queue
+        self.default_timeout = default_timeout
+
+        self._queue = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._threads = [
+            threading.Thread(target=self._work, name=f"matrix-scheduler-{i}", daemon=True) for i in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @staticmethod
+    def _priority(priority):
+        if isinstance(priority, str):
+            if priority not in PRIORITIES:
+                raise RuntimeError(f"priority must be one of {list(PRIORITIES)} or an int, got {priority}")
+            return priority, PRIORITIES[priority]
+        return str(priority), int(priority)
+
+    def _finish(self, request, status, result=None, error=None):
+        if request.future.done():
+            # cancelled by the caller
+            return
+        SCHEDULER_REQUESTS.labels(status=status, priority=request.priority[0]).inc()
+        if error is not None:
+            request.future.set_exception(error)
+        else:
+            request.future.set_result(result)
+
+    def submit(self, inputs, preprocess_params, forward_params, postprocess_params, priority="normal", deadline=None, timeout=None):
+        """
+            Queue a request, same arguments as AbstractModel.run
+
+            Args:
+                priority: "high", "normal", "low" or an int, lower runs first
+                deadline: time.monotonic() after which the result is useless
+                timeout: seconds from now to the deadline, used if deadline is not given
+
+            Returns:
+                a future, future.result() returns the output of run() or raises DeadlineExceeded/RequestRejected
+        """
+        priority = self._priority(priority)
+        timeout = timeout if timeout is not None else self.default_timeout
+        if deadline is None and timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        request = _Request((inputs, preprocess_params, forward_params, postprocess_params), priority, deadline)
+        key = (priority[1], deadline if deadline is not None else float("inf"), next(self._order))
+        shed = None
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The scheduler is shut down")
+            if len(self._queue) >= self.max_queue:
+                # the least important queued request, the lowest priority and the latest deadline
+                victim = max(self._queue)
+                if victim[0] <= key[0]:
+                    self._finish(request, "rejected", error=RequestRejected(f"the queue is full ({self.max_queue} requests)"))
+                    return request.future
+                self._queue.remove(victim)
+                heapq.heapify(self._queue)
+                shed = victim[-1]
+            heapq.heappush(self._queue, (*key, request))
+            QUEUE_DEPTH.set(len(self._queue))
+            self._condition.notify()
+
+        # a shed future is moved to running first, the caller can not cancel it any more while the error is set
+        if shed is not None and shed.future.set_running_or_notify_cancel():
+            self._finish(shed, "rejected", error=RequestRejected("shed for a request of a higher priority"))
+        return request.future
+
+    def run(self, inputs, preprocess_params, forward_params, postprocess_params, priority="normal", deadline=None, timeout=None):
+        return self.submit(inputs, preprocess_params, forward_params, postprocess_params, priority, deadline, timeout).result()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                request = heapq.heappop(self._queue)[-1]
+                QUEUE_DEPTH.set(len(self._queue))
+
+            QUEUE_SECONDS.labels(priority=request.priority[0]).observe(time.monotonic() - request.enqueued)
+            if not request.future.set_running_or_notify_cancel():
+                continue
+            if request.deadline is not None and time.monotonic() > request.deadline:
+                self._finish(request, "expired", error=DeadlineExceeded("the deadline passed while the request was queued"))
+                continue
+            try:
+                result = self.pipeline.run(*request.args, deadline=request.deadline)
+            except DeadlineExceeded as e:
+                self._finish(request, "expired", error=e)
+            except Exception as e:
+                self._finish(request, "failed", error=e)
+            else:
+                self._finish(request, "served", result=result)
+
+    def queue_depth(self):
+        with self._condition:
+            return len(self._queue)
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        """
+            stops the workers after the queued requests, or cancels the queued requests if cancel_pending
+        """
+        with self._condition:
+            self._closed = True
+            pending = []
+            if cancel_pending:
+                pending = [item[-1] for item in self._queue]
+                self._queue = []
+                QUEUE_DEPTH.set(0)
+            self._condition.notify_all()
+        for request in pending:
+            request.future.cancel()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
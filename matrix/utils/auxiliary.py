@@ -33,6 +33,20 @@ def _is_package_available(pkg_name: str, return_version: bool = False) -> Union[
 
 _torch_available, _torch_version = _is_package_available("torch", return_version=True)
 
+_numpy_available = _is_package_available("numpy")
+
+# onnxruntime is distributed as onnxruntime, onnxruntime-gpu, onnxruntime-openvino, ...
+_onnxruntime_available = importlib.util.find_spec("onnxruntime") is not None
+if _onnxruntime_available:
+    _onnxruntime_available = False
+    for pkg in ("onnxruntime", "onnxruntime-gpu", "onnxruntime-openvino", "onnxruntime-directml", "ort-nightly"):
+        try:
+            importlib_metadata.version(pkg)
+            _onnxruntime_available = True
+            break
+        except importlib_metadata.PackageNotFoundError:
+            pass
+
 _tf_available = importlib.util.find_spec("tensorflow") is not None
 if _tf_available:
     candidates = (
@@ -71,3 +85,9 @@ def is_torch_available():
 
 def is_sklearn_available():
     return _sklearn_available
+
+def is_numpy_available():
+    return _numpy_available
+
+def is_onnxruntime_available():
+    return _onnxruntime_available
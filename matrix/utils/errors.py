@@ -17,6 +17,33 @@ class PipelineException(Exception):
         self.task = task
         self.model = model
 
+class RequestRejected(RuntimeError):
+    """
+    Raised by the Scheduler when its queue is full, the request is refused without waiting (load shedding).
+    """
+
+
+class DeadlineExceeded(RuntimeError):
+    """
+    Raised when the deadline of a request passed before its forward pass started.
+    """
+
+
+class HTTPError(RuntimeError):
+    """
+    Raised by the client when the matrix server answers with an error status.
+
+    Args:
+        message (`str`): The error message to display.
+        status_code (`int`): The HTTP status code of the answer.
+    """
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+
+        self.status_code = status_code
+
+
 def write_error(cwd, err):
     path = os.path.join(cwd, "error")
     os.makedirs(path, exist_ok=True)
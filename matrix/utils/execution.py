@@ -0,0 +1,193 @@
+"""
+Execution modes of AbstractModel: autocast, compiled models and channels-last memory format
+"""
+
+from contextlib import nullcontext
+import sys
+from .auxiliary import is_numpy_available, is_tf_available, is_torch_available
+from .logging import get_logger
+
+
+if is_numpy_available():
+    import numpy as np
+
+if is_tf_available():
+    import tensorflow as tf
+
+if is_torch_available():
+    import torch
+
+
+logger = get_logger(__name__)
+
+PRECISIONS = ["fp32", "fp16", "bf16"]
+COMPILE_MODES = {
+    "pt": ["torch_compile", "torchscript"],
+    "tf": ["tf_function", "xla"],
+}
+
+
+def is_compile_error(mode, error):
+    """
+        True if the error comes from compiling or tracing the model (e.g. torch.compile compiles lazily on the first call),
+        not from running it on the inputs
+    """
+    if mode == "torch_compile":
+        # torch._dynamo is imported by torch.compile, BackendCompilerFailed, Unsupported, ... derive from TorchDynamoException
+        dynamo_exc = sys.modules.get("torch._dynamo.exc", None)
+        return dynamo_exc is not None and isinstance(error, dynamo_exc.TorchDynamoException)
+    elif mode in ["tf_function", "xla"] and is_tf_available():
+        if isinstance(error, tf.errors.UnimplementedError):
+            return True
+        # ops which XLA can not compile are reported as InvalidArgumentError
+        return mode == "xla" and isinstance(error, tf.errors.InvalidArgumentError) and "compil" in str(error).lower()
+    return False
+
+
+class CompiledModel:
+    """
+        Wraps a compiled model and falls back to the eager model if compiling fails,
+        e.g. torch.compile compiles lazily on the first call and may fail there.
+        Errors of the model itself (e.g. bad inputs) are raised as they are.
+        Any other attribute is read from the eager model
+    """
+
+    def __init__(self, compiled, eager, mode) -> None:
+        self.__dict__["_compiled"] = compiled
+        self.__dict__["_eager"] = eager
+        self.__dict__["_mode"] = mode
+
+    @property
+    def is_compiled(self):
+        return self._compiled is not None
+
+    def __call__(self, *args, **kwargs):
+        if self._compiled is not None:
+            try:
+                return self._compiled(*args, **kwargs)
+            except Exception as e:
+                if not is_compile_error(self._mode, e):
+                    raise
+                logger.warning(f"Compiled model ({self._mode}) failed, falling back to the eager model: {e}")
+                self.__dict__["_compiled"] = None
+        return self._eager(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._eager, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._eager, name, value)
+
+
+def get_autocast_dtype(precision):
+    if precision is None or precision == "fp32":
+        return None
+    if precision not in PRECISIONS:
+        raise RuntimeError(f"precision must be one of {PRECISIONS}, got {precision}")
+    return torch.float16 if precision == "fp16" else torch.bfloat16
+
+
+def autocast_context(framework, device, precision):
+    """
+        autocast context for the forward pass, a no-op context for fp32 or frameworks other than pytorch
+    """
+    if framework != "pt" or precision in [None, "fp32"]:
+        return nullcontext()
+    return torch.autocast(device_type=device.type, dtype=get_autocast_dtype(precision))
+
+
+def make_example_inputs(framework, device, example_inputs=None, example_input_shape=None):
+    """
+        returns the example inputs used for tracing and warm up, or None if nothing is given
+        example_input_shape creates a random float tensor of the given shape
+    """
+    if example_inputs is not None:
+        return example_inputs
+    if example_input_shape is None:
+        return None
+    shape = [int(s) for s in example_input_shape]
+    if framework == "pt":
+        return torch.randn(*shape, device=device)
+    elif framework == "tf":
+        return tf.random.normal(shape)
+    elif framework == "onnx":
+        return np.random.standard_normal(shape).astype(np.float32)
+    return None
+
+
+def _call_model(model, example_inputs):
+    if isinstance(example_inputs, dict):
+        return model(**example_inputs)
+    elif isinstance(example_inputs, tuple):
+        return model(*example_inputs)
+    return model(example_inputs)
+
+
+def apply_execution_modes(model, framework, device, precision=None, compile_mode=None, channels_last=False, example_inputs=None):
+    """
+     Apply the execution modes to a loaded model and warm it up on the example inputs
+     any failure falls back to the eager model with a warning
+     
+     Args:
+     	 model: the loaded model
+     	 framework: "pt" or "tf", other frameworks are returned as they are
+     	 device: the device of the model
+     	 precision: "fp32", "fp16" or "bf16", used for autocast in the warm up
+     	 compile_mode: pt-> "torch_compile" or "torchscript", tf-> "tf_function" or "xla"
+     	 channels_last: if True, pytorch model is converted to channels-last memory format
+     	 example_inputs: inputs for tracing and warm up, torchscript needs them
+     
+     Returns: 
+     	 the model, or a CompiledModel wrapping it
+    """
+    if framework not in COMPILE_MODES:
+        return model
+    
+    if compile_mode is not None and compile_mode not in COMPILE_MODES[framework]:
+        raise RuntimeError(f"compile_mode for `{framework}` must be one of {COMPILE_MODES[framework]}, got {compile_mode}")
+    
+    if framework == "pt" and channels_last:
+        try:
+            model = model.to(memory_format=torch.channels_last)
+        except Exception as e:
+            logger.warning(f"Could not convert the model to channels-last: {e}")
+    
+    compiled = None
+    try:
+        if compile_mode == "torch_compile":
+            if not hasattr(torch, "compile"):
+                raise RuntimeError("torch.compile needs torch>=2.0")
+            compiled = torch.compile(model)
+        elif compile_mode == "torchscript":
+            if example_inputs is None:
+                raise RuntimeError("torchscript tracing needs example_inputs or example_input_shape")
+            with torch.inference_mode(False), torch.no_grad(), autocast_context(framework, device, precision):
+                traced = torch.jit.trace(model, example_inputs)
+            compiled = torch.jit.freeze(traced.eval())
+        elif compile_mode in ["tf_function", "xla"]:
+            compiled = tf.function(model, jit_compile=compile_mode == "xla")
+    except Exception as e:
+        logger.warning(f"Compiling the model with {compile_mode} failed, using the eager model: {e}")
+        compiled = None
+    
+    if compile_mode is not None:
+        model = CompiledModel(compiled, model, compile_mode)
+    
+    if example_inputs is not None:
+        warm_up_model(model, framework, device, precision, example_inputs)
+    
+    return model
+
+
+def warm_up_model(model, framework, device, precision, example_inputs):
+    """
+        one forward pass on the example inputs, triggers lazy compilation, kernel selection and allocator growth
+    """
+    try:
+        if framework == "pt":
+            with torch.no_grad(), autocast_context(framework, device, precision):
+                _call_model(model, example_inputs)
+        else:
+            _call_model(model, example_inputs)
+    except Exception as e:
+        logger.warning(f"Warm up of the model failed: {e}")
@@ -1,9 +1,13 @@
 import json
-import glob
+import functools
 import mimetypes
 import os
+from . import metrics, tracing
+from .transport import FileRef, can_encode, is_payload_dir, read_payload
 
 
+FILES_LOADED = metrics.counter("matrix_loader_files", "Files loaded by auto_file_loader", ["type"])
+LOAD_SECONDS = metrics.histogram("matrix_loader_seconds", "Duration of loading one file in auto_file_loader", ["type"])
 
 SUPPORTED_TYPES = ["text", "image", "video", "audio", "json", "pdf"]
 
@@ -97,13 +101,143 @@ def audio_loader(path, sr=22050, mono=False):
     return (audio, sr)
 
 
+# type_ -> (loader, extend), the loader is called as loader(path, **options)
+# if extend is True, the loader returns a list and the items are added one by one to the result
+_LOADERS = {}
+# ".ext" -> type_, and "group/subtype" -> type_
+_EXTENSIONS = {}
+_MIMETYPES = {}
+# (offset, signature, type_), checked only when the extension does not tell us anything
+_MAGIC_BYTES = []
+_MAGIC_READ_SIZE = 16
+
+
+def register_loader(type_, loader, extensions=(), mimetypes_=(), magic=(), extend=False):
+    """
+     Register a loader for a file type, so auto_file_loader can load it without changing the SDK
+     
+     Args:
+     	 type_: name of the type, this is the key used in `types` and in the returned dict, e.g. "npz"
+     	 loader: callable, loader(path, **options) -> loaded object, options are the auto_file_loader options like pil
+     	 extensions: extensions mapped to this type, e.g. [".npz"]
+     	 mimetypes_: mimetypes mapped to this type, e.g. ["application/x-parquet"]
+     	 magic: list of (offset, bytes) signatures used to sniff files with unknown extensions
+     	 extend: if True, the loader returns a list and its items are added to the result one by one
+     
+     Example:
+        register_loader("npz", lambda path, **options: numpy.load(path), extensions=[".npz"])
+    """
+    if not callable(loader):
+        raise RuntimeError(f"loader for `{type_}` must be callable")
+    
+    _LOADERS[type_] = (loader, extend)
+    register_type(type_, extensions=extensions, mimetypes_=mimetypes_, magic=magic)
+
+
+def register_type(type_, extensions=(), mimetypes_=(), magic=()):
+    """
+     Map extensions, mimetypes and magic bytes to a type without registering a loader.
+     Files of a type without a loader are returned as paths when "generic" is requested
+    """
+    for ext in extensions:
+        ext = ext.lower()
+        if not ext.startswith("."):
+            ext = f".{ext}"
+        _EXTENSIONS[ext] = type_
+    for mtype in mimetypes_:
+        _MIMETYPES[mtype] = type_
+    for offset, signature in magic:
+        _MAGIC_BYTES.append((offset, signature, type_))
+    
+    global _MAGIC_READ_SIZE
+    _MAGIC_READ_SIZE = max([_MAGIC_READ_SIZE] + [offset + len(sig) for offset, sig, _ in _MAGIC_BYTES])
+    _type_from_extension.cache_clear()
+
+
+def _type_from_mimetype(gtype):
+    if gtype in _MIMETYPES:
+        return _MIMETYPES[gtype]
+    group_, type_ = gtype.split("/", 1)
+    if group_!="application":
+        type_ = group_
+    return type_
+
+
+@functools.lru_cache(maxsize=None)
+def _type_from_extension(ext):
+    """
+        resolve the type once per extension instead of once per file
+        returns None if the extension is unknown
+    """
+    if ext in _EXTENSIONS:
+        return _EXTENSIONS[ext]
+    gtype = mimetypes.guess_type(f"file{ext}")[0]
+    if gtype is None:
+        return None
+    return _type_from_mimetype(gtype)
+
+
+def _sniff_type(path):
+    try:
+        with open(path, "rb") as f:
+            head = f.read(_MAGIC_READ_SIZE)
+    except OSError:
+        return None
+    for offset, signature, type_ in _MAGIC_BYTES:
+        if head[offset:offset+len(signature)] == signature:
+            return type_
+    return None
+
+
+def get_file_type(path):
+    """
+     Return the type of the file the way auto_file_loader sees it, e.g. "text", "image", "pdf", "npz"
+     the extension is checked first and the magic bytes of the file are used as a fallback
+     if nothing matches, "octet-stream" is returned (like application/octet-stream)
+    """
+    ext = os.path.splitext(path)[1].lower()
+    type_ = _type_from_extension(ext)
+    if type_ is None:
+        type_ = _sniff_type(path)
+    if type_ is None:
+        type_ = "octet-stream"
+    return type_
+
+
+def _list_files(path):
+    # same files as glob(path/*), non hidden entries, but without building a pattern matcher per directory
+    with os.scandir(path) as it:
+        return [entry.path for entry in it if not entry.name.startswith(".") and entry.is_file()]
+
+
+register_loader("text", lambda path, **options: text_loader(path, split_lines=False), extend=True)
+register_loader("image", lambda path, pil=False, **options: image_loader(path, pil=pil))
+register_loader("video", lambda path, **options: video_loader(path, iterator=False))
+register_loader("audio", lambda path, **options: audio_loader(path, sr=22050, mono=False))
+register_loader("json", lambda path, **options: json_loader(path))
+# pdf files are returned as paths, since you need to load them in your special format
+register_loader("pdf", lambda path, **options: path, magic=[(0, b"%PDF-")])
+
+register_type("image", magic=[(0, b"\x89PNG\r\n\x1a\n"), (0, b"\xff\xd8\xff"), (0, b"GIF87a"), (0, b"GIF89a"), (0, b"BM")])
+register_type("audio", magic=[(8, b"WAVE"), (0, b"ID3"), (0, b"fLaC"), (0, b"OggS")])
+register_type("video", magic=[(4, b"ftyp"), (0, b"\x1aE\xdf\xa3"), (8, b"AVI ")])
+register_type("npy", extensions=[".npy"], magic=[(0, b"\x93NUMPY")])
+# npz files are zip files, so they can only be recognized by their extension
+register_type("npz", extensions=[".npz"])
+register_type("parquet", extensions=[".parquet"], magic=[(0, b"PAR1")])
+register_type("safetensors", extensions=[".safetensors"])
+
+
 def auto_file_loader(path, types, pil=False):
     """
         path: directory to load files from
         types: types of files we want to load, options: ["text", "image", "video", "audio", "json", "pdf", "generic"]
+                or any type added with register_loader
         pil: if True -> the loader will load the images in PIL format
-        split_lines: if True, splits the lines for the text files else it will return each file as a full sentence
         NOTE: if the file type is generic or pdf, the path to the file will be returned, since you need to load them in your special format
+        NOTE: files with an unknown extension are recognized by their magic bytes, if this fails, they are of type "octet-stream"
+        NOTE: if path is a shared payload (see matrix.utils.transport), the decoded inputs are memory-mapped from it instead,
+              the arrays are copy-on-write, so they can be changed in place without changing the payload
 
         Return:
             a dictionary of shape {"type":list(), ...}
@@ -115,49 +249,73 @@ def auto_file_loader(path, types, pil=False):
             json -> list of dictionaries
     """
 
+    with tracing.start_span("auto_file_loader", {"path": path}) as span:
+        if is_payload_dir(path):
+            data = _load_payload(path, set(types), pil)
+        else:
+            data = _load_files(path, set(types), pil)
+        span.set_attribute("files", sum(len(items) for items in data.values()))
+    return data
+
+
+def load_payload_inputs(path, types):
+    """
+        loads the files of path like auto_file_loader, ready to be written with matrix.utils.transport.write_payload,
+        files whose loaded content can not be put in a payload (e.g. videos) are kept as FileRef and loaded again by the reader
+    """
+    return _load_files(path, set(types), False, file_refs=True)
+
+
+def _wanted(type_, types):
+    # the same selection as _load_files, types without a loader or not supported are returned as paths with "generic"
+    return type_ in types or ("generic" in types and type_ not in SUPPORTED_TYPES)
+
+
+def _load_payload(path, types, pil):
     data = {}
+    for type_, items in read_payload(path, writable=True).items():
+        if not _wanted(type_, types):
+            continue
+        data[type_] = []
+        for item in items:
+            if isinstance(item, FileRef):
+                loader, extend = _LOADERS[item.type_]
+                content = loader(item.path, pil=pil)
+                if extend:
+                    data[type_] += content
+                else:
+                    data[type_].append(content)
+            elif pil and type_ == "image":
+                from PIL import Image
+                data[type_].append(Image.fromarray(item))
+            else:
+                data[type_].append(item)
+    return data
+
 
-    files = glob.glob(os.path.join(path, "*"))
-    for file in files:
-        gtype = mimetypes.guess_type(file)[0]
-        group_, type_ = gtype.split("/")
-        if group_!="application":
-            type_ = group_
+def _load_files(path, types, pil, file_refs=False):
+    data = {}
+    load_generic = "generic" in types
+
+    for file in _list_files(path):
+        type_ = get_file_type(file)
         
-        if type_=="text" and "text" in types:
-            if type_ not in data.keys():
-                data[type_] = []
-            content = text_loader(file, split_lines=False)
-            data[type_] += content
-        elif type_=="image" and "image" in types:
-            if type_ not in data.keys():
+        if type_ in types and type_ in _LOADERS:
+            loader, extend = _LOADERS[type_]
+            with LOAD_SECONDS.labels(type=type_).time():
+                content = loader(file, pil=pil)
+            FILES_LOADED.labels(type=type_).inc()
+            if type_ not in data:
                 data[type_] = []
-            img = image_loader(file, pil=pil)
-            data[type_].append(img)
-        elif type_=="video" and "video" in types:
-            if type_ not in data.keys():
-                data[type_] = []
-            cap = video_loader(file, iterator=False)
-            data[type_].append(cap)
-        elif type_=="audio" and "audio" in types:
-            if type_ not in data.keys():
-                data[type_] = []
-            audio = audio_loader(file, sr=22050, mono=False)
-            data[type_].append(audio)
-        elif type_=="json" and "json" in types:
-            if type_ not in data.keys():
-                data[type_] = []
-            obj = json_loader(file)
-            data[type_].append(obj)
-        elif type_=="pdf" and "pdf" in types:
-            if type_ not in data.keys():
+            if file_refs and not can_encode(content):
+                data[type_].append(FileRef(file, type_))
+            elif extend:
+                data[type_] += content
+            else:
+                data[type_].append(content)
+        elif load_generic and type_ not in SUPPORTED_TYPES:
+            if type_ not in data:
                 data[type_] = []
             data[type_].append(file)
-        else:
-            if type_ not in SUPPORTED_TYPES and "generic" in types:
-                if type_ not in data.keys():
-                    data[type_] = []
-                data[type_].append(file)
+            FILES_LOADED.labels(type="generic").inc()
     return data
-
-
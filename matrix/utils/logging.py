@@ -1,9 +1,18 @@
 
-import functools
+import atexit
+import copy
+import json
 import logging
 import os
+import queue
+import random
 import sys
 import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
 from logging import (
     CRITICAL,
     DEBUG,
@@ -255,16 +264,284 @@ def warning(self, msg, *args, **kwargs):
 logging.Logger.warning_advice = warning_advice
 
 
-@functools.lru_cache(None)
-def warning_once(self, *args, **kwargs):
+# keys of the warnings emitted by warning_once, bounded so families of messages with variable parts can not grow it forever
+_warning_once_keys: "OrderedDict" = OrderedDict()
+_warning_once_lock = threading.Lock()
+WARNING_ONCE_MAXSIZE = 4096
+
+
+def warning_once(self, *args, key=None, **kwargs):
     """
     This method is identical to `logger.warning()`, but will emit the warning with the same message only once
 
     Note: The cache is for the function arguments, so 2 different callers using the same arguments will hit the cache.
     The assumption here is that all warning messages are unique across the code. If they aren't then need to switch to
     another type of cache that includes the caller frame information in the hashing function.
+
+    key: if given, the warning is emitted once per key instead of once per message, use it to cover a whole family
+        of messages, e.g. logger.warning_once("frame %d was dropped", index, key="frame-dropped")
+    NOTE: at most WARNING_ONCE_MAXSIZE keys are remembered, the least recently seen ones are forgotten first
     """
+    if key is None:
+        key = (args, tuple(sorted(kwargs.items())))
+    key = (self.name, key)
+
+    with _warning_once_lock:
+        if key in _warning_once_keys:
+            _warning_once_keys.move_to_end(key)
+            return
+        _warning_once_keys[key] = None
+        if len(_warning_once_keys) > WARNING_ONCE_MAXSIZE:
+            _warning_once_keys.popitem(last=False)
+    kwargs.setdefault("stacklevel", 2)
     self.warning(*args, **kwargs)
 
 
 logging.Logger.warning_once = warning_once
+
+
+#----------------------------------------------------------------------#
+#------------------------ Structured logging --------------------------#
+#----------------------------------------------------------------------#
+
+# request/task ids of the current request, set with log_context()
+_log_context: ContextVar[dict] = ContextVar("matrix_log_context", default={})
+# the listener of the async handler, see enable_async_handler()
+_queue_listener: Optional[QueueListener] = None
+_queue_handler: Optional[logging.Handler] = None
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    Attach fields (e.g. request_id, task_id) to every log record emitted inside the context, 
+    they are written by the JSON formatter
+
+    Example:
+        with log_context(request_id=request_id):
+            pipeline.run(...)
+    """
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+class lazy:
+    """
+    Defers building a message argument until the record is actually formatted,
+    e.g. logger.debug("stats: %s", lazy(lambda: compute_stats(frame)))
+    nothing is computed when the level is disabled or the record is filtered out
+    """
+
+    __slots__ = ("func",)
+
+    def __init__(self, func) -> None:
+        self.func = func
+
+    def __str__(self) -> str:
+        return str(self.func())
+
+    def __repr__(self) -> str:
+        return repr(self.func())
+
+
+class _ContextFilter(logging.Filter):
+    """
+    copies the current log context to the record, the context is not visible from the listener thread
+    """
+
+    def filter(self, record):
+        context = _log_context.get()
+        if context and not hasattr(record, "context"):
+            record.context = context
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats each record as a JSON line:
+        {"time": ..., "level": ..., "logger": ..., "message": ..., "request_id": ..., ...}
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "file": f"{record.filename}:{record.lineno}",
+        }
+        entry.update(getattr(record, "context", None) or _log_context.get())
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Limits high frequency messages, the records are grouped by their unformatted message (record.msg),
+    so "frame %d" with different frame numbers is one group. The first record of a group let through after
+    records were dropped ends with " (N similar messages suppressed)", `suppressed` counts every dropped record
+
+    Args:
+        rate (`int`): number of records of a group allowed per `interval` seconds
+        interval (`float`): length of the window in seconds
+        sample (`float`): probability of keeping a record that passed the rate limit, 1.0 keeps all
+        max_groups (`int`): number of groups remembered, the oldest ones are dropped first
+        level (`int`): records at this level or above are never limited
+    """
+
+    def __init__(self, rate=10, interval=1.0, sample=1.0, max_groups=1024, level=ERROR) -> None:
+        super().__init__()
+        self.rate = rate
+        self.interval = interval
+        self.sample = sample
+        self.max_groups = max_groups
+        self.level = level
+        self.suppressed = 0
+        # (logger name, message) -> (start of the window, records in the window, records dropped since the last one let through)
+        self._windows: "OrderedDict" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= self.level:
+            return True
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return False
+        
+        now = time.monotonic()
+        key = (record.name, record.msg if isinstance(record.msg, str) else type(record.msg))
+        with self._lock:
+            start, count, dropped = self._windows.pop(key, (now, 0, 0))
+            if now - start >= self.interval:
+                start, count = now, 0
+            count += 1
+            allowed = count <= self.rate
+            if not allowed:
+                dropped += 1
+                self.suppressed += 1
+            elif dropped and isinstance(record.msg, str):
+                record.msg = f"{record.msg} ({dropped} similar messages suppressed)"
+                dropped = 0
+            self._windows[key] = (start, count, dropped)
+            if len(self._windows) > self.max_groups:
+                self._windows.popitem(last=False)
+        return allowed
+
+
+class _AsyncQueueHandler(QueueHandler):
+    """
+    Like QueueHandler, the message is merged with its args in the calling thread, arguments changed after the call
+    are not seen, the rest of the formatting (JSON, exceptions) is done by the handlers on the listener thread
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def _move_rate_limits(source, targets):
+    """
+        moves the RateLimitFilters of the source handlers to the targets, records are counted once whatever
+        the order of add_rate_limit and enable_async_handler
+    """
+    for handler in source:
+        for log_filter in list(handler.filters):
+            if isinstance(log_filter, RateLimitFilter):
+                handler.removeFilter(log_filter)
+                for target in targets:
+                    target.addFilter(log_filter)
+
+
+def add_rate_limit(rate=10, interval=1.0, sample=1.0) -> RateLimitFilter:
+    """
+    Adds a RateLimitFilter to the handlers of the root logger and returns it, remove it with remove_filter()
+    NOTE: with the async handler, the records are dropped before they are queued, whether it is enabled before or after
+    """
+
+    _setup_library_root_logger()
+    rate_filter = RateLimitFilter(rate=rate, interval=interval, sample=sample)
+    # logger filters do not apply to records of child loggers, handler filters do
+    for handler in _get_library_root_logger().handlers:
+        handler.addFilter(rate_filter)
+    return rate_filter
+
+
+def remove_filter(log_filter: logging.Filter) -> None:
+    for handler in _get_library_root_logger().handlers + _current_handlers():
+        handler.removeFilter(log_filter)
+
+
+def enable_async_handler(max_queue_size: int = 10000) -> None:
+    """
+    Moves the handlers of the root logger behind a queue, the calling thread only puts the record in the queue
+    and a background thread formats and writes it. 
+    NOTE: when the queue is full, records are dropped instead of blocking the caller
+    """
+    global _queue_listener, _queue_handler
+
+    _setup_library_root_logger()
+    with _lock:
+        if _queue_listener is not None:
+            return
+        library_root_logger = _get_library_root_logger()
+        handlers = list(library_root_logger.handlers)
+        log_queue = queue.Queue(maxsize=max_queue_size)
+
+        _queue_handler = _AsyncQueueHandler(log_queue)
+        _queue_handler.addFilter(_ContextFilter())
+        _queue_handler.handleError = lambda record: None
+        for handler in handlers:
+            library_root_logger.removeHandler(handler)
+        _move_rate_limits(handlers, [_queue_handler])
+        library_root_logger.addHandler(_queue_handler)
+
+        _queue_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _queue_listener.start()
+        atexit.register(disable_async_handler)
+
+
+def disable_async_handler() -> None:
+    """
+    Flushes the queue and puts the handlers back on the root logger
+    """
+    global _queue_listener, _queue_handler
+
+    with _lock:
+        if _queue_listener is None:
+            return
+        _queue_listener.stop()
+        library_root_logger = _get_library_root_logger()
+        library_root_logger.removeHandler(_queue_handler)
+        _move_rate_limits([_queue_handler], _queue_listener.handlers)
+        for handler in _queue_listener.handlers:
+            library_root_logger.addHandler(handler)
+        _queue_listener = None
+        _queue_handler = None
+
+
+def _current_handlers():
+    if _queue_listener is not None:
+        return list(_queue_listener.handlers)
+    return _get_library_root_logger().handlers
+
+
+def enable_structured_logging(async_handler: bool = True) -> None:
+    """
+    Enable JSON lines output with the fields of log_context(), optionally through the async handler
+    """
+
+    _setup_library_root_logger()
+    for handler in _current_handlers():
+        handler.setFormatter(JsonFormatter())
+    if async_handler:
+        enable_async_handler()
+
+
+def disable_structured_logging() -> None:
+    disable_async_handler()
+    reset_format()
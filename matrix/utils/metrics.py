@@ -0,0 +1,357 @@
+"""
+Lightweight metrics: counters, gauges and histograms with fixed buckets, exported in Prometheus text format
+
+Metrics are disabled by default and then every update is a single flag check,
+enable them with enable_metrics() or MATRIX_METRICS=1
+"""
+
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.request import Request, urlopen
+import bisect
+import os
+import sys
+import threading
+import time
+from .logging import get_logger
+
+try:
+    import resource
+except ImportError: # windows
+    resource = None
+
+
+logger = get_logger(__name__)
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_enabled = os.getenv("MATRIX_METRICS", "0").lower() in ["1", "true", "yes"]
+
+
+def enable_metrics():
+    global _enabled
+    _enabled = True
+
+
+def disable_metrics():
+    global _enabled
+    _enabled = False
+
+
+def is_metrics_enabled():
+    return _enabled
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not pairs:
+        return ""
+    content = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs)
+    return "{" + content + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._init_values()
+
+    def _init_values(self):
+        raise NotImplementedError
+
+    def labels(self, **labels):
+        """
+            returns the child metric for the given label values, e.g. histogram.labels(stage="forward")
+        """
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key, None)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key, None)
+                if child is None:
+                    child = type(self).__new__(type(self))
+                    child.name = self.name
+                    child.labelnames = ()
+                    child._lock = threading.Lock()
+                    child._copy_config(self)
+                    child._init_values()
+                    self._children[key] = child
+        return child
+
+    def _copy_config(self, parent):
+        pass
+
+    def _samples(self):
+        if self.labelnames:
+            for key, child in list(self._children.items()):
+                for suffix, extra, value in child._own_samples():
+                    yield suffix, key, extra, value
+        else:
+            for suffix, extra, value in self._own_samples():
+                yield suffix, (), extra, value
+
+    def expose(self):
+        documentation = self.documentation.replace("\\", "\\\\").replace("\n", "\\n")
+        lines = [f"# HELP {self.name} {documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _init_values(self):
+        self._value = 0
+
+    def inc(self, amount=1):
+        if not _enabled:
+            return
+        with self._lock:
+            self._value += amount
+
+    def _own_samples(self):
+        yield "_total", None, self._value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _init_values(self):
+        self._value = 0
+        self._function = None
+
+    def set(self, value):
+        if not _enabled:
+            return
+        self._value = value
+
+    def inc(self, amount=1):
+        if not _enabled:
+            return
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        """
+            the value is read from function() when the metrics are collected
+        """
+        self._function = function
+
+    @contextmanager
+    def track_in_progress(self):
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+    def _own_samples(self):
+        yield "", None, self._function() if self._function is not None else self._value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _copy_config(self, parent):
+        self.buckets = parent.buckets
+
+    def _init_values(self):
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value):
+        if not _enabled:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    @contextmanager
+    def time(self):
+        """
+            observes the duration of the block in seconds
+        """
+        if not _enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def _own_samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self._counts):
+            cumulative += count
+            yield "_bucket", [("le", _format_value(float(bound)))], cumulative
+        yield "_sum", None, self._sum
+        yield "_count", None, self._count
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name, None)
+            if metric is None:
+                metric = cls(name, documentation, labelnames, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise RuntimeError(f"Metric {name} is already registered as a {metric.kind}")
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def generate_latest(self):
+        """
+            all metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.expose() for metric in metrics) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+generate_latest = REGISTRY.generate_latest
+
+
+def _max_rss_bytes():
+    # ru_maxrss is in bytes on macOS and in KB on linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+if resource is not None:
+    gauge("matrix_process_max_rss_bytes", "Peak resident memory of the process").set_function(_max_rss_bytes)
+
+
+#----------------------------------------------------------------------#
+#------------------------------- Sinks --------------------------------#
+#----------------------------------------------------------------------#
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ["/", "/metrics"]:
+            self.send_response(404)
+            self.end_headers()
+            return
+        content = self.registry.generate_latest().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def start_http_server(port=9100, host="0.0.0.0", registry=REGISTRY):
+    """
+     Serve the metrics on http://host:port/metrics for Prometheus to scrape, in a daemon thread
+     
+     Returns: 
+     	 the server, call server.shutdown() to stop it
+    """
+    enable_metrics()
+    handler = type("Handler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_to_file(path, registry=REGISTRY):
+    """
+        writes the metrics to path atomically, e.g. for the node exporter textfile collector
+    """
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(registry.generate_latest())
+    os.replace(temp_path, path)
+
+
+def push_to_gateway(url, job, registry=REGISTRY, timeout=5):
+    """
+        pushes the metrics to a Prometheus pushgateway, url e.g. http://localhost:9091
+    """
+    request = Request(
+        f"{url.rstrip('/')}/metrics/job/{job}",
+        data=registry.generate_latest().encode("utf-8"),
+        method="PUT",
+        headers={"Content-Type": "text/plain; version=0.0.4"},
+    )
+    with urlopen(request, timeout=timeout) as resp:
+        if resp.status >= 300:
+            raise RuntimeError(f"Pushing metrics failed, ERR_CODE: {resp.status}")
+
+
+class PeriodicSink:
+    """
+        calls sink() every `interval` seconds in a daemon thread, e.g.
+            PeriodicSink(lambda: write_to_file("/var/metrics/matrix.prom"), interval=15).start()
+    """
+
+    def __init__(self, sink, interval=15.0) -> None:
+        self.sink = sink
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sink()
+            except Exception:
+                logger.exception("Exporting the metrics failed")
+
+    def start(self):
+        enable_metrics()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.sink()
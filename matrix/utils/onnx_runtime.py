@@ -0,0 +1,282 @@
+"""
+ONNX Runtime backend of AbstractModel (framework="onnx"): export from pytorch/tensorflow, int8 dynamic quantization,
+session options and I/O binding
+"""
+
+import importlib.util
+import os
+import threading
+from .auxiliary import is_numpy_available, is_onnxruntime_available, is_tf_available, is_torch_available
+from .logging import get_logger
+
+
+if is_numpy_available():
+    import numpy as np
+
+if is_onnxruntime_available():
+    import onnxruntime as ort
+
+if is_torch_available():
+    import torch
+
+if is_tf_available():
+    import tensorflow as tf
+
+
+logger = get_logger(__name__)
+
+GRAPH_OPTIMIZATION_LEVELS = ["disable", "basic", "extended", "all"]
+QUANTIZATION_TYPES = ["int8", "uint8"]
+
+_QUANTIZE_LOCK = threading.Lock()
+
+
+def _require_onnxruntime():
+    if not is_onnxruntime_available():
+        raise RuntimeError("onnxruntime is not installed, pip install onnxruntime (or onnxruntime-gpu)")
+
+
+def export_onnx(model, path, framework, example_inputs, input_names=None, output_names=None, dynamic_axes=None, opset=17):
+    """
+     Export a pytorch or tensorflow (keras) model to an onnx file
+
+     Args:
+     	 model: the loaded model
+     	 path: the .onnx file to write
+     	 framework: "pt" or "tf"
+     	 example_inputs: pt-> a tensor or a tuple of tensors used for tracing, tf-> a tf.TensorSpec or a list of them
+     	 input_names, output_names: names of the graph inputs and outputs, pass them to feed inputs by name later
+     	 dynamic_axes: pt-> {name: {axis: "batch"}}, by default axis 0 of every input and output is dynamic
+     	 opset: the onnx opset version
+
+     Returns:
+     	 path
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    if framework == "pt":
+        input_names = input_names or ["input"]
+        output_names = output_names or ["output"]
+        if dynamic_axes is None:
+            dynamic_axes = {name: {0: "batch"} for name in input_names + output_names}
+        model.eval()
+        with torch.no_grad():
+            torch.onnx.export(
+                model, example_inputs, path,
+                input_names=input_names, output_names=output_names,
+                dynamic_axes=dynamic_axes, opset_version=opset, do_constant_folding=True
+            )
+    elif framework == "tf":
+        if importlib.util.find_spec("tf2onnx") is None:
+            raise RuntimeError("Exporting tensorflow models needs tf2onnx, pip install tf2onnx")
+        import tf2onnx
+
+        signature = example_inputs if isinstance(example_inputs, (list, tuple)) else [example_inputs]
+        if input_names:
+            signature = [tf.TensorSpec(spec.shape, spec.dtype, name=name) for spec, name in zip(signature, input_names)]
+        tf2onnx.convert.from_keras(model, input_signature=signature, opset=opset, output_path=path)
+    else:
+        raise RuntimeError(f"Only pytorch and tensorflow models can be exported to onnx, got {framework}")
+    return path
+
+
+def quantize_dynamic(model_path, output_path=None, weight_type="int8"):
+    """
+     Dynamic quantization of an onnx model, the weights are stored as int8 and activations are quantized on the fly,
+     usually a large speed up on cpu for linear/transformer models
+
+     Args:
+     	 model_path: the .onnx file
+     	 output_path: the quantized .onnx file, default is model_path with a .int8.onnx suffix
+     	 weight_type: "int8" or "uint8"
+
+     Returns:
+     	 output_path
+    """
+    _require_onnxruntime()
+    from onnxruntime.quantization import QuantType, quantize_dynamic as ort_quantize_dynamic
+
+    if weight_type not in QUANTIZATION_TYPES:
+        raise RuntimeError(f"weight_type must be one of {QUANTIZATION_TYPES}, got {weight_type}")
+    output_path = output_path or f"{os.path.splitext(model_path)[0]}.{weight_type}.onnx"
+    ort_quantize_dynamic(model_path, output_path, weight_type=QuantType.QInt8 if weight_type == "int8" else QuantType.QUInt8)
+    return output_path
+
+
+def quantized_path(path, quantize):
+    """
+        the file loaded for quantize (False, True -> "int8" or "uint8"), path itself if quantize is False
+    """
+    if not quantize:
+        return path
+    weight_type = quantize if isinstance(quantize, str) else "int8"
+    return f"{os.path.splitext(path)[0]}.{weight_type}.onnx"
+
+
+def ensure_quantized(path, quantize):
+    """
+     Quantize the onnx file once and cache it next to the original, it is quantized again if the original is newer
+
+     the quantized file is written to a temporary file and renamed, so sessions created concurrently (threads or processes)
+     never load a partly written file
+
+     Returns:
+     	 the path to load, see quantized_path
+    """
+    output_path = quantized_path(path, quantize)
+    if output_path == path:
+        return path
+    with _QUANTIZE_LOCK:
+        if os.path.exists(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(path):
+            return output_path
+        weight_type = quantize if isinstance(quantize, str) else "int8"
+        temp_path = f"{os.path.splitext(output_path)[0]}.{os.getpid()}.tmp.onnx"
+        try:
+            quantize_dynamic(path, temp_path, weight_type=weight_type)
+            os.replace(temp_path, output_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    return output_path
+
+
+def make_session_options(intra_op_threads=None, inter_op_threads=None, graph_optimization="all", parallel_execution=False, optimized_model_path=None):
+    """
+     onnxruntime.SessionOptions from the usual knobs
+
+     Args:
+     	 intra_op_threads: threads used inside one operator, default lets onnxruntime use the physical cores
+     	 inter_op_threads: threads used to run independent operators, only used with parallel_execution
+     	 graph_optimization: one of GRAPH_OPTIMIZATION_LEVELS
+     	 parallel_execution: if True, independent branches of the graph run concurrently
+     	 optimized_model_path: if given, the optimized graph is saved there, load it next time to skip the optimization
+    """
+    _require_onnxruntime()
+    if graph_optimization not in GRAPH_OPTIMIZATION_LEVELS:
+        raise RuntimeError(f"graph_optimization must be one of {GRAPH_OPTIMIZATION_LEVELS}, got {graph_optimization}")
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = {
+        "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+    }[graph_optimization]
+    if intra_op_threads:
+        options.intra_op_num_threads = int(intra_op_threads)
+    if inter_op_threads:
+        options.inter_op_num_threads = int(inter_op_threads)
+    options.execution_mode = ort.ExecutionMode.ORT_PARALLEL if parallel_execution else ort.ExecutionMode.ORT_SEQUENTIAL
+    if optimized_model_path:
+        options.optimized_model_filepath = optimized_model_path
+    return options
+
+
+def get_providers(device):
+    """
+        execution providers for the device, -1 -> cpu, otherwise the gpu index (cuda), falls back to cpu if cuda is missing
+    """
+    _require_onnxruntime()
+    if device is None or device < 0:
+        return ["CPUExecutionProvider"]
+    if "CUDAExecutionProvider" not in ort.get_available_providers():
+        logger.warning("CUDAExecutionProvider is not available (install onnxruntime-gpu), running on cpu")
+        return ["CPUExecutionProvider"]
+    return [("CUDAExecutionProvider", {"device_id": int(device)}), "CPUExecutionProvider"]
+
+
+class OnnxModel:
+    """
+        An onnxruntime InferenceSession that is called like a model
+            outputs = model(input_array) or model(input_ids=..., attention_mask=...)
+        the outputs are a list of numpy arrays in the order of output_names, or a single array if there is one output
+
+        io_binding: if True, the inputs are bound to the session instead of copied into it, numpy arrays on cpu and
+            cuda torch tensors (by their data pointer) are used in place, and the outputs stay on the device
+            of the session until they are read
+
+        NOTE: InferenceSession.run is thread safe, replicas on the same device share one session
+    """
+
+    def __init__(self, path, device=-1, session_options=None, io_binding=False) -> None:
+        _require_onnxruntime()
+        self.path = path
+        self.device = device
+        self.session_options = session_options
+        self.io_binding = io_binding
+        self.session = ort.InferenceSession(path, sess_options=session_options, providers=get_providers(device))
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.output_names = [o.name for o in self.session.get_outputs()]
+
+    def to(self, device):
+        """
+            a new session of the same model on the given device
+        """
+        if device == self.device:
+            return self
+        return OnnxModel(self.path, device=device, session_options=self.session_options, io_binding=self.io_binding)
+
+    def _feeds(self, args, kwargs):
+        if len(args) > len(self.input_names):
+            raise RuntimeError(f"the model has {len(self.input_names)} inputs, got {len(args)}")
+        feeds = dict(zip(self.input_names, args))
+        feeds.update(kwargs)
+        return feeds
+
+    @staticmethod
+    def _to_numpy(value):
+        if hasattr(value, "detach") and hasattr(value, "cpu"): # torch tensors
+            return value.detach().cpu().numpy()
+        if hasattr(value, "numpy") and not isinstance(value, np.ndarray): # tensorflow tensors
+            return value.numpy()
+        return np.asarray(value)
+
+    def _bind(self, feeds):
+        """
+            returns the binding and the bound values, which must stay alive until the run finished
+        """
+        binding = self.session.io_binding()
+        bound = []
+        for name, value in feeds.items():
+            if hasattr(value, "data_ptr") and value.device.type == "cuda":
+                value = value.contiguous()
+                bound.append(value)
+                binding.bind_input(
+                    name, "cuda", value.device.index or 0,
+                    np.dtype(str(value.dtype).replace("torch.", "")), list(value.shape), value.data_ptr()
+                )
+            else:
+                value = np.ascontiguousarray(self._to_numpy(value))
+                bound.append(value)
+                binding.bind_cpu_input(name, value)
+
+        device_type = "cpu" if self.device is None or self.device < 0 else "cuda"
+        for name in self.output_names:
+            binding.bind_output(name, device_type, 0 if device_type == "cpu" else int(self.device))
+        return binding, bound
+
+    def __call__(self, *args, **kwargs):
+        feeds = self._feeds(args, kwargs)
+        if self.io_binding:
+            binding, bound = self._bind(feeds)
+            self.session.run_with_iobinding(binding)
+            outputs = binding.copy_outputs_to_cpu()
+            del bound
+        else:
+            outputs = self.session.run(self.output_names, {name: self._to_numpy(value) for name, value in feeds.items()})
+        return outputs[0] if len(outputs) == 1 else outputs
+
+
+def load_onnx_model(path, device=-1, quantize=False, intra_op_threads=None, inter_op_threads=None, graph_optimization="all", io_binding=False):
+    """
+     Load an onnx file as an OnnxModel, optionally quantized first
+
+     Args:
+     	 path: the .onnx file
+     	 device: -1 for cpu, otherwise the gpu index
+     	 quantize: False, True ("int8") or "uint8", the quantized model is cached next to the original, see ensure_quantized
+     	 intra_op_threads, inter_op_threads, graph_optimization: see make_session_options
+     	 io_binding: see OnnxModel
+    """
+    path = ensure_quantized(path, quantize)
+    options = make_session_options(intra_op_threads, inter_op_threads, graph_optimization)
+    return OnnxModel(path, device=device, session_options=options, io_binding=io_binding)
@@ -0,0 +1,233 @@
+"""
+Subprocess runner that drains stdout and stderr at the same time, so a chatty stream can not fill its pipe and block the child
+"""
+
+import asyncio
+import os
+import re
+import signal
+import sys
+import time
+from datetime import datetime
+from typing import Callable, List, Optional
+
+
+# seconds the output of a killed command is still read, a process outside its group could hold the pipes open
+_DRAIN_GRACE = 1.0
+
+
+class CommandResult:
+    def __init__(self, returncode, stdout, stderr, duration, timed_out=False) -> None:
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+        self.timed_out = timed_out
+        # (monotonic seconds since start, stream name, line) of both streams in arrival order
+        self.lines = []
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+
+async def _drain(stream, name, chunks, result, start, log_file, echo, on_line):
+    """
+        reads the stream into chunks (a list of lines), the lines read so far stay in chunks if the task is cancelled
+    """
+    def handle(raw):
+        line = raw.decode("utf-8", errors="replace").rstrip("\r")
+        elapsed = time.monotonic() - start
+        chunks.append(line)
+        result.lines.append((elapsed, name, line))
+        if log_file is not None:
+            log_file.write(f"[{datetime.now().strftime('%H:%M:%S.%f')[:-3]}] [{name}] {line}\n")
+        if echo:
+            print(line, file=sys.stderr if name == "stderr" else sys.stdout, flush=True)
+        if on_line is not None:
+            on_line(name, line)
+
+    # read chunks instead of readline, a very long line must not overflow the stream limit
+    buffer = b""
+    try:
+        while True:
+            data = await stream.read(64 * 1024)
+            if not data:
+                break
+            buffer += data
+            *lines, buffer = buffer.split(b"\n")
+            for raw in lines:
+                handle(raw)
+    finally:
+        if buffer:
+            handle(buffer)
+
+
+def _kill(process):
+    """
+        kills the process group of the command, so the children of a shell, sudo, ... die with it
+    """
+    try:
+        if os.name == "posix":
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+    except PermissionError:
+        # e.g. a child that changed its user (sudo), at least kill the direct child
+        try:
+            process.kill()
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+async def _reap(process):
+    """
+        waits for the killed command, a process that could not be killed (another user) is left behind
+    """
+    try:
+        await asyncio.wait_for(process.wait(), timeout=_DRAIN_GRACE)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def _stop_drains(drains):
+    """
+        waits a little for the rest of the output, then gives up on the pipes
+    """
+    done, pending = await asyncio.wait(drains, timeout=_DRAIN_GRACE)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*drains, return_exceptions=True)
+
+
+async def run_command_async(command, log_path=None, timeout=None, echo=True, on_line: Optional[Callable[[str, str], None]] = None, cwd=None, env=None):
+    """
+     Run a command and stream both stdout and stderr line by line
+     
+     Args:
+     	 command: a string (run in a shell) or a list of arguments
+     	 log_path: if given, every line is appended to this file with a timestamp and its stream name
+     	 timeout: seconds after which the command is killed, result.timed_out is set
+     	 echo: if True, lines are printed to stdout/stderr as they arrive
+     	 on_line: callable(stream_name, line) called for every line
+     	 cwd, env: passed to the subprocess
+     
+     Returns: 
+     	 CommandResult, cancelling the task kills the command
+     
+     NOTE: the command runs in its own session, a timeout or a cancellation kills its whole process group
+    """
+    start = time.monotonic()
+    # a new session makes the command the leader of a process group, see _kill()
+    kwargs = {"start_new_session": True} if os.name == "posix" else {}
+    if isinstance(command, str):
+        process = await asyncio.create_subprocess_shell(command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, cwd=cwd, env=env, **kwargs)
+    else:
+        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, cwd=cwd, env=env, **kwargs)
+    
+    result = CommandResult(None, "", "", 0.0)
+    stdout, stderr = [], []
+    log_file = open(log_path, "a") if log_path is not None else None
+    try:
+        drains = [
+            asyncio.ensure_future(_drain(process.stdout, "stdout", stdout, result, start, log_file, echo, on_line)),
+            asyncio.ensure_future(_drain(process.stderr, "stderr", stderr, result, start, log_file, echo, on_line)),
+        ]
+        try:
+            await asyncio.wait_for(asyncio.gather(*[asyncio.shield(task) for task in drains]), timeout=timeout)
+            await process.wait()
+        except asyncio.TimeoutError:
+            result.timed_out = True
+            _kill(process)
+            await _reap(process)
+            await _stop_drains(drains)
+        except asyncio.CancelledError:
+            _kill(process)
+            await _reap(process)
+            await _stop_drains(drains)
+            raise
+    finally:
+        if log_file is not None:
+            log_file.close()
+    
+    result.stdout, result.stderr = "\n".join(stdout), "\n".join(stderr)
+    result.returncode = process.returncode
+    result.duration = time.monotonic() - start
+    return result
+
+
+def run_command(command, log_path=None, timeout=None, echo=True, on_line=None, cwd=None, env=None):
+    """
+        blocking version of run_command_async, do not call it from a running event loop
+    """
+    return asyncio.run(run_command_async(command, log_path=log_path, timeout=timeout, echo=echo, on_line=on_line, cwd=cwd, env=env))
+
+
+# BuildKit plain progress: "#7 [builder 4/8] RUN pip install ..." ... "#7 DONE 12.3s" or "#7 CACHED"
+_BUILDKIT_STEP = re.compile(r"^#(\d+) (\[.+?\] .+)$")
+_BUILDKIT_DONE = re.compile(r"^#(\d+) DONE (\d+(?:\.\d+)?)s$")
+_BUILDKIT_CACHED = re.compile(r"^#(\d+) CACHED$")
+# legacy builder: "Step 3/10 : RUN pip install ..."
+_LEGACY_STEP = re.compile(r"^Step (\d+)/(\d+) : (.+)$")
+
+
+def parse_docker_build_timings(result: CommandResult) -> List[dict]:
+    """
+     Extract the duration of each step of a docker build from its output
+     BuildKit (--progress=plain) reports the durations, for the legacy builder they are measured between the step lines
+     
+     Args:
+     	 result: the CommandResult of the docker build command
+     
+     Returns: 
+     	 list of {"step": str, "duration_s": float or None, "cached": bool} in build order
+    """
+    steps = {}
+    order = []
+    legacy = []
+    for elapsed, _, line in result.lines:
+        line = line.strip()
+        match = _BUILDKIT_STEP.match(line)
+        if match:
+            if match.group(1) not in steps:
+                steps[match.group(1)] = {"step": match.group(2), "duration_s": None, "cached": False}
+                order.append(match.group(1))
+            continue
+        match = _BUILDKIT_DONE.match(line)
+        if match and match.group(1) in steps:
+            steps[match.group(1)]["duration_s"] = float(match.group(2))
+            continue
+        match = _BUILDKIT_CACHED.match(line)
+        if match and match.group(1) in steps:
+            steps[match.group(1)]["cached"] = True
+            steps[match.group(1)]["duration_s"] = 0.0
+            continue
+        match = _LEGACY_STEP.match(line)
+        if match:
+            legacy.append((elapsed, match.group(3)))
+    
+    if order:
+        return [steps[i] for i in order]
+    
+    timings = []
+    for i, (elapsed, step) in enumerate(legacy):
+        end = legacy[i + 1][0] if i + 1 < len(legacy) else result.duration
+        timings.append({"step": step, "duration_s": end - elapsed, "cached": False})
+    return timings
+
+
+def print_build_timings(timings, top=None):
+    """
+        prints the steps sorted by duration, the slowest first
+    """
+    ranked = sorted(timings, key=lambda t: t["duration_s"] or 0.0, reverse=True)
+    if top is not None:
+        ranked = ranked[:top]
+    total = sum(t["duration_s"] or 0.0 for t in timings)
+    print(f"{'duration(s)':>12}  {'cached':<8}step")
+    for t in ranked:
+        duration = "N/A" if t["duration_s"] is None else f"{t['duration_s']:.1f}"
+        print(f"{duration:>12}  {str(t['cached']):<8}{t['step'][:100]}")
+    print(f"{total:>12.1f}  total")
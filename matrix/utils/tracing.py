@@ -0,0 +1,430 @@
+"""
+Request-level tracing with W3C trace context propagation and OpenTelemetry (OTLP/JSON) compatible export
+
+A trace starts in Client.call, its context is sent with the `traceparent` header and the pipeline runner
+picks it up from the TRACEPARENT env var (the server passes the header to the container), so the spans of
+the client, the loaders and each stage of AbstractModel.run end up in the same trace.
+
+Spans are recorded and exported only when an exporter is set, with set_exporter() or the env vars:
+    MATRIX_TRACES_FILE=/path/traces.jsonl      -> FileSpanExporter
+    MATRIX_OTLP_ENDPOINT=http://localhost:4318 -> OTLPHttpExporter
+the export runs in a background thread, the requests only put their finished spans in a bounded queue
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional
+from urllib.request import Request, urlopen
+from .logging import get_logger
+import atexit
+import json
+import os
+import queue
+import re
+import secrets
+import threading
+import time
+
+
+logger = get_logger(__name__)
+
+SERVICE_NAME = os.getenv("MATRIX_SERVICE_NAME", "matrix")
+TRACEPARENT_HEADER = "traceparent"
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+
+class SpanContext:
+    def __init__(self, trace_id, span_id, sampled=True) -> None:
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+
+    def to_traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    @classmethod
+    def from_traceparent(cls, value):
+        match = _TRACEPARENT.match((value or "").strip().lower())
+        if not match:
+            return None
+        return cls(match.group(1), match.group(2), sampled=match.group(3) == "01")
+
+
+class Span:
+    def __init__(self, name, context, parent_span_id=None, attributes=None) -> None:
+        self.name = name
+        self.context = context
+        self.parent_span_id = parent_span_id
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.context.trace_id,
+            "spanId": self.context.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [_otlp_attribute(k, v) for k, v in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_span_id:
+            span["parentSpanId"] = self.parent_span_id
+        return span
+
+
+class _NoopSpan:
+    """
+        returned by start_span when tracing is disabled, nothing is recorded
+    """
+    name = None
+    context = None
+    attributes = {}
+
+    def set_attribute(self, key, value):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    elif isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    elif isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def to_otlp_request(spans):
+    """
+        OTLP/JSON ExportTraceServiceRequest of the given spans
+    """
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{
+                "scope": {"name": "matrix"},
+                "spans": [span.to_otlp() for span in spans],
+            }],
+        }]
+    }
+
+
+#----------------------------------------------------------------------#
+#----------------------------- Exporters ------------------------------#
+#----------------------------------------------------------------------#
+
+class FileSpanExporter:
+    """
+        appends one OTLP/JSON ExportTraceServiceRequest per line to path
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        line = json.dumps(to_otlp_request(spans))
+        with self._lock, open(self.path, "a") as f:
+            f.write(line + "\n")
+
+
+class OTLPHttpExporter:
+    """
+        posts OTLP/JSON to an OpenTelemetry collector, endpoint e.g. http://localhost:4318
+    """
+
+    def __init__(self, endpoint, timeout=5) -> None:
+        self.url = endpoint.rstrip("/")
+        if not self.url.endswith("/v1/traces"):
+            self.url = f"{self.url}/v1/traces"
+        self.timeout = timeout
+
+    def export(self, spans):
+        request = Request(
+            self.url, 
+            data=json.dumps(to_otlp_request(spans)).encode("utf-8"), 
+            method="POST", 
+            headers={"Content-Type": "application/json"}
+        )
+        with urlopen(request, timeout=self.timeout) as resp:
+            if resp.status >= 300:
+                raise RuntimeError(f"Exporting spans failed, ERR_CODE: {resp.status}")
+
+
+class _BatchProcessor:
+    """
+        exports finished spans in batches from a background thread, requests never wait for the exporter
+
+        max_batch: spans exported at once
+        max_queue: spans waiting for the export at most, more spans are dropped
+        schedule_delay: seconds a span waits at most before the export of an incomplete batch
+    """
+
+    _FLUSH_TIMEOUT = 30
+
+    def __init__(self, exporter, max_batch=256, max_queue=2048, schedule_delay=1.0) -> None:
+        self.exporter = exporter
+        self.max_batch = max_batch
+        self.schedule_delay = schedule_delay
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, name="matrix-span-export", daemon=True)
+                self._thread.start()
+
+    def on_end(self, span):
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=_FLUSH_TIMEOUT):
+        """
+            exports the queued spans, returns False if it did not finish in timeout seconds
+        """
+        if self._thread is None:
+            return True
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def shutdown(self):
+        self.flush()
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(self._FLUSH_TIMEOUT)
+
+    def _work(self):
+        spans = []
+        deadline = None
+        while True:
+            try:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+            
+            if isinstance(item, Span):
+                spans.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.schedule_delay
+                if len(spans) < self.max_batch:
+                    continue
+            
+            # a full batch, the schedule delay passed, flush() or shutdown()
+            if spans:
+                self._export(spans)
+                spans, deadline = [], None
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                return
+
+    def _export(self, spans):
+        try:
+            self.exporter.export(spans)
+        except Exception as e:
+            # tracing must never break the request
+            logger.debug(f"Exporting {len(spans)} spans failed: {e}")
+
+
+_processor: Optional[_BatchProcessor] = None
+_current_span: ContextVar[Optional[Span]] = ContextVar("matrix_current_span", default=None)
+
+
+def set_exporter(exporter, max_batch=256, max_queue=2048, schedule_delay=1.0):
+    """
+        exporter: an object with export(spans), e.g. FileSpanExporter or OTLPHttpExporter, None disables tracing
+        max_batch, max_queue, schedule_delay: see _BatchProcessor
+    """
+    global _processor
+    if _processor is not None:
+        _processor.shutdown()
+    _processor = _BatchProcessor(exporter, max_batch=max_batch, max_queue=max_queue, schedule_delay=schedule_delay) if exporter is not None else None
+
+
+def flush():
+    """
+        waits until the finished spans are exported
+    """
+    if _processor is not None:
+        _processor.flush()
+
+
+def is_tracing_enabled():
+    return _processor is not None
+
+
+if os.getenv("MATRIX_TRACES_FILE"):
+    set_exporter(FileSpanExporter(os.getenv("MATRIX_TRACES_FILE")))
+elif os.getenv("MATRIX_OTLP_ENDPOINT"):
+    set_exporter(OTLPHttpExporter(os.getenv("MATRIX_OTLP_ENDPOINT")))
+atexit.register(flush)
+
+
+#----------------------------------------------------------------------#
+#---------------------------- Propagation -----------------------------#
+#----------------------------------------------------------------------#
+
+def _new_id(nbytes):
+    return secrets.token_hex(nbytes)
+
+
+def context_from_env():
+    """
+        the remote parent given to this process, TRACEPARENT env var
+    """
+    return SpanContext.from_traceparent(os.getenv("TRACEPARENT", os.getenv("MATRIX_TRACEPARENT", "")))
+
+
+def extract(headers):
+    """
+        the SpanContext of the traceparent header, None if missing or malformed
+    """
+    for key, value in (headers or {}).items():
+        if key.lower() == TRACEPARENT_HEADER:
+            return SpanContext.from_traceparent(value)
+    return None
+
+
+def inject(headers=None):
+    """
+        adds the traceparent header of the current span to headers (a new dict if None) and returns it
+    """
+    headers = {} if headers is None else headers
+    span = _current_span.get()
+    if span is not None:
+        headers[TRACEPARENT_HEADER] = span.context.to_traceparent()
+    return headers
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+@contextmanager
+def start_span(name, attributes=None, parent: Optional[SpanContext] = None):
+    """
+     Record a span around the block, the parent is the given context, the current span,
+     or the remote parent of the TRACEPARENT env var, in this order. Otherwise a new trace starts
+     if tracing is disabled, a no-op span is returned and nothing is recorded
+     
+     Example:
+        with start_span("forward", {"batch_size": 8}) as span:
+            ...
+    """
+    if _processor is None:
+        yield _NOOP_SPAN
+        return
+    
+    if parent is None:
+        current = _current_span.get()
+        parent = current.context if current is not None else context_from_env()
+    
+    if parent is not None:
+        context = SpanContext(parent.trace_id, _new_id(8), parent.sampled)
+        span = Span(name, context, parent.span_id, attributes)
+    else:
+        span = Span(name, SpanContext(_new_id(16), _new_id(8)), None, attributes)
+    
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            # a generator holding the span was resumed in another thread, whose context never had the span
+            pass
+        span.end_ns = time.time_ns()
+        processor = _processor
+        if processor is not None and span.context.sampled:
+            processor.on_end(span)
+
+
+#----------------------------------------------------------------------#
+#------------------------- Stand-in collector -------------------------#
+#----------------------------------------------------------------------#
+
+class LocalCollector:
+    """
+        a local stand-in for an OpenTelemetry collector, accepts OTLP/JSON on POST /v1/traces and keeps the spans
+
+        Example Usage:
+            collector = LocalCollector().start()
+            set_exporter(OTLPHttpExporter(collector.endpoint))
+            ...
+            flush()
+            spans = collector.spans
+    """
+
+    def __init__(self, host="127.0.0.1", port=0) -> None:
+        collector = self
+        self.spans = []
+        self._lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                if self.path != "/v1/traces":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                with collector._lock:
+                    for resource_spans in body.get("resourceSpans", []):
+                        for scope_spans in resource_spans.get("scopeSpans", []):
+                            collector.spans.extend(scope_spans.get("spans", []))
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.endpoint = f"http://{self._server.server_address[0]}:{self._server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def shutdown(self):
+        self._server.shutdown()
+
+    def traces(self):
+        """
+            {trace_id: [span, ...]} of the received spans
+        """
+        with self._lock:
+            result = {}
+            for span in self.spans:
+                result.setdefault(span["traceId"], []).append(span)
+            return result
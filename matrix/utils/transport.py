@@ -0,0 +1,201 @@
+"""
+Shared-memory handoff of decoded inputs/outputs between a runner and a pipeline on the same host
+
+A payload is a directory with two files:
+    matrix_manifest.json      -> the structure of the data, small values inline and arrays as (offset, shape, dtype)
+    matrix_payload-<id>.bin   -> the bytes of all arrays, 64 bytes aligned
+
+Values that can not be stored as arrays (e.g. cv2.VideoCapture objects) are put in as a FileRef, the path of the
+file and its type, and auto_file_loader loads them again on the reading side.
+
+Put the directory on a tmpfs like /dev/shm and the arrays are read as memory maps of the same pages,
+no decoding, no copy. auto_file_loader reads a payload directory transparently.
+"""
+
+import json
+import os
+import tempfile
+import uuid
+from .auxiliary import is_numpy_available
+
+
+if is_numpy_available():
+    import numpy as np
+
+
+MANIFEST_FILE = "matrix_manifest.json"
+PAYLOAD_FILE = "matrix_payload.bin"
+_PAYLOAD_PREFIX = "matrix_payload"
+SHM_ROOT = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+_ALIGNMENT = 64
+
+
+def is_payload_dir(path):
+    return os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+
+def new_payload_dir(prefix="matrix"):
+    """
+        creates an empty directory on the shared memory filesystem (/dev/shm on linux)
+    """
+    path = os.path.join(SHM_ROOT, f"{prefix}-{uuid.uuid4().hex}")
+    os.makedirs(path)
+    return path
+
+
+class FileRef:
+    """
+        a file put in a payload by its path, used for values that can not be stored as arrays
+        the path must be valid on the reading side too
+    """
+    def __init__(self, path, type_) -> None:
+        self.path = path
+        self.type_ = type_
+
+    def __repr__(self) -> str:
+        return f"FileRef({self.path!r}, {self.type_!r})"
+
+
+def can_encode(value):
+    """
+        True if write_payload can store the value
+    """
+    try:
+        _encode(value, [], 0)
+    except RuntimeError:
+        return False
+    return True
+
+
+def _encode(value, arrays, offset):
+    """
+        returns (manifest entry, new offset), arrays collects (offset, array) to be written
+    """
+    if hasattr(value, "detach") and hasattr(value, "cpu"): # torch tensors
+        value = value.detach().cpu().numpy()
+    elif hasattr(value, "numpy") and not isinstance(value, np.ndarray): # tensorflow tensors
+        value = value.numpy()
+    if is_numpy_available() and isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        offset = (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+        arrays.append((offset, value))
+        entry = {"kind": "ndarray", "offset": offset, "shape": list(value.shape), "dtype": value.dtype.str}
+        return entry, offset + value.nbytes
+    elif isinstance(value, dict):
+        entry = {"kind": "dict", "items": {}}
+        for k, v in value.items():
+            entry["items"][str(k)], offset = _encode(v, arrays, offset)
+        return entry, offset
+    elif isinstance(value, (list, tuple)):
+        entry = {"kind": "list" if isinstance(value, list) else "tuple", "items": []}
+        for v in value:
+            item, offset = _encode(v, arrays, offset)
+            entry["items"].append(item)
+        return entry, offset
+    elif isinstance(value, (str, int, float, bool)) or value is None:
+        return {"kind": "value", "value": value}, offset
+    elif isinstance(value, bytes):
+        return _encode(np.frombuffer(value, dtype=np.uint8), arrays, offset)
+    elif isinstance(value, FileRef):
+        return {"kind": "file", "path": value.path, "type": value.type_}, offset
+    else:
+        raise RuntimeError(f"{type(value).__name__} can not be put in a shared payload, convert it to a numpy array first")
+
+
+def _decode(entry, buffer):
+    kind = entry["kind"]
+    if kind == "ndarray":
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"])) if entry["shape"] else 1
+        return np.frombuffer(buffer, dtype=dtype, count=count, offset=entry["offset"]).reshape(entry["shape"])
+    elif kind == "dict":
+        return {k: _decode(v, buffer) for k, v in entry["items"].items()}
+    elif kind == "list":
+        return [_decode(v, buffer) for v in entry["items"]]
+    elif kind == "tuple":
+        return tuple([_decode(v, buffer) for v in entry["items"]])
+    elif kind == "file":
+        return FileRef(entry["path"], entry["type"])
+    return entry["value"]
+
+
+def write_payload(path, data):
+    """
+     Write data (e.g. the dict returned by auto_file_loader) into a payload directory
+     
+     Args:
+     	 path: the payload directory, created if needed, use new_payload_dir() for one in shared memory
+     	 data: nested dicts/lists/tuples of numpy arrays, strings, numbers, bytes, FileRef
+     
+     NOTE: a payload can be written again while readers still map it, the arrays go to a new file
+           and readers keep the pages of the old one
+     
+     Returns: 
+     	 path
+    """
+    os.makedirs(path, exist_ok=True)
+    arrays = []
+    manifest, size = _encode(data, arrays, 0)
+
+    # never truncate a file that could be mapped by a reader (SIGBUS), each write gets its own payload file
+    payload_file = f"{_PAYLOAD_PREFIX}-{uuid.uuid4().hex}.bin"
+    payload_path = os.path.join(path, payload_file)
+    with open(payload_path, "wb") as f:
+        f.truncate(size)
+    if size:
+        buffer = np.memmap(payload_path, dtype=np.uint8, mode="r+", shape=(size,))
+        for offset, array in arrays:
+            buffer[offset:offset+array.nbytes] = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+        buffer.flush()
+        del buffer
+    
+    # the manifest is written last and renamed, readers never see a manifest without its payload
+    temp_path = os.path.join(path, f".{MANIFEST_FILE}.tmp")
+    with open(temp_path, "w") as f:
+        f.write(json.dumps({"version": 1, "size": size, "payload": payload_file, "data": manifest}))
+    os.replace(temp_path, os.path.join(path, MANIFEST_FILE))
+
+    # the previous payload files are only unlinked, readers which mapped them keep their pages
+    for name in os.listdir(path):
+        if name.startswith(_PAYLOAD_PREFIX) and name != payload_file:
+            os.remove(os.path.join(path, name))
+    return path
+
+
+def read_payload(path, writable=False):
+    """
+     Read a payload directory, the arrays are memory-mapped views of the payload file, nothing is copied
+     
+     Args:
+     	 path: the payload directory
+     	 writable: if True, the arrays are copy-on-write (writes are private), otherwise read-only
+     
+     Returns: 
+     	 the data given to write_payload
+    """
+    for attempt in range(3):
+        with open(os.path.join(path, MANIFEST_FILE), "r") as f:
+            manifest = json.loads(f.read())
+        
+        buffer = b""
+        if manifest["size"]:
+            payload_path = os.path.join(path, manifest.get("payload", PAYLOAD_FILE))
+            try:
+                buffer = np.memmap(payload_path, dtype=np.uint8, mode="c" if writable else "r", shape=(manifest["size"],))
+            except FileNotFoundError:
+                # written again between reading the manifest and mapping the payload, read the new manifest
+                if attempt == 2:
+                    raise
+                continue
+        return _decode(manifest["data"], buffer)
+
+
+def remove_payload(path):
+    if not os.path.isdir(path):
+        return
+    for name in os.listdir(path):
+        if name == MANIFEST_FILE or name.startswith(_PAYLOAD_PREFIX):
+            os.remove(os.path.join(path, name))
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
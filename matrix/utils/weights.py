@@ -0,0 +1,203 @@
+"""
+Memory-mapped weight loading, the weights are read from the page cache and copied directly to the target device
+instead of reading the whole checkpoint into RAM first
+"""
+
+from collections.abc import Mapping
+import importlib.util
+import json
+import os
+import struct
+from packaging import version
+from .auxiliary import is_numpy_available, is_torch_available
+from .logging import get_logger
+
+
+if is_numpy_available():
+    import numpy as np
+
+if is_torch_available():
+    import torch
+
+
+logger = get_logger(__name__)
+
+_safetensors_available = importlib.util.find_spec("safetensors") is not None
+
+# safetensors dtype -> (numpy dtype used to read the bytes, torch dtype name)
+_SAFETENSORS_DTYPES = {
+    "F64": ("<f8", "float64"),
+    "F32": ("<f4", "float32"),
+    "F16": ("<f2", "float16"),
+    "BF16": ("<u2", "bfloat16"),
+    "I64": ("<i8", "int64"),
+    "I32": ("<i4", "int32"),
+    "I16": ("<i2", "int16"),
+    "I8": ("i1", "int8"),
+    "U8": ("u1", "uint8"),
+    "BOOL": ("?", "bool"),
+}
+
+TORCH_EXTENSIONS = [".pt", ".pth", ".ckpt", ".bin"]
+
+
+def _to_device(array, device, framework):
+    if framework == "pt":
+        tensor = torch.from_numpy(array)
+        return tensor.to(device) if device is not None else tensor
+    return array
+
+
+class SafetensorsFile(Mapping):
+    """
+        Read-only mapping over a .safetensors file, the file is memory-mapped and each tensor is
+        materialized only when it is accessed
+
+        Parameters:
+            path: path to the .safetensors file
+            device: the device of the returned tensors, None keeps numpy arrays/cpu tensors backed by the file
+            framework: "pt" returns torch tensors, anything else returns numpy arrays
+    """
+
+    def __init__(self, path, device=None, framework="pt") -> None:
+        with open(path, "rb") as f:
+            header_size = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(header_size))
+        self.metadata = header.pop("__metadata__", {})
+        self._header = header
+        self._data_start = 8 + header_size
+        # copy-on-write mapping, the pages are shared with the page cache and the arrays are writable for torch.from_numpy
+        self._mmap = np.memmap(path, dtype=np.uint8, mode="c")
+        self.device = device
+        self.framework = framework
+
+    def _array(self, name):
+        info = self._header[name]
+        if info["dtype"] not in _SAFETENSORS_DTYPES:
+            raise RuntimeError(f"Unsupported safetensors dtype {info['dtype']} for {name}")
+        np_dtype, torch_dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        buffer = self._mmap[self._data_start + begin:self._data_start + end]
+        return buffer.view(np_dtype).reshape(info["shape"]), torch_dtype
+
+    def __getitem__(self, name):
+        array, torch_dtype = self._array(name)
+        if self.framework == "pt":
+            tensor = torch.from_numpy(array)
+            if torch_dtype == "bfloat16":
+                tensor = tensor.view(torch.bfloat16)
+            return tensor.to(self.device) if self.device is not None else tensor
+        return array
+
+    def __iter__(self):
+        return iter(self._header)
+
+    def __len__(self):
+        return len(self._header)
+
+
+def load_weights(path, device=None, framework="pt", lazy=False, weights_only=True):
+    """
+     Load weights from a checkpoint file without reading the whole file into memory when possible
+     
+     Args:
+     	 path: .safetensors, .npy, .npz or a torch checkpoint (.pt, .pth, .ckpt, .bin)
+     	 device: the target device, tensors are materialized directly on it
+     	 framework: "pt" returns torch tensors, otherwise numpy arrays
+     	 lazy: if True, returns a mapping that loads each tensor on access, only for .safetensors and .npz
+     	 weights_only: torch checkpoints are unpickled with the safe loader (tensors and plain containers only),
+     	     False unpickles any object, only give it for checkpoints you trust
+     
+     Returns: 
+     	 a dict (or a lazy mapping) of name -> tensor, a single array/tensor for .npy files
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if framework == "pt" and device is not None:
+        device = torch.device(device) if not isinstance(device, torch.device) else device
+
+    if ext == ".safetensors":
+        if _safetensors_available and framework == "pt" and not lazy:
+            from safetensors.torch import load_file
+            return load_file(path, device=str(device) if device is not None else "cpu")
+        weights = SafetensorsFile(path, device=device, framework=framework)
+        return weights if lazy else {name: weights[name] for name in weights}
+    elif ext == ".npy":
+        return _to_device(np.load(path, mmap_mode="c"), device, framework)
+    elif ext == ".npz":
+        # npz members are compressed or zipped, they can not be memory-mapped but are read one by one
+        archive = np.load(path)
+        if lazy:
+            return archive
+        return {name: _to_device(archive[name], device, framework) for name in archive.files}
+    elif ext in TORCH_EXTENSIONS:
+        if framework != "pt":
+            raise RuntimeError(f"{path} is a torch checkpoint, framework must be `pt`")
+        kwargs = {"map_location": device if device is not None else "cpu"}
+        torch_version = version.parse(version.parse(torch.__version__).base_version)
+        if not weights_only:
+            logger.warning(f"Loading {path} with weights_only=False, any pickled object in it is executed")
+        if torch_version >= version.parse("1.13.0"):
+            kwargs["weights_only"] = bool(weights_only)
+        elif weights_only:
+            logger.warning(f"torch {torch.__version__} has no safe loader, {path} is unpickled as is")
+        if torch_version >= version.parse("2.1.0"):
+            # memory-map the checkpoint instead of reading it into RAM
+            kwargs["mmap"] = True
+        try:
+            return torch.load(path, **kwargs)
+        except TypeError as e:
+            # builds of torch without the mmap argument, every other error (a checkpoint the safe loader rejects,
+            # a corrupt file, a bad map_location) is raised as is
+            if "mmap" not in str(e):
+                raise
+            kwargs.pop("mmap")
+            return torch.load(path, **kwargs)
+    else:
+        raise RuntimeError(f"Unknown weights format {ext}, supported formats: {['.safetensors', '.npy', '.npz'] + TORCH_EXTENSIONS}")
+
+
+def load_weights_into_model(model, path, strict=True, prefix=""):
+    """
+     Load weights from a checkpoint into a torch model one tensor at a time,
+     each tensor is copied from the memory-mapped file directly to the device of its parameter,
+     so the peak memory overhead is one tensor instead of the whole checkpoint
+     
+     Args:
+     	 model: torch.nn.Module already placed on its device
+     	 path: checkpoint path, see load_weights, a .npy file holds a single array without names and is not supported
+     	 strict: if True, missing or unexpected keys raise RuntimeError
+     	 prefix: prefix of the model keys inside the checkpoint, e.g. "model."
+     
+     Returns: 
+     	 tuple of (missing_keys, unexpected_keys)
+    """
+    if os.path.splitext(path)[1].lower() == ".npy":
+        raise RuntimeError(f"{path} holds a single array without parameter names, save the weights as .npz or .safetensors")
+    weights = load_weights(path, device=None, framework="pt", lazy=True)
+    if isinstance(weights, Mapping) and "state_dict" in weights and not isinstance(weights["state_dict"], torch.Tensor):
+        weights = weights["state_dict"]
+    
+    state = model.state_dict(keep_vars=True)
+    names = {name[len(prefix):] if name.startswith(prefix) else None: name for name in weights}
+    names.pop(None, None)
+
+    missing = [key for key in state if key not in names]
+    unexpected = [names[key] for key in names if key not in state]
+    if strict and (missing or unexpected):
+        raise RuntimeError(f"Error loading weights from {path}, missing keys: {missing}, unexpected keys: {unexpected}")
+    
+    with torch.no_grad():
+        for key, target in state.items():
+            if key not in names:
+                continue
+            source = weights[names[key]]
+            if isinstance(source, np.ndarray): # members of .npz files
+                source = torch.from_numpy(source)
+            if tuple(source.shape) != tuple(target.shape):
+                raise RuntimeError(f"Shape mismatch for {key}: checkpoint {tuple(source.shape)}, model {tuple(target.shape)}")
+            target.copy_(source.to(target.device, non_blocking=True))
+    
+    if hasattr(weights, "close"): # the NpzFile of .npz files
+        weights.close()
+    logger.info(f"Loaded {len(state) - len(missing)} tensors from {path}")
+    return missing, unexpected
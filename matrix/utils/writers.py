@@ -0,0 +1,177 @@
+"""
+Asynchronous output writer for post_process, the encoding and the disk I/O run in a background pool
+"""
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import json
+import os
+import threading
+import uuid
+from .logging import get_logger
+
+
+logger = get_logger(__name__)
+
+FSYNC_POLICIES = ["none", "file", "dir"]
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _atomic_write(path, data, fsync):
+    """
+        writes to a temporary file in the same directory and renames it, readers never see a partial file
+    """
+    directory = os.path.dirname(path) or "."
+    temp_path = os.path.join(directory, f".{os.path.basename(path)}.{uuid.uuid4().hex}.tmp")
+    mode = "w" if isinstance(data, str) else "wb"
+    try:
+        with open(temp_path, mode) as f:
+            f.write(data)
+            if fsync != "none":
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    if fsync == "dir":
+        _fsync_dir(directory)
+    return path
+
+
+def _encode_image(path, image, params, rgb):
+    import cv2
+    if rgb and image.ndim == 3 and image.shape[2] == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    ext = os.path.splitext(path)[1] or ".png"
+    ok, encoded = cv2.imencode(ext, image, params or [])
+    if not ok:
+        raise RuntimeError(f"Could not encode the image {path}")
+    return encoded.tobytes()
+
+
+def _write_image(path, image, params, rgb, fsync):
+    return _atomic_write(path, _encode_image(path, image, params, rgb), fsync)
+
+
+def _write_array(path, array, fsync):
+    import io
+    import numpy as np
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return _atomic_write(path, buffer.getvalue(), fsync)
+
+
+def _write_json(path, obj, fsync):
+    return _atomic_write(path, json.dumps(obj, ensure_ascii=False), fsync)
+
+
+class OutputWriter:
+    """
+        Writes the outputs of post_process in the background, post_process hands over the data and returns
+
+        Parameters:
+            output_dir: the directory of the outputs
+            workers: number of background writers
+            max_pending: maximum number of writes queued, write_* blocks when the queue is full
+            fsync: "none", "file" (fsync each file) or "dir" (fsync each file and the directory after the rename)
+            use_processes: if True, encoding runs in worker processes instead of threads
+                threads are enough for cv2, it releases the GIL while encoding
+
+        Example Usage (inside post_process):
+            self.output_writer.write_image("result.png", image)
+            self.output_writer.write_text("result.txt", text)
+        
+        NOTE: the files are written atomically, a file appears under its name only when it is complete
+        NOTE: call flush() to wait for every pending write, run() does this at the end unless output_flush="none"
+    """
+
+    def __init__(self, output_dir, workers=2, max_pending=16, fsync="none", use_processes=False) -> None:
+        if fsync not in FSYNC_POLICIES:
+            raise RuntimeError(f"fsync must be one of {FSYNC_POLICIES}, got {fsync}")
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.fsync = fsync
+        executor_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        self._executor = executor_cls(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending = set()
+        self._errors = []
+        self._lock = threading.Lock()
+        self._finished = threading.Condition(self._lock)
+
+    def _path(self, name):
+        return name if os.path.isabs(name) else os.path.join(self.output_dir, name)
+
+    def _submit(self, func, *args):
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._finished:
+            self._pending.discard(future)
+            if future.exception() is not None:
+                self._errors.append(future.exception())
+            self._finished.notify_all()
+        self._slots.release()
+
+    def write_text(self, name, text):
+        return self._submit(_atomic_write, self._path(name), str(text), self.fsync)
+
+    def write_bytes(self, name, data):
+        return self._submit(_atomic_write, self._path(name), bytes(data), self.fsync)
+
+    def write_json(self, name, obj):
+        return self._submit(_write_json, self._path(name), obj, self.fsync)
+
+    def write_image(self, name, image, params=None, rgb=True):
+        """
+            name: the extension selects the format, e.g. "out.png", "out.jpg"
+            image: numpy array, RGB by default like the images of auto_file_loader, rgb=False for BGR
+            params: cv2.imencode params, e.g. [cv2.IMWRITE_JPEG_QUALITY, 90]
+        """
+        return self._submit(_write_image, self._path(name), image, params, rgb, self.fsync)
+
+    def write_array(self, name, array):
+        """
+            saves a numpy array in .npy format
+        """
+        return self._submit(_write_array, self._path(name), array, self.fsync)
+
+    def flush(self):
+        """
+            waits for every pending write, raises the first error of the failed writes
+        """
+        with self._finished:
+            # the done callbacks remove the futures from pending, so every error is collected once
+            self._finished.wait_for(lambda: not self._pending)
+            errors, self._errors = self._errors, []
+        if errors:
+            raise RuntimeError(f"{len(errors)} output(s) could not be written, first error: {errors[0]}") from errors[0]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
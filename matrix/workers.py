@@ -0,0 +1,475 @@
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
+from multiprocessing.connection import wait
+import multiprocessing as mp
+import gc
+import importlib
+import itertools
+import os
+import pickle
+import signal
+import threading
+import traceback
+from .utils.auxiliary import is_numpy_available, is_torch_available
+from .utils.logging import get_logger
+
+
+if is_numpy_available():
+    import numpy as np
+
+if is_torch_available():
+    import torch
+
+
+logger = get_logger(__name__)
+
+# the pipeline of the current worker process
+_worker_pipeline = None
+
+
+class _SharedArray:
+    """
+        a numpy array moved to shared memory, only the name, shape and dtype are pickled
+    """
+    def __init__(self, array):
+        self.shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.name = self.shm.name
+        self.shape = array.shape
+        self.dtype = array.dtype.str
+        np.ndarray(array.shape, dtype=array.dtype, buffer=self.shm.buf)[...] = array
+
+    def __getstate__(self):
+        return {"name": self.name, "shape": self.shape, "dtype": self.dtype}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = None
+
+    def load(self):
+        shm = shared_memory.SharedMemory(name=self.name)
+        try:
+            return np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf).copy()
+        finally:
+            shm.close()
+            shm.unlink()
+
+
+def _to_shared(outputs, threshold, created):
+    if is_numpy_available() and isinstance(outputs, np.ndarray) and outputs.nbytes >= threshold and not outputs.dtype.hasobject:
+        shared = _SharedArray(outputs)
+        created.append(shared)
+        return shared
+    elif isinstance(outputs, dict):
+        return {k: _to_shared(v, threshold, created) for k, v in outputs.items()}
+    elif isinstance(outputs, list):
+        return [_to_shared(v, threshold, created) for v in outputs]
+    elif isinstance(outputs, tuple):
+        return tuple([_to_shared(v, threshold, created) for v in outputs])
+    return outputs
+
+
+def _from_shared(outputs):
+    if isinstance(outputs, _SharedArray):
+        return outputs.load()
+    elif isinstance(outputs, dict):
+        return {k: _from_shared(v) for k, v in outputs.items()}
+    elif isinstance(outputs, list):
+        return [_from_shared(v) for v in outputs]
+    elif isinstance(outputs, tuple):
+        return tuple([_from_shared(v) for v in outputs])
+    return outputs
+
+
+def _init_worker(factory, pipeline):
+    """
+        pipeline is only given with fork, the arguments of a forked worker are inherited (copy-on-write), not pickled
+    """
+    global _worker_pipeline
+    if factory is not None:
+        _worker_pipeline = factory()
+    else:
+        _worker_pipeline = pipeline
+
+
+def _share_outputs(outputs, threshold):
+    created = []
+    outputs = _to_shared(outputs, threshold, created)
+    for shared in created:
+        # the parent owns and unlinks the memory after reading it, so the worker must not track it
+        resource_tracker.unregister(shared.shm._name, "shared_memory")
+        shared.shm.close()
+    return outputs
+
+
+def _run_in_worker(inputs, preprocess_params, forward_params, postprocess_params, threshold):
+    outputs = _worker_pipeline.run(inputs, preprocess_params, forward_params, postprocess_params)
+    return _share_outputs(outputs, threshold)
+
+
+class ProcessPoolRunner:
+    """
+        Runs an AbstractModel in N worker processes, for CPU-bound pipelines (framework="oth", sklearn, ...)
+        that are limited by the GIL when run in threads.
+
+        Parameters:
+            pipeline: a loaded AbstractModel instance, shared copy-on-write with forked workers
+                only supported with the "fork" start method (linux)
+            factory: callable with no argument returning a loaded AbstractModel instance, called once in each worker
+                it must be picklable (a module level function) if the start method is not "fork"
+            workers: number of worker processes, default os.cpu_count()
+            shm_threshold: numpy outputs larger than this (bytes) are sent back through shared memory instead of the pipe
+            start_method: "fork", "spawn" or "forkserver", default "fork" when pipeline is given
+
+        NOTE: if pytorch or tensorflow have been initialized in the parent, use factory with "spawn"
+
+        Example Usage:
+            with ProcessPoolRunner(pipeline, workers=8) as runner:
+                futures = [runner.submit(inputs, preprocess_params, forward_params, postprocess_params) for inputs in requests]
+                outputs = [f.result() for f in futures]
+    """
+
+    def __init__(self, pipeline=None, factory=None, workers=None, shm_threshold=1024*1024, start_method=None) -> None:
+        if (pipeline is None) == (factory is None):
+            raise RuntimeError("Exactly one of pipeline or factory must be given")
+        
+        if start_method is None:
+            start_method = "fork" if pipeline is not None else "spawn"
+        if pipeline is not None and start_method != "fork":
+            raise RuntimeError("A loaded pipeline can be shared only with forked workers, use factory instead")
+        if start_method not in mp.get_all_start_methods():
+            raise RuntimeError(f"Start method {start_method} is not supported on this platform")
+        
+        self.workers = workers or os.cpu_count() or 1
+        self.shm_threshold = shm_threshold
+        
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=mp.get_context(start_method),
+            initializer=_init_worker,
+            initargs=(factory, pipeline),
+        )
+        logger.info(f"Started a process pool with {self.workers} workers ({start_method})")
+
+    def submit(self, inputs, preprocess_params, forward_params, postprocess_params):
+        """
+            Submit a request to the pool, same arguments as AbstractModel.run
+
+            Returns:
+                a future, future.result() returns the output of run()
+        """
+        future = self._executor.submit(
+            _run_in_worker, inputs, preprocess_params, forward_params, postprocess_params, self.shm_threshold
+        )
+        return _ResultFuture(future)
+
+    def run(self, inputs, preprocess_params, forward_params, postprocess_params):
+        return self.submit(inputs, preprocess_params, forward_params, postprocess_params).result()
+
+    def map(self, inputs_list, preprocess_params, forward_params, postprocess_params):
+        """
+            Run a list of inputs, returns the outputs in the same order
+        """
+        futures = [self.submit(inputs, preprocess_params, forward_params, postprocess_params) for inputs in inputs_list]
+        return [future.result() for future in futures]
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+class _ResultFuture:
+    """
+        wraps the future of the pool, the outputs are read from shared memory (and the memory is unlinked)
+        as soon as the worker is done, so a future that is dropped or never read does not leak the memory
+    """
+    def __init__(self, future):
+        self._future = future
+        self._loaded = threading.Event()
+        self._result = None
+        self._error = None
+        future.add_done_callback(self._load)
+
+    def _load(self, future):
+        try:
+            if not future.cancelled() and future.exception() is None:
+                self._result = _from_shared(future.result())
+        except BaseException as e:
+            self._error = e
+        finally:
+            self._loaded.set()
+
+    def done(self):
+        return self._loaded.is_set()
+
+    def cancel(self):
+        return self._future.cancel()
+
+    def result(self, timeout=None):
+        # raises the error of the worker, or the timeout
+        self._future.result(timeout=timeout)
+        self._loaded.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def exception(self, timeout=None):
+        error = self._future.exception(timeout=timeout)
+        if error is None:
+            self._loaded.wait()
+            return self._error
+        return error
+
+
+def _zygote_child(pipeline, conn, args, threshold):
+    """
+        runs one request in the forked child and exits, never returns
+    """
+    status = 0
+    try:
+        try:
+            conn.send(("ok", _share_outputs(pipeline.run(*args), threshold)))
+        except BaseException as e:
+            status = 1
+            error = e
+            try:
+                pickle.dumps(error)
+            except Exception:
+                error = RuntimeError(f"{type(e).__name__}: {e}")
+            conn.send(("error", (error, traceback.format_exc())))
+        conn.close()
+    finally:
+        # skip the atexit handlers and buffers inherited from the zygote
+        os._exit(status)
+
+
+def _zygote_main(control, pipeline, factory, preload, workers, threshold):
+    """
+        the zygote process: imports and loads once, then forks one child per request
+        only this process writes to control, so the answers of concurrent children never interleave
+    """
+    try:
+        for module in preload:
+            importlib.import_module(module)
+        if factory is not None:
+            pipeline = factory()
+        # the loaded objects are moved out of the gc, collections in the children do not touch (and copy) their pages
+        gc.collect()
+        gc.freeze()
+    except BaseException as e:
+        control.send((None, "error", (RuntimeError(f"{type(e).__name__}: {e}"), traceback.format_exc())))
+        return
+    control.send((None, "ok", None))
+
+    pending = deque()
+    children = {} # reader connection -> (request_id, pid)
+    pids = {} # request_id -> pid
+    stopping = False
+    while not (stopping and not pending and not children):
+        for conn in wait([control, *children] if not stopping else list(children)):
+            if conn is control:
+                try:
+                    message = control.recv()
+                except EOFError:
+                    message = ("stop", None, None)
+                kind, request_id, args = message
+                if kind == "run":
+                    pending.append((request_id, args))
+                elif kind == "kill":
+                    if request_id in pids:
+                        os.kill(pids[request_id], signal.SIGKILL)
+                    else:
+                        for item in list(pending):
+                            if item[0] == request_id:
+                                pending.remove(item)
+                                control.send((request_id, "error", (TimeoutError("the request timed out in the queue"), "")))
+                elif kind == "stop":
+                    stopping = True
+            else:
+                request_id, pid = children.pop(conn)
+                pids.pop(request_id, None)
+                try:
+                    result = conn.recv()
+                except EOFError:
+                    result = None
+                conn.close()
+                _, status = os.waitpid(pid, 0)
+                if result is None:
+                    if os.WIFSIGNALED(status) and os.WTERMSIG(status) == signal.SIGKILL:
+                        error = TimeoutError("the request timed out and its worker was killed")
+                    else:
+                        error = RuntimeError(f"the worker of the request died, exit code {os.waitstatus_to_exitcode(status)}")
+                    result = ("error", (error, ""))
+                control.send((request_id, *result))
+
+        while pending and len(children) < workers:
+            request_id, args = pending.popleft()
+            reader, writer = mp.Pipe(duplex=False)
+            pid = os.fork()
+            if pid == 0:
+                reader.close()
+                _zygote_child(pipeline, writer, args, threshold)
+            writer.close()
+            children[reader] = (request_id, pid)
+            pids[request_id] = pid
+
+
+class ZygoteRunner:
+    """
+        Runs every request in its own process, like calling main.py once per request, without paying the imports and
+        the model loading each time: a zygote process imports the modules and loads the model once, then forks
+        a child per request. The children share the memory of the zygote copy-on-write, a request can not leak
+        state into the next one and a crash or a leak dies with its child.
+
+        Parameters:
+            factory: callable with no argument returning a loaded AbstractModel instance, called once in the zygote
+            pipeline: a loaded AbstractModel instance, inherited by the zygote instead of factory
+            preload: module names imported in the zygote before factory, e.g. ["torch", "settings", "matrix.neo"]
+            workers: number of children running at the same time, other requests wait in the zygote, default os.cpu_count()
+            shm_threshold: numpy outputs larger than this (bytes) are sent back through shared memory instead of the pipe
+            timeout: default seconds after which the child of a request is killed, None waits forever
+
+        NOTE: the zygote is forked (linux), create the runner before starting threads and before initializing cuda,
+                cuda can not be used in a forked child, load the model on cpu or use ProcessPoolRunner with "spawn"
+
+        Example Usage:
+            def factory():
+                from settings import configs
+                return Pipeline(load_model(config=configs), "cpu", "pt", **configs)
+
+            with ZygoteRunner(factory, preload=["torch", "settings"], workers=4) as runner:
+                outputs = runner.run(auto_file_loader(input_dir, INPUT_TYPES), preprocess_params, forward_params, postprocess_params)
+    """
+
+    def __init__(self, factory=None, pipeline=None, preload=(), workers=None, shm_threshold=1024*1024, timeout=None) -> None:
+        if (pipeline is None) == (factory is None):
+            raise RuntimeError("Exactly one of pipeline or factory must be given")
+        if "fork" not in mp.get_all_start_methods():
+            raise RuntimeError("ZygoteRunner needs the fork start method, it is not supported on this platform")
+        if is_torch_available() and torch.cuda.is_initialized():
+            logger.warning("cuda is initialized before forking the zygote, the forked children can not use it")
+
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self._futures = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+
+        context = mp.get_context("fork")
+        self._conn, child_conn = context.Pipe()
+        self._process = context.Process(
+            target=_zygote_main,
+            args=(child_conn, pipeline, factory, list(preload), self.workers, shm_threshold),
+            name="matrix-zygote",
+            daemon=True,
+        )
+        self._process.start()
+        child_conn.close()
+
+        _, status, payload = self._conn.recv()
+        if status != "ok":
+            self._process.join()
+            error, trace = payload
+            raise RuntimeError(f"The zygote failed to load the model: {error}\n{trace}")
+        logger.info(f"Started a zygote (pid {self._process.pid}) forking up to {self.workers} workers")
+
+        self._reader = threading.Thread(target=self._read, name="matrix-zygote-reader", daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        while True:
+            try:
+                request_id, status, payload = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                future, timer = self._futures.pop(request_id, (None, None))
+            if timer is not None:
+                timer.cancel()
+            if future is None:
+                continue
+            if status == "ok":
+                try:
+                    future.set_result(_from_shared(payload))
+                except Exception as e:
+                    future.set_exception(e)
+            else:
+                error, trace = payload
+                if trace:
+                    logger.debug(f"request failed in the zygote worker->\n{trace}")
+                future.set_exception(error)
+
+        with self._lock:
+            futures, self._futures = self._futures, {}
+        for future, timer in futures.values():
+            if timer is not None:
+                timer.cancel()
+            future.set_exception(RuntimeError("The zygote process exited"))
+
+    def _send(self, message):
+        with self._lock:
+            self._conn.send(message)
+
+    def submit(self, inputs, preprocess_params, forward_params, postprocess_params, timeout=None):
+        """
+            Run a request in a new child of the zygote, same arguments as AbstractModel.run
+
+            Args:
+                timeout: seconds after which the child is killed and the future fails with TimeoutError,
+                    default is the timeout of the runner
+
+            Returns:
+                a future, future.result() returns the output of run()
+        """
+        if self._closed:
+            raise RuntimeError("The runner is shut down")
+        timeout = timeout if timeout is not None else self.timeout
+        request_id = next(self._ids)
+        future = Future()
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, self._send, args=(("kill", request_id, None),))
+            timer.daemon = True
+        with self._lock:
+            self._futures[request_id] = (future, timer)
+            self._conn.send(("run", request_id, (inputs, preprocess_params, forward_params, postprocess_params)))
+        if timer is not None:
+            timer.start()
+        return future
+
+    def run(self, inputs, preprocess_params, forward_params, postprocess_params, timeout=None):
+        return self.submit(inputs, preprocess_params, forward_params, postprocess_params, timeout=timeout).result()
+
+    def map(self, inputs_list, preprocess_params, forward_params, postprocess_params):
+        """
+            Run a list of inputs, each in its own child, returns the outputs in the same order
+        """
+        futures = [self.submit(inputs, preprocess_params, forward_params, postprocess_params) for inputs in inputs_list]
+        return [future.result() for future in futures]
+
+    def shutdown(self, wait=True):
+        """
+            the zygote exits after the submitted requests are done
+        """
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._send(("stop", None, None))
+        except (BrokenPipeError, OSError):
+            pass
+        if wait:
+            self._process.join()
+            self._reader.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
@@ -0,0 +1,45 @@
+import pytest
+import matrix.neo as neo
+import matrix.utils.loaders as loaders
+
+
+class EchoPipeline(neo.AbstractModel):
+    """
+        returns {"name": the name kwarg, "inputs": the inputs}, forward raises if the inputs have "fail"
+    """
+    def preprocess(self, inputs, **kwargs):
+        return inputs
+
+    def forward(self, inputs, **kwargs):
+        if "fail" in inputs:
+            raise ValueError(inputs["fail"])
+        return inputs
+
+    def post_process(self, outputs, **kwargs):
+        return {"name": self.kwargs.get("name", None), "inputs": outputs}
+
+
+@pytest.fixture
+def make_pipeline(monkeypatch):
+    """
+        AbstractModel needs one of the frameworks installed, framework="oth" runs without them
+    """
+    monkeypatch.setattr(neo, "is_sklearn_available", lambda: True)
+
+    def make(cls=EchoPipeline, device="cpu", framework="oth", **kwargs):
+        return cls(None, device, framework, **kwargs)
+    return make
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """
+        registrations of a test are dropped after it
+    """
+    monkeypatch.setattr(loaders, "_LOADERS", dict(loaders._LOADERS))
+    monkeypatch.setattr(loaders, "_EXTENSIONS", dict(loaders._EXTENSIONS))
+    monkeypatch.setattr(loaders, "_MIMETYPES", dict(loaders._MIMETYPES))
+    monkeypatch.setattr(loaders, "_MAGIC_BYTES", list(loaders._MAGIC_BYTES))
+    monkeypatch.setattr(loaders, "_MAGIC_READ_SIZE", loaders._MAGIC_READ_SIZE)
+    yield
+    loaders._type_from_extension.cache_clear()
@@ -0,0 +1,28 @@
+import os
+import pytest
+from matrix.manager.admin import generate_dockerfile, read_build_args, update_dockerfile
+
+
+def test_build_args_are_read_from_the_project_settings(tmp_path):
+    (tmp_path / "settings.py").write_text(
+        "import not_installed_module\n"
+        "FRAMEWORK = 'pt'\n"
+        "DOCKER_BUILD_ARGS = {'TORCH_VERSION': '2.3.1', 'TORCHVISION_VERSION': 0.18}\n"
+    )
+    assert read_build_args(str(tmp_path)) == {"TORCH_VERSION": "2.3.1", "TORCHVISION_VERSION": "0.18"}
+    assert read_build_args(str(tmp_path / "missing")) == {}
+
+
+def test_update_dockerfile_pins_the_settings(tmp_path):
+    (tmp_path / "settings.py").write_text("DOCKER_BUILD_ARGS = {'TORCH_VERSION': '2.3.1'}\n")
+    update_dockerfile(str(tmp_path), "pt")
+    dockerfile = (tmp_path / "Dockerfile").read_text()
+    assert "ARG TORCH_VERSION=2.3.1\n" in dockerfile
+    assert os.path.exists(tmp_path / ".dockerignore")
+    assert os.path.isdir(tmp_path / "weights")
+
+
+def test_unknown_build_args_are_rejected():
+    assert "ARG TF_VERSION=2.16.1" in generate_dockerfile("tf", {"TF_VERSION": "2.16.1"})
+    with pytest.raises(RuntimeError):
+        generate_dockerfile("tf", {"TORCH_VERSION": "2.3.1"})
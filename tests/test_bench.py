@@ -0,0 +1,44 @@
+import time
+from matrix.client.bench import percentile, print_report, run_benchmark
+from matrix.client.mock_server import start_mock_server
+from matrix.client.request import Client
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([3, 1, 2], 50) == 2
+    assert percentile([0, 10], 95) == 9.5
+
+
+def test_benchmark_against_the_mock_server(capsys):
+    server, uri = start_mock_server(task_duration=0.0)
+    try:
+        report = run_benchmark(Client("key", "a/repo", server_uri=uri), "a/repo", text="hi", requests=10, concurrency=4, poll_interval=0.01)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert report["error_rate"] == 0 and report["latency"]["count"] == 10
+    # no line per request
+    out = capsys.readouterr().out
+    assert "Request is Running" not in out
+    assert "Saved file to" not in out
+
+
+def test_rate_is_kept_when_requests_take_longer_than_the_interval():
+    server, uri = start_mock_server(latency=0.2, task_duration=0.0)
+    try:
+        start = time.perf_counter()
+        report = run_benchmark(Client("key", "a/repo", server_uri=uri), "a/repo", text="hi", requests=10, concurrency=10, rate=20, poll_interval=0.01, download=False)
+        duration = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert report["error_rate"] == 0
+    # 10 requests at 20/s start within 0.5s, each takes about 0.4s (call and status)
+    assert duration < 1.5
+
+
+def test_print_report_without_requests(capsys):
+    report = run_benchmark(Client("key", "a/repo", server_uri="http://127.0.0.1:9"), "a/repo", requests=0)
+    print_report(report)
+    assert "N/A" in capsys.readouterr().out
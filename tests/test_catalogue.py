@@ -0,0 +1,63 @@
+import json
+import pytest
+from matrix.client import catalogue
+from matrix.client.catalogue import RepoCatalogue, get_catalogue, iter_json_array
+from matrix.client.mock_server import start_mock_server
+
+
+REPOS = [{"repo_name": f"repo{i}", "author_username": "alice" if i % 2 else "bob"} for i in range(7)]
+
+
+@pytest.fixture
+def server_uri():
+    server, uri = start_mock_server(repos=REPOS)
+    yield uri
+    server.shutdown()
+    server.server_close()
+
+
+def test_pages_are_followed(server_uri):
+    repos = RepoCatalogue(server_uri, page_size=3)
+    assert repos.repos == REPOS
+    assert repos.get("alice/repo1") == REPOS[1]
+    assert [repo["repo_name"] for repo in repos.by_author("bob")] == ["repo0", "repo2", "repo4", "repo6"]
+
+
+def test_unchanged_lists_are_revalidated_with_the_etag(server_uri):
+    repos = RepoCatalogue(server_uri)
+    assert repos.refresh() is True
+    assert repos._etag
+    assert repos.refresh(force=True) is False
+    assert len(repos) == len(REPOS)
+
+
+@pytest.mark.parametrize("content", ['{"repos": [', '{"fetched_at": 0}', '{"repos": 1, "fetched_at": 0}'])
+def test_broken_disk_caches_are_a_miss(server_uri, tmp_path, content):
+    repos = RepoCatalogue(server_uri, cache_dir=str(tmp_path))
+    with open(repos.cache_path, "w") as f:
+        f.write(content)
+    assert repos.repos == REPOS
+    with open(repos.cache_path) as f:
+        assert json.load(f)["repos"] == REPOS
+
+
+def test_the_shared_catalogue_stays_in_memory_by_default(server_uri, monkeypatch):
+    monkeypatch.setattr(catalogue, "_CATALOGUES", {})
+    repos = get_catalogue(server_uri)
+    assert repos.cache_path is None
+    assert get_catalogue(server_uri) is repos
+    assert get_catalogue(server_uri, cache_dir=catalogue.CACHE_DIR) is not repos
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7])
+def test_json_arrays_are_decoded_across_chunks(size):
+    document = '[123, -4.5e2, "a,]\\u00e9", {"n": [1, 2]}, true, null, 67890]'.encode("utf-8")
+    chunks = [document[i:i + size] for i in range(0, len(document), size)]
+    assert list(iter_json_array(chunks)) == json.loads(document)
+
+
+def test_numbers_split_between_chunks_are_not_truncated():
+    assert list(iter_json_array([b"[12", b"3, 4", b"5]"])) == [123, 45]
+    assert list(iter_json_array([b"[4.", b"5, -1", b"e2 ", b"]"])) == [4.5, -100.0]
+    with pytest.raises(ValueError):
+        list(iter_json_array([b"[12"]))
@@ -0,0 +1,89 @@
+import pytest
+from matrix.client.mock_server import start_mock_server
+from matrix.client.request import Client
+from matrix.client.server import MODEL_BATCH_REQUEST_URI
+from matrix.utils.errors import HTTPError
+
+
+@pytest.fixture
+def mock_server():
+    servers = []
+
+    def start(**state_kwargs):
+        server, uri = start_mock_server(**state_kwargs)
+        servers.append(server)
+        return server.RequestHandlerClass.state, uri
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_call_many_splits_the_inputs_in_batches(mock_server):
+    state, uri = mock_server()
+    handles = Client("key", "repo", server_uri=uri).call_many("a/repo", [{"text": str(i)} for i in range(35)], max_batch_items=10)
+    assert [handle.index for handle in handles] == list(range(35))
+    assert all(handle.ok for handle in handles)
+    assert len({handle.task_id for handle in handles}) == 35
+    assert state.submissions == {"single": 0, "batch": 4}
+
+
+def test_batches_too_large_for_the_server_are_halved(mock_server):
+    state, uri = mock_server(max_batch_items=10)
+    handles = Client("key", "repo", server_uri=uri).call_many("a/repo", [{"text": str(i)} for i in range(35)], max_batch_items=20)
+    assert all(handle.ok for handle in handles)
+    assert len({handle.task_id for handle in handles}) == 35
+    assert state.submissions["single"] == 0
+
+
+@pytest.mark.parametrize("status_code", [404, 405])
+def test_halves_without_the_batch_endpoint_get_single_calls(mock_server, status_code):
+    state, uri = mock_server()
+    client = Client("key", "repo", server_uri=uri)
+    submit = client._submit
+    batch_sizes = []
+
+    def flaky_submit(path, data, **kwargs):
+        # too large first, then the endpoint disappears after the first half was accepted
+        if path == MODEL_BATCH_REQUEST_URI:
+            batch_sizes.append(len(data["requests"]))
+            if len(batch_sizes) == 1:
+                raise HTTPError("too large", 413)
+            if len(batch_sizes) == 3:
+                raise HTTPError("gone", status_code)
+        return submit(path, data, **kwargs)
+
+    client._submit = flaky_submit
+    handles = client.call_many("a/repo", [{"text": str(i)} for i in range(10)], max_batch_items=10)
+    assert batch_sizes == [10, 5, 5]
+    assert all(handle.ok for handle in handles)
+    assert len({handle.task_id for handle in handles}) == 10
+    # every item is submitted once
+    assert state.submissions == {"single": 5, "batch": 1}
+
+
+def test_servers_without_the_batch_endpoint_get_single_calls(mock_server):
+    state, uri = mock_server(batching=False)
+    client = Client("key", "repo", server_uri=uri)
+    handles = client.call_many("a/repo", [{"text": str(i)} for i in range(12)], max_batch_items=5)
+    assert all(handle.ok for handle in handles)
+    assert client.batch_supported is False
+    assert state.submissions == {"single": 12, "batch": 0}
+
+
+def test_failed_items_carry_the_error(mock_server):
+    state, uri = mock_server(error_rate=1.0)
+    client = Client("key", "repo", server_uri=uri)
+    with pytest.raises(RuntimeError):
+        client.call_many("a/repo", [{"text": "x"}])
+    handles = client.call_many("a/repo", [{"text": "x"}, {"text": "y"}], raise_on_error=False)
+    assert not any(handle.ok for handle in handles)
+    assert "500" in handles[0].error
+
+
+def test_http_errors_carry_the_status_code(mock_server):
+    state, uri = mock_server()
+    with pytest.raises(HTTPError) as error:
+        Client("key", "repo", server_uri=uri)._submit("/missing/", {})
+    assert error.value.status_code == 404
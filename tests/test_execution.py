@@ -0,0 +1,75 @@
+import os
+import sys
+import types
+import pytest
+from matrix.utils.execution import CompiledModel
+from conftest import EchoPipeline
+
+
+class _DynamoError(Exception):
+    pass
+
+
+@pytest.fixture
+def dynamo(monkeypatch):
+    monkeypatch.setitem(sys.modules, "torch._dynamo.exc", types.SimpleNamespace(TorchDynamoException=_DynamoError))
+
+
+def _raise(error):
+    def call(*args, **kwargs):
+        raise error
+    return call
+
+
+def test_errors_of_the_inputs_are_raised_and_keep_the_compiled_model(dynamo):
+    model = CompiledModel(_raise(ValueError("bad input")), lambda x: ("eager", x), "torch_compile")
+    with pytest.raises(ValueError):
+        model(1)
+    assert model.is_compiled
+
+
+def test_compile_errors_fall_back_to_the_eager_model(dynamo):
+    model = CompiledModel(_raise(_DynamoError("backend failed")), lambda x: ("eager", x), "torch_compile")
+    assert model(1) == ("eager", 1)
+    assert not model.is_compiled
+
+
+def _count_forward_wrapper(pipeline, monkeypatch):
+    calls = []
+    original = pipeline._forward
+    monkeypatch.setattr(pipeline, "_forward", lambda inputs, **params: calls.append(inputs) or original(inputs, **params))
+    return calls
+
+
+def test_run_calls_forward_directly_by_default(make_pipeline, monkeypatch):
+    pipeline = make_pipeline()
+    calls = _count_forward_wrapper(pipeline, monkeypatch)
+    assert pipeline.run({"x": 1}, {}, {}, {})["inputs"] == {"x": 1}
+    assert list(pipeline.run({"x": 2}, {}, {}, {}, stream=True))[0]["inputs"] == {"x": 2}
+    assert not pipeline.execution_modes_enabled
+    assert calls == []
+
+
+def test_run_goes_through_forward_wrapper_with_execution_modes(make_pipeline, monkeypatch):
+    pipeline = make_pipeline(precision="bf16")
+    calls = _count_forward_wrapper(pipeline, monkeypatch)
+    assert pipeline.run({"x": 1}, {}, {}, {})["inputs"] == {"x": 1}
+    pipeline.warm_up({"x": 2}, iterations=1, batch_sizes=[1])
+    assert calls == [{"x": 1}, {"x": 2}]
+
+
+class WritingPipeline(EchoPipeline):
+    def post_process(self, outputs, **kwargs):
+        self.output_writer.write_text(f"{outputs['name']}.txt", "done")
+        return outputs
+
+
+def test_warm_up_does_not_redirect_concurrent_runs(make_pipeline, tmp_path):
+    output_dir = str(tmp_path / "results")
+    pipeline = make_pipeline(WritingPipeline, output_dir=output_dir, warmup_iterations=50)
+    thread = pipeline.warm_up({"name": "warmup"}, background=True)
+    for i in range(20):
+        pipeline.run({"name": f"request-{i}"}, {}, {}, {})
+    thread.join()
+    assert pipeline.kwargs["output_dir"] == output_dir
+    assert sorted(os.listdir(output_dir)) == sorted(f"request-{i}.txt" for i in range(20))
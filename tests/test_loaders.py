@@ -0,0 +1,71 @@
+import json
+import numpy as np
+import pytest
+from matrix.utils.loaders import auto_file_loader, get_file_type, register_loader, register_type
+
+
+def _write(path, content):
+    path.write_bytes(content)
+    return str(path)
+
+
+@pytest.mark.parametrize("name, type_", [
+    ("a.txt", "text"), ("a.JSON", "json"), ("a.png", "image"), ("a.pdf", "pdf"),
+    ("a.npy", "npy"), ("a.npz", "npz"), ("a.safetensors", "safetensors"),
+])
+def test_types_from_the_extension(tmp_path, name, type_):
+    assert get_file_type(_write(tmp_path / name, b"")) == type_
+
+
+@pytest.mark.parametrize("content, type_", [
+    (b"\x89PNG\r\n\x1a\n....", "image"), (b"\xff\xd8\xff\xe0", "image"), (b"%PDF-1.7", "pdf"),
+    (b"RIFF\x00\x00\x00\x00WAVEfmt ", "audio"), (b"\x00\x00\x00\x18ftypmp42", "video"),
+    (b"\x93NUMPY\x01\x00", "npy"), (b"PAR1", "parquet"), (b"nothing known", "octet-stream"),
+])
+def test_unknown_extensions_are_sniffed(tmp_path, content, type_):
+    assert get_file_type(_write(tmp_path / "upload", content)) == type_
+
+
+def test_the_extension_wins_over_the_magic_bytes(tmp_path):
+    assert get_file_type(_write(tmp_path / "a.txt", b"%PDF-1.7")) == "text"
+
+
+def _rows_loader(path, **options):
+    with open(path) as f:
+        return f.read().split(",")
+
+
+def test_registered_loaders_are_used(tmp_path, registry):
+    register_loader("rows", _rows_loader, extensions=["rows"], extend=True)
+    register_type("blob", magic=[(32, b"BLOB")])
+    _write(tmp_path / "a.rows", b"1,2,3")
+    _write(tmp_path / "data", b"\x00" * 32 + b"BLOB")
+    _write(tmp_path / "a.json", json.dumps({"a": 1}).encode())
+
+    assert get_file_type(str(tmp_path / "data")) == "blob"
+    data = auto_file_loader(str(tmp_path), ["rows", "json", "generic"])
+    assert data["rows"] == ["1", "2", "3"]
+    assert data["json"] == [{"a": 1}]
+    # a type without a loader comes back as its path with "generic"
+    assert data["blob"] == [str(tmp_path / "data")]
+
+
+def test_registered_mimetypes_are_used(tmp_path, registry):
+    assert get_file_type(_write(tmp_path / "a.csv", b"a,b")) == "text"
+    register_type("table", mimetypes_=["text/csv"])
+    assert get_file_type(str(tmp_path / "a.csv")) == "table"
+
+
+def test_only_requested_types_are_loaded(tmp_path):
+    _write(tmp_path / "a.txt", b"first\nline")
+    _write(tmp_path / ".hidden.txt", b"hidden")
+    _write(tmp_path / "a.json", b"{}")
+    np.save(tmp_path / "a.npy", np.zeros(2))
+    data = auto_file_loader(str(tmp_path), ["text"])
+    assert data == {"text": ["first line"]}
+    assert auto_file_loader(str(tmp_path), ["generic"]) == {"npy": [str(tmp_path / "a.npy")]}
+
+
+def test_loaders_must_be_callable(registry):
+    with pytest.raises(RuntimeError):
+        register_loader("broken", None)
@@ -0,0 +1,105 @@
+import json
+import logging
+import queue
+import sys
+import time
+from collections import OrderedDict
+import pytest
+import matrix.utils.logging as matrix_logging
+from matrix.utils.logging import JsonFormatter, RateLimitFilter, log_context
+
+
+def _record(msg="frame %d", args=(1,), level=logging.WARNING, name="matrix.test", exc_info=None):
+    return logging.LogRecord(name, level, "file.py", 12, msg, args, exc_info)
+
+
+def test_json_formatter_fields():
+    with log_context(request_id="r1", task_id="t1"):
+        entry = json.loads(JsonFormatter().format(_record()))
+    assert entry["level"] == "WARNING"
+    assert entry["logger"] == "matrix.test"
+    assert entry["message"] == "frame 1"
+    assert entry["file"] == "file.py:12"
+    assert (entry["request_id"], entry["task_id"]) == ("r1", "t1")
+    assert "T" in entry["time"]
+
+
+def test_json_formatter_exceptions():
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        record = _record(msg="failed", args=(), exc_info=sys.exc_info())
+    entry = json.loads(JsonFormatter().format(record))
+    assert "ValueError: boom" in entry["exception"]
+    assert "request_id" not in entry
+
+
+def test_rate_limit_suppresses_and_summarizes():
+    rate_filter = RateLimitFilter(rate=2, interval=0.2)
+    passed = [rate_filter.filter(_record(args=(i,))) for i in range(5)]
+    assert passed == [True, True, False, False, False]
+    assert rate_filter.suppressed == 3
+    # other messages and errors are not limited
+    assert rate_filter.filter(_record(msg="other"))
+    assert all(rate_filter.filter(_record(level=logging.ERROR)) for _ in range(5))
+
+    time.sleep(0.25)
+    record = _record(args=(5,))
+    assert rate_filter.filter(record)
+    assert record.getMessage() == "frame 5 (3 similar messages suppressed)"
+    record = _record(args=(6,))
+    assert rate_filter.filter(record)
+    assert record.getMessage() == "frame 6"
+
+
+def test_warning_once_keys_are_bounded(monkeypatch):
+    monkeypatch.setattr(matrix_logging, "_warning_once_keys", OrderedDict())
+    monkeypatch.setattr(matrix_logging, "WARNING_ONCE_MAXSIZE", 2)
+    logger = logging.getLogger("matrix.test.warning_once")
+    messages = []
+    monkeypatch.setattr(logger, "warning", lambda msg, *args, **kwargs: messages.append(msg % args))
+
+    for i in range(3):
+        logger.warning_once("frame %d was dropped", i, key="dropped")
+    logger.warning_once("plain")
+    logger.warning_once("plain")
+    assert messages == ["frame 0 was dropped", "plain"]
+    assert len(matrix_logging._warning_once_keys) == 2
+
+    logger.warning_once("third")
+    # the least recently seen key is forgotten
+    logger.warning_once("frame %d was dropped", 9, key="dropped")
+    assert messages[-1] == "frame 9 was dropped"
+    assert len(matrix_logging._warning_once_keys) == 2
+
+
+def test_async_records_are_formatted_when_logged():
+    handler = matrix_logging._AsyncQueueHandler(queue.Queue())
+    args = [1]
+    record = handler.prepare(_record(msg="args %s", args=(args,)))
+    args.append(2)
+    assert record.getMessage() == "args [1]"
+
+
+@pytest.mark.parametrize("rate_limit_first", [True, False])
+def test_rate_limit_applies_before_the_queue_in_both_orders(rate_limit_first):
+    matrix_logging._setup_library_root_logger()
+    root = matrix_logging._get_library_root_logger()
+    handlers = list(root.handlers)
+    rate_filter = None
+    try:
+        if rate_limit_first:
+            rate_filter = matrix_logging.add_rate_limit(rate=1)
+        matrix_logging.enable_async_handler()
+        if not rate_limit_first:
+            rate_filter = matrix_logging.add_rate_limit(rate=1)
+        assert root.handlers == [matrix_logging._queue_handler]
+        assert rate_filter in matrix_logging._queue_handler.filters
+        assert not any(rate_filter in handler.filters for handler in handlers)
+
+        matrix_logging.disable_async_handler()
+        assert root.handlers == handlers
+        assert all(rate_filter in handler.filters for handler in handlers)
+    finally:
+        matrix_logging.disable_async_handler()
+        matrix_logging.remove_filter(rate_filter)
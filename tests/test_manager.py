@@ -0,0 +1,89 @@
+import json
+import os
+import threading
+import time
+import types
+import pytest
+import matrix.manager.test as manager_test
+from matrix.utils.process import CommandResult
+
+
+class FakeDocker:
+    """
+        stands in for the docker cli, `docker exec` of a case takes `delay` seconds and fails for the cases in `failing`
+    """
+    def __init__(self, delay=0.1, failing=()):
+        self.delay = delay
+        self.failing = set(failing)
+        self.commands = []
+        self.cases = []
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def run(self, command, **kwargs):
+        self.commands.append(command[2])
+        return types.SimpleNamespace(returncode=0, stdout="container-id", stderr="")
+
+    def run_command(self, command, log_path=None, timeout=None, echo=True):
+        case = os.path.basename(command[command.index("--input_dir") + 1])
+        with self._lock:
+            self.cases.append(case)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        with self._lock:
+            self.running -= 1
+        returncode = 1 if case in self.failing else 0
+        return CommandResult(returncode, f"done {case}\nMATRIX_MAXRSS_KB 2048", "failed" if returncode else "", self.delay)
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    for case in ["a", "b", "c"]:
+        os.makedirs(tmp_path / "samples" / case)
+        (tmp_path / "samples" / case / "input.txt").write_text(f"text {case}")
+    docker = FakeDocker()
+    monkeypatch.setattr(manager_test, "run", docker.run)
+    monkeypatch.setattr(manager_test, "run_command", docker.run_command)
+    monkeypatch.setattr(manager_test, "_image_digest", lambda image: "sha256:1")
+    return str(tmp_path), docker
+
+
+def _test(cwd, **kwargs):
+    return manager_test.test_main(cwd, "repo:latest", "cpu", kwargs.pop("framework", "pt"), ["text"], **kwargs)
+
+
+def test_cases_run_concurrently_in_one_container(project):
+    cwd, docker = project
+    report = _test(cwd, workers=3)
+    assert docker.commands == ["run", "rm"]
+    assert sorted(docker.cases) == ["a", "b", "c"]
+    assert docker.max_running == 3
+    with open(os.path.join(cwd, "results", manager_test.REPORT_FILE)) as f:
+        assert json.load(f) == report
+    assert [case["case"] for case in report["cases"]] == ["a", "b", "c"]
+    assert all(case["passed"] and case["peak_memory_bytes"] == 2048 * 1024 for case in report["cases"])
+    assert report["cases"][0]["stdout"] == "done a"
+    assert report["throughput_cases_per_s"] > 0
+
+
+def test_cached_cases_depend_on_framework_and_transport(project):
+    cwd, docker = project
+    _test(cwd)
+    assert _test(cwd)["skipped"] == ["a", "b", "c"]
+    assert _test(cwd, framework="tf")["skipped"] == []
+    assert _test(cwd, transport="shm")["skipped"] == []
+    with open(os.path.join(cwd, "samples", "b", "input.txt"), "w") as f:
+        f.write("changed")
+    assert _test(cwd)["skipped"] == ["a", "c"]
+    assert _test(cwd, use_cache=False)["skipped"] == []
+
+
+def test_failed_cases_raise_and_are_not_cached(project):
+    cwd, docker = project
+    docker.failing = {"b"}
+    with pytest.raises(RuntimeError, match="case `b`"):
+        _test(cwd, workers=2)
+    docker.failing = set()
+    assert _test(cwd)["skipped"] == ["a", "c"]
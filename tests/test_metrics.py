@@ -0,0 +1,111 @@
+import re
+import subprocess
+import sys
+import threading
+import pytest
+from matrix.utils import metrics
+
+
+def test_modules_import_without_resource():
+    # the resource module does not exist on windows
+    code = "import sys; sys.modules['resource'] = None; import matrix.utils.loaders, matrix.client.request"
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_periodic_sink_logs_failures(monkeypatch):
+    failed = threading.Event()
+    logged = []
+
+    def sink():
+        if not failed.is_set():
+            failed.set()
+            raise OSError("disk full")
+
+    monkeypatch.setattr(metrics, "_enabled", metrics._enabled)
+    monkeypatch.setattr(metrics.logger, "exception", lambda message: logged.append(message))
+    periodic = metrics.PeriodicSink(sink, interval=0.01).start()
+    assert failed.wait(5)
+    periodic.stop()
+    assert logged
+
+
+def test_max_rss_is_in_bytes():
+    # any python process uses more than 1MB
+    assert metrics._max_rss_bytes() > 1024**2
+
+
+# name{labels} value, label values are quoted with \\, \" and \n escaped
+_SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{(?:[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\\n]|\\[\\"n])*",?)*\})? (\S+)$')
+
+
+def _parse(text):
+    """
+        checks every line of the exposition text, returns {(name, labels): value} and {name: (help, type)}
+    """
+    samples, families = {}, {}
+    assert text.endswith("\n")
+    for line in text.splitlines():
+        if line.startswith("# HELP "):
+            name, help_ = line[len("# HELP "):].split(" ", 1)
+            families.setdefault(name, [None, None])[0] = help_
+        elif line.startswith("# TYPE "):
+            name, kind = line[len("# TYPE "):].split(" ")
+            assert kind in ["counter", "gauge", "histogram"]
+            families.setdefault(name, [None, None])[1] = kind
+        else:
+            match = _SAMPLE.match(line)
+            assert match, line
+            samples[(match.group(1), match.group(2) or "")] = float(match.group(3))
+    return samples, families
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(metrics, "_enabled", True)
+    return metrics.MetricsRegistry()
+
+
+def test_exposition_format(registry):
+    requests = registry.counter("app_requests", "Requests\nserved", ["path"])
+    requests.labels(path='/a"b\\c\n').inc()
+    requests.labels(path="/").inc(2)
+    registry.gauge("app_depth", "Queue depth").set(3)
+    samples, families = _parse(registry.generate_latest())
+    assert families == {"app_requests": ["Requests\\nserved", "counter"], "app_depth": ["Queue depth", "gauge"]}
+    assert samples[("app_requests_total", '{path="/a\\"b\\\\c\\n"}')] == 1
+    assert samples[("app_requests_total", '{path="/"}')] == 2
+    assert samples[("app_depth", "")] == 3
+
+
+def test_histogram_buckets_accumulate(registry):
+    latency = registry.histogram("app_seconds", "Latency", ["stage"], buckets=(0.1, 1.0))
+    for value in [0.05, 0.1, 0.5, 2.0]:
+        latency.labels(stage="forward").observe(value)
+    latency.labels(stage="forward").observe(0.5)
+    samples, families = _parse(registry.generate_latest())
+    assert families["app_seconds"][1] == "histogram"
+    buckets = {labels: value for (name, labels), value in samples.items() if name == "app_seconds_bucket"}
+    assert buckets == {
+        '{stage="forward",le="0.1"}': 2,
+        '{stage="forward",le="1.0"}': 4,
+        '{stage="forward",le="+Inf"}': 5,
+    }
+    assert samples[("app_seconds_sum", '{stage="forward"}')] == pytest.approx(3.15)
+    assert samples[("app_seconds_count", '{stage="forward"}')] == 5
+
+
+def test_registering_a_name_again_returns_the_same_metric(registry):
+    counter = registry.counter("app_total_errors", "Errors", ["kind"])
+    assert registry.counter("app_total_errors", "Errors", ["kind"]) is counter
+    with pytest.raises(RuntimeError):
+        registry.gauge("app_total_errors", "Errors")
+    # modules imported twice (e.g. reloaded) get the metric of the first import
+    from matrix.neo import RUN_TOTAL
+    assert metrics.counter("matrix_pipeline_runs", "Calls of AbstractModel.run", ["status"]) is RUN_TOTAL
+
+
+def test_updates_are_ignored_when_disabled(registry, monkeypatch):
+    counter = registry.counter("app_calls", "Calls")
+    monkeypatch.setattr(metrics, "_enabled", False)
+    counter.inc()
+    assert "app_calls_total 0" in registry.generate_latest()
@@ -0,0 +1,64 @@
+import os
+import threading
+import time
+import matrix.utils.onnx_runtime as onnx_runtime
+from matrix.pool import _replica_memory
+
+
+def _fake_quantize(calls):
+    def quantize_dynamic(model_path, output_path, weight_type="int8"):
+        calls.append(output_path)
+        with open(output_path, "wb") as f:
+            f.write(b"q")
+            # a reader must never see the file before it is complete
+            time.sleep(0.05)
+            f.write(b"uantized")
+        return output_path
+    return quantize_dynamic
+
+
+def test_concurrent_loads_quantize_once(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(onnx_runtime, "quantize_dynamic", _fake_quantize(calls))
+    path = str(tmp_path / "model.onnx")
+    with open(path, "wb") as f:
+        f.write(b"original")
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(onnx_runtime.ensure_quantized(path, True))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [str(tmp_path / "model.int8.onnx")] * 4
+    assert len(calls) == 1
+    assert sorted(os.listdir(tmp_path)) == ["model.int8.onnx", "model.onnx"]
+    with open(results[0], "rb") as f:
+        assert f.read() == b"quantized"
+
+
+def test_stale_quantized_files_are_rebuilt(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(onnx_runtime, "quantize_dynamic", _fake_quantize(calls))
+    path = str(tmp_path / "model.onnx")
+    with open(path, "wb") as f:
+        f.write(b"original")
+    assert onnx_runtime.ensure_quantized(path, False) == path
+    output_path = onnx_runtime.ensure_quantized(path, "uint8")
+    assert output_path.endswith("model.uint8.onnx")
+    os.utime(output_path, (0, 0))
+    onnx_runtime.ensure_quantized(path, "uint8")
+    assert len(calls) == 2
+
+
+class _Session:
+    def __init__(self, path):
+        self.path = path
+
+
+def test_onnx_memory_is_the_size_of_the_loaded_file(tmp_path):
+    path = tmp_path / "model.int8.onnx"
+    path.write_bytes(b"x" * 10)
+    assert _replica_memory(_Session(str(path)), "onnx", -1) == (10, {})
+    assert _replica_memory(_Session(str(path)), "onnx", 1) == (0, {"gpu:1": 10})
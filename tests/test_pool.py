@@ -0,0 +1,65 @@
+import threading
+import numpy as np
+import matrix.pool as pool_module
+from matrix.pool import ModelPool, estimate_model_memory
+
+
+class _Weights:
+    def __init__(self, nbytes):
+        self.weights = np.zeros(nbytes, dtype=np.uint8)
+
+
+def _pipeline(make_pipeline, nbytes):
+    pipeline = make_pipeline()
+    pipeline.model = _Weights(nbytes)
+    return pipeline
+
+
+def test_memory_is_summed_over_replicas(make_pipeline):
+    pipeline = make_pipeline()
+    pipeline.replicas = [_Weights(100), _Weights(50)]
+    pipeline.devices = [-1, -1]
+    assert estimate_model_memory(pipeline) == (150, {})
+    pipeline.replicas = [pipeline.replicas[0]] * 2
+    assert estimate_model_memory(pipeline) == (100, {})
+
+
+def test_least_recently_used_model_is_evicted(make_pipeline):
+    pool = ModelPool(host_memory_budget=250)
+    for name in ["a", "b", "c"]:
+        pool.register(name, lambda: _pipeline(make_pipeline, 100))
+    a = pool.get("a")
+    pool.get("b")
+    assert pool.get("a") is a
+    pool.get("c")
+    assert pool.resident() == ["a", "c"]
+    assert pool.memory_usage() == {"host": 200, "devices": {}}
+
+
+def test_only_models_using_the_memory_over_budget_are_evicted(make_pipeline, monkeypatch):
+    memory = {"host": (10, {}), "gpu": (10, {"gpu:0": 80}), "gpu2": (10, {"gpu:0": 80})}
+    monkeypatch.setattr(pool_module, "estimate_model_memory", lambda pipeline: memory[pipeline.kwargs["name"]])
+    pool = ModelPool(device_memory_budget={"gpu:0": 100})
+    for name in memory:
+        pool.register(name, lambda name=name: make_pipeline(name=name))
+        pool.get(name)
+    # "host" is the least recently used, but it does not use gpu:0
+    assert pool.resident() == ["host", "gpu2"]
+
+
+def test_get_never_returns_none_under_concurrent_eviction(make_pipeline):
+    pool = ModelPool(host_memory_budget=150)
+    for name in ["a", "b"]:
+        pool.register(name, lambda: _pipeline(make_pipeline, 100))
+    results = []
+
+    def worker(name):
+        for _ in range(50):
+            results.append(pool.get(name))
+
+    threads = [threading.Thread(target=worker, args=(name,)) for name in ["a", "b", "a", "b"]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 200 and all(result is not None for result in results)
@@ -0,0 +1,140 @@
+import numpy as np
+import pytest
+from conftest import EchoPipeline
+from matrix.preprocessing import BufferArena, batch_images, bucket_indices, pad_images, pad_sequences, stack_into
+
+
+def test_buffers_are_reused_across_scopes():
+    arena = BufferArena()
+    with arena.scope():
+        first = arena.acquire((2, 3))
+    with arena.scope():
+        assert arena.acquire((2, 3)) is first
+        # the buffer is in use until the end of the scope
+        assert arena.acquire((2, 3)) is not first
+
+
+def test_buffers_are_keyed_by_shape_and_dtype():
+    arena = BufferArena()
+    with arena.scope():
+        buffer = arena.acquire((2, 3), "float32")
+    with arena.scope():
+        assert arena.acquire((3, 2), "float32") is not buffer
+        assert arena.acquire((2, 3), "int64") is not buffer
+        assert arena.acquire((2, 3), np.float32) is buffer
+
+
+def test_buffers_are_released_when_the_scope_raises():
+    arena = BufferArena()
+    with pytest.raises(ValueError):
+        with arena.scope():
+            buffer = arena.acquire((4,))
+            raise ValueError("preprocess failed")
+    with arena.scope():
+        assert arena.acquire((4,)) is buffer
+
+
+def test_untracked_buffers_and_the_byte_limit():
+    arena = BufferArena(max_bytes=16)
+    with arena.scope():
+        kept = arena.acquire((4,), "float32", track=False)
+        large = arena.acquire((8,), "float32")
+    with arena.scope():
+        assert arena.acquire((4,), "float32") is not kept
+        # larger than max_bytes, left to the garbage collector
+        assert arena.acquire((8,), "float32") is not large
+        arena.release(kept)
+        assert arena.acquire((4,), "float32") is kept
+
+
+def test_pad_sequences_values_and_lengths():
+    batch, lengths = pad_sequences([[1, 2, 3], [4], []], pad_value=-1)
+    assert batch.tolist() == [[1, 2, 3], [4, -1, -1], [-1, -1, -1]]
+    assert lengths.tolist() == [3, 1, 0]
+    mask = np.arange(batch.shape[1]) < lengths[:, None]
+    assert mask.tolist() == [[True, True, True], [True, False, False], [False, False, False]]
+
+    batch, lengths = pad_sequences([[1, 2, 3], [4]], max_length=2)
+    assert batch.tolist() == [[1, 2], [4, 0]]
+    assert lengths.tolist() == [2, 1]
+
+
+def test_padded_buffers_from_the_arena_are_filled_again():
+    arena = BufferArena()
+    with arena.scope():
+        batch, _ = pad_sequences([[7, 7], [7, 7]], arena=arena)
+    with arena.scope():
+        reused, _ = pad_sequences([[1], [2, 3]], arena=arena)
+        assert reused is batch
+        assert reused.tolist() == [[1, 0], [2, 3]]
+
+
+def test_batch_images_normalizes_into_the_layout():
+    images = [np.full((2, 3, 3), 255, dtype=np.uint8), np.zeros((2, 3, 3), dtype=np.uint8)]
+    batch = batch_images(images, mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5))
+    assert batch.shape == (2, 3, 2, 3) and batch.dtype == np.float32
+    np.testing.assert_allclose(batch[0], 1.0)
+    np.testing.assert_allclose(batch[1], -1.0)
+    assert batch_images(images, layout="NHWC", scale=1).shape == (2, 2, 3, 3)
+
+
+def test_batch_images_reuses_the_arena_buffers():
+    arena = BufferArena()
+    images = [np.ones((2, 2, 3), dtype=np.uint8)] * 3
+    with arena.scope():
+        batch = batch_images(images, arena=arena)
+    with arena.scope():
+        assert batch_images(images, arena=arena) is batch
+
+
+def test_stack_and_pad_images():
+    batch = stack_into([np.ones(2), np.zeros(2)])
+    assert batch.tolist() == [[1, 1], [0, 0]]
+    padded = pad_images([np.ones((1, 2, 1), dtype=np.uint8)], size=(2, 3))
+    assert padded[0, :, :, 0].tolist() == [[1, 1, 0], [0, 0, 0]]
+    with pytest.raises(RuntimeError):
+        pad_images([np.ones((3, 3), dtype=np.uint8)], size=(2, 2))
+
+
+def test_bucket_indices_groups_by_the_smallest_boundary():
+    items = ["abcdef", "a", "abc", "ab", "abcdefghij"]
+    assert bucket_indices(items, [2, 4, 8]) == [(2, [1, 3]), (4, [2]), (8, [0]), (10, [4])]
+    assert bucket_indices([], [2, 4]) == []
+
+
+def test_bucket_indices_of_images():
+    images = [np.zeros((30, 10)), np.zeros((10, 10)), np.zeros((40, 50))]
+    assert bucket_indices(images, [(16, 16), (32, 32)]) == [((16, 16), [1]), ((32, 32), [0]), ((40, 50), [2])]
+
+
+class BucketPipeline(EchoPipeline):
+    def preprocess(self, inputs, bucket_size=None, **kwargs):
+        self.calls.append((bucket_size, list(inputs["text"])))
+        return inputs, bucket_size
+
+    def forward(self, inputs, **kwargs):
+        return inputs
+
+    def post_process(self, outputs, **kwargs):
+        inputs, bucket_size = outputs
+        return [(text, bucket_size) for text in inputs["text"]]
+
+
+def test_run_bucketed_keeps_the_order_of_the_inputs(make_pipeline):
+    pipeline = make_pipeline(BucketPipeline, bucket_key="text", bucket_boundaries=[2, 4])
+    pipeline.calls = []
+    texts = ["abc", "a", "abcdefg", "ab", "abcd"]
+    outputs = pipeline.run_bucketed({"text": texts}, {}, {}, {})
+    assert [text for text, _ in outputs] == texts
+    # longer than the largest boundary, run in a last bucket of their own size
+    assert [size for _, size in outputs] == [4, 2, 7, 2, 4]
+    assert pipeline.calls == [(2, ["a", "ab"]), (4, ["abc", "abcd"]), (7, ["abcdefg"])]
+
+
+def test_run_bucketed_without_items(make_pipeline):
+    pipeline = make_pipeline(BucketPipeline)
+    pipeline.calls = []
+    assert pipeline.run_bucketed({"text": []}, {}, {}, {}, key="text", boundaries=[4]) == []
+    assert pipeline.calls == []
+    with pytest.raises(RuntimeError):
+        pipeline.run_bucketed({"other": ["a"]}, {}, {}, {}, key="text", boundaries=[4])
@@ -0,0 +1,58 @@
+import asyncio
+import os
+import sys
+import time
+import pytest
+from matrix.utils.process import run_command, run_command_async
+
+
+posix_only = pytest.mark.skipif(os.name != "posix", reason="needs a posix shell")
+
+
+def test_run_command_reads_both_streams():
+    result = run_command([sys.executable, "-c", "import sys; print('out'); print('err', file=sys.stderr)"], echo=False)
+    assert result.ok
+    assert result.stdout == "out"
+    assert result.stderr == "err"
+    assert sorted(name for _, name, _ in result.lines) == ["stderr", "stdout"]
+
+
+def test_run_command_reads_long_lines():
+    result = run_command([sys.executable, "-c", "print('x' * 200000)"], echo=False)
+    assert result.stdout == "x" * 200000
+
+
+@posix_only
+def test_timeout_kills_the_children_of_a_shell():
+    start = time.monotonic()
+    result = run_command("sleep 4 | cat", timeout=1, echo=False)
+    assert time.monotonic() - start < 3
+    assert result.timed_out
+    assert not result.ok
+
+
+@posix_only
+def test_timeout_keeps_the_output_read_so_far():
+    result = run_command("echo first; sleep 4", timeout=1, echo=False)
+    assert result.timed_out
+    assert result.stdout == "first"
+
+
+@posix_only
+def test_cancelling_kills_the_command():
+    async def main():
+        task = asyncio.ensure_future(run_command_async("sleep 4 | cat", echo=False))
+        await asyncio.sleep(0.3)
+        task.cancel()
+        start = time.monotonic()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return time.monotonic() - start
+    assert asyncio.run(main()) < 3
+
+
+def test_log_file_has_every_line(tmp_path):
+    log_path = tmp_path / "command.log"
+    run_command([sys.executable, "-c", "print('a'); print('b')"], log_path=str(log_path), echo=False)
+    lines = log_path.read_text().splitlines()
+    assert [line.split("] ", 2)[-1] for line in lines] == ["a", "b"]
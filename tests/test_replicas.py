@@ -0,0 +1,92 @@
+import threading
+import pytest
+from conftest import EchoPipeline
+
+
+class DevicePipeline(EchoPipeline):
+    """
+        returns the device of the replica that ran forward, blocks in forward while inputs["wait"] is not set
+    """
+    def forward(self, inputs, **kwargs):
+        if "wait" in inputs:
+            inputs["started"].set()
+            inputs["wait"].wait(5)
+        return super().forward(inputs, **kwargs)
+
+    def post_process(self, outputs, **kwargs):
+        return self.device
+
+
+def _devices(pipeline, n):
+    return [pipeline.run({"x": i}, {}, {}, {}) for i in range(n)]
+
+
+@pytest.fixture
+def busy():
+    """
+        runs a request in a thread and keeps its replica busy until the end of the test
+    """
+    release = threading.Event()
+    threads = []
+
+    def hold(pipeline):
+        started = threading.Event()
+        thread = threading.Thread(target=pipeline.run, args=({"wait": release, "started": started}, {}, {}, {}))
+        thread.start()
+        threads.append(thread)
+        assert started.wait(5)
+
+    yield hold
+    release.set()
+    for thread in threads:
+        thread.join()
+
+
+def test_round_robin_cycles_over_the_devices(make_pipeline, busy):
+    pipeline = make_pipeline(DevicePipeline, device=[0, 1, 2])
+    assert _devices(pipeline, 4) == [0, 1, 2, 0]
+    busy(pipeline)
+    # the busy replica is not skipped
+    assert _devices(pipeline, 3) == [2, 0, 1]
+
+
+def test_least_loaded_picks_the_replica_with_fewest_requests(make_pipeline, busy):
+    pipeline = make_pipeline(DevicePipeline, device=[0, 1, 2], device_scheduling="least_loaded")
+    busy(pipeline)
+    assert pipeline._in_flight == [1, 0, 0]
+    assert _devices(pipeline, 3) == [1, 1, 1]
+    busy(pipeline)
+    assert _devices(pipeline, 2) == [2, 2]
+
+
+def test_the_replica_is_released_when_forward_raises(make_pipeline):
+    pipeline = make_pipeline(DevicePipeline, device=[0, 1])
+    for _ in range(3):
+        with pytest.raises(ValueError):
+            pipeline.run({"fail": "boom"}, {}, {}, {})
+    assert pipeline._in_flight == [0, 0]
+    assert getattr(pipeline._local, "replica", None) is None
+    assert pipeline.device == 0
+
+
+def test_nested_scopes_keep_the_outer_replica(make_pipeline):
+    pipeline = make_pipeline(DevicePipeline, device=[0, 1])
+    with pipeline.replica_scope() as outer:
+        with pipeline.replica_scope() as inner:
+            assert inner == outer
+        assert pipeline._in_flight[outer] == 1
+    assert pipeline._in_flight == [0, 0]
+
+
+def test_parallel_run_keeps_the_order(make_pipeline):
+    pipeline = make_pipeline(device=[0, 1, 2])
+    outputs = pipeline.parallel_run([{"i": i} for i in range(9)], {}, {}, {})
+    assert [output["inputs"]["i"] for output in outputs] == list(range(9))
+    assert pipeline._in_flight == [0, 0, 0]
+
+
+def test_unknown_scheduling_is_rejected(make_pipeline):
+    with pytest.raises(RuntimeError):
+        make_pipeline(device=[0, 1], device_scheduling="random")
+    with pytest.raises(RuntimeError):
+        make_pipeline(device=[])
@@ -0,0 +1,65 @@
+import pytest
+import matrix.manager.test as manager_test
+from matrix.manager.test import _parse_requirement_line, find_missing_requirements
+
+
+@pytest.mark.parametrize("line, expected", [
+    ("numpy>=1.20", ("numpy", ">=1.20", None)),
+    ("Foo_Bar[extra1,extra2]==2.0  # pinned", ("Foo_Bar", "==2.0", None)),
+    ("git+https://github.com/org/repo.git@v1#egg=my-lib", ("my-lib", "", "git+https://github.com/org/repo.git@v1")),
+    ("-e git+https://github.com/org/repo.git#egg=my_lib", ("my_lib", "", "git+https://github.com/org/repo.git")),
+    ("--editable=git+https://github.com/org/repo.git#egg=lib", ("lib", "", "git+https://github.com/org/repo.git")),
+    ('torch; python_version < "3"', ("torch", "", None)),
+])
+def test_requirement_lines(line, expected):
+    requirement = _parse_requirement_line(line)
+    assert (requirement.name, str(requirement.specifier), requirement.url) == expected
+
+
+@pytest.mark.parametrize("line", ["", "   ", "# a comment", "-r other.txt", "--index-url https://example.com/simple", "--no-binary :all:"])
+def test_comments_and_options_are_skipped(line):
+    assert _parse_requirement_line(line) is None
+
+
+def test_paths_without_a_name_are_kept_as_is():
+    assert _parse_requirement_line("./libs/local_package") == "./libs/local_package"
+
+
+def test_extras_are_parsed():
+    assert _parse_requirement_line("Foo_Bar[extra1,extra2]==2.0").extras == {"extra1", "extra2"}
+
+
+@pytest.fixture
+def installed(monkeypatch):
+    monkeypatch.setattr(manager_test, "_installed_distributions", lambda: {"foo-bar": "2.0", "numpy": "1.19.0", "my-lib": "0.1"})
+
+
+def _missing(tmp_path, *lines):
+    path = tmp_path / "requirements.txt"
+    path.write_text("\n".join(lines))
+    return find_missing_requirements(str(path))
+
+
+@pytest.mark.parametrize("line", ["Foo_Bar==2.0", "foo.bar>=1", "FOO-BAR[extra]", "-e git+https://github.com/org/repo.git#egg=My_Lib"])
+def test_installed_names_are_normalized(tmp_path, installed, line):
+    assert _missing(tmp_path, line) == []
+
+
+def test_missing_and_mismatched_requirements(tmp_path, installed):
+    missing = _missing(
+        tmp_path,
+        "# requirements",
+        "numpy>=1.20",
+        "foo_bar==2.0",
+        'never-installed; python_version < "3"',
+        'win-only; sys_platform == "nonexistent"',
+        "git+https://github.com/org/other.git#egg=other",
+        "--extra-index-url https://example.com/simple",
+        "requests-new",
+    )
+    assert missing == ["numpy>=1.20", "other @ git+https://github.com/org/other.git", "requests-new"]
+
+
+def test_empty_requirement_files_are_rejected(tmp_path, installed):
+    with pytest.raises(RuntimeError):
+        _missing(tmp_path)
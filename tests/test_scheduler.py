@@ -0,0 +1,97 @@
+import threading
+import time
+import pytest
+from matrix.scheduler import Scheduler
+from matrix.utils.errors import DeadlineExceeded, RequestRejected
+from conftest import EchoPipeline
+
+
+class BlockingPipeline(EchoPipeline):
+    """
+        forward waits for the gate, so the queue fills up deterministically
+    """
+    def init_gate(self):
+        self.gate = threading.Event()
+        self.started = threading.Event()
+        self.forwarded = []
+
+    def forward(self, inputs, **kwargs):
+        self.started.set()
+        self.gate.wait(5)
+        self.forwarded.append(inputs["id"])
+        return inputs
+
+
+@pytest.fixture
+def blocked(make_pipeline):
+    pipeline = make_pipeline(BlockingPipeline)
+    pipeline.init_gate()
+    scheduler = Scheduler(pipeline, workers=1, max_queue=2)
+    running = scheduler.submit({"id": "running"}, {}, {}, {})
+    assert pipeline.started.wait(5)
+    yield pipeline, scheduler, running
+    pipeline.gate.set()
+    scheduler.shutdown()
+
+
+def _error(future):
+    try:
+        future.result(5)
+    except Exception as e:
+        return type(e)
+    return None
+
+
+def test_full_queue_rejects_requests_of_the_same_priority(blocked):
+    pipeline, scheduler, running = blocked
+    queued = [scheduler.submit({"id": i}, {}, {}, {}) for i in range(2)]
+    rejected = scheduler.submit({"id": "rejected"}, {}, {}, {})
+    assert rejected.done() and _error(rejected) is RequestRejected
+    pipeline.gate.set()
+    assert [_error(f) for f in queued] == [None, None]
+
+
+def test_higher_priority_sheds_the_lowest_queued_request(blocked):
+    pipeline, scheduler, running = blocked
+    normal = scheduler.submit({"id": "normal"}, {}, {}, {})
+    low = scheduler.submit({"id": "low"}, {}, {}, {}, priority="low")
+    high = scheduler.submit({"id": "high"}, {}, {}, {}, priority="high")
+    assert _error(low) is RequestRejected
+    pipeline.gate.set()
+    assert _error(high) is None and _error(normal) is None
+    assert pipeline.forwarded == ["running", "high", "normal"]
+
+
+def test_shedding_a_cancelled_request(blocked):
+    pipeline, scheduler, running = blocked
+    scheduler.submit({"id": "normal"}, {}, {}, {})
+    low = scheduler.submit({"id": "low"}, {}, {}, {}, priority="low")
+    assert low.cancel()
+    high = scheduler.submit({"id": "high"}, {}, {}, {}, priority="high")
+    pipeline.gate.set()
+    assert high.result(5)["inputs"]["id"] == "high"
+    assert low.cancelled()
+
+
+def test_expired_requests_are_dropped_before_forward(blocked):
+    pipeline, scheduler, running = blocked
+    expired = scheduler.submit({"id": "expired"}, {}, {}, {}, timeout=0.05)
+    time.sleep(0.1)
+    pipeline.gate.set()
+    assert _error(expired) is DeadlineExceeded
+    assert "expired" not in pipeline.forwarded
+
+
+def test_earliest_deadline_runs_first_inside_a_priority(blocked):
+    pipeline, scheduler, running = blocked
+    late = scheduler.submit({"id": "late"}, {}, {}, {}, timeout=60)
+    early = scheduler.submit({"id": "early"}, {}, {}, {}, timeout=30)
+    pipeline.gate.set()
+    late.result(5), early.result(5)
+    assert pipeline.forwarded == ["running", "early", "late"]
+
+
+def test_run_raises_deadline_exceeded_after_preprocess(make_pipeline):
+    pipeline = make_pipeline()
+    with pytest.raises(DeadlineExceeded):
+        pipeline.run({"id": 1}, {}, {}, {}, deadline=time.monotonic() - 1)
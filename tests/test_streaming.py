@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from matrix.client.mock_server import start_mock_server
+from matrix.client.request import Client
+from matrix.utils import tracing
+from matrix.utils.transport import read_payload
+from conftest import EchoPipeline
+
+
+class SpanCollector:
+    def __init__(self) -> None:
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+
+@pytest.fixture
+def spans():
+    collector = SpanCollector()
+    tracing.set_exporter(collector)
+    yield collector.spans
+    tracing.set_exporter(None)
+
+
+class TokenPipeline(EchoPipeline):
+    def preprocess(self, inputs, **kwargs):
+        buffer = self.buffer_arena.acquire((4,), "float32")
+        buffer[:] = 1
+        return {"tokens": inputs["tokens"], "buffer": buffer}
+
+    def forward(self, inputs, **kwargs):
+        for token in inputs["tokens"]:
+            # the preprocess buffer is still owned by this request while the tokens are generated
+            assert inputs["buffer"].sum() == 4
+            yield token
+
+    def post_process(self, outputs, **kwargs):
+        return outputs.upper()
+
+
+def test_run_stream_yields_each_chunk_and_releases_buffers(make_pipeline, spans):
+    pipeline = make_pipeline(TokenPipeline)
+    assert list(pipeline.run({"tokens": ["a", "b", "c"]}, {}, {}, {}, stream=True)) == ["A", "B", "C"]
+    assert pipeline.buffer_arena._free_bytes == 16
+
+    tracing.flush()
+    run = next(span for span in spans if span.name == "pipeline.run")
+    stages = [span for span in spans if span.name.startswith("pipeline.") and span is not run]
+    assert sorted({span.name for span in stages}) == ["pipeline.forward", "pipeline.post_process", "pipeline.preprocess"]
+    assert all(span.parent_span_id == run.context.span_id for span in stages)
+
+
+def test_run_stream_writes_a_shared_payload(make_pipeline, tmp_path):
+    pipeline = make_pipeline(TokenPipeline, output_dir=str(tmp_path), output_transport="shm")
+    list(pipeline.run_stream({"tokens": ["a", "b"]}, {}, {}, {}))
+    assert read_payload(str(tmp_path)) == ["A", "B"]
+
+
+def test_run_and_run_stream_share_the_stages(make_pipeline, tmp_path):
+    pipeline = make_pipeline(output_dir=str(tmp_path), output_transport="shm")
+    outputs = pipeline.run({"x": np.arange(3)}, {}, {}, {})
+    assert read_payload(str(tmp_path))["inputs"]["x"].tolist() == outputs["inputs"]["x"].tolist()
+    assert list(pipeline.run_stream({"x": 1}, {}, {}, {})) == [{"name": None, "inputs": {"x": 1}}]
+
+
+def test_client_stream_span_covers_the_whole_stream(spans):
+    server, uri = start_mock_server(stream_outputs=["a", "b", "c"], stream_interval=0.1)
+    try:
+        assert list(Client("key", "repo", server_uri=uri).stream({"repo_name": "a/repo", "inputs": {}})) == ["a", "b", "c"]
+    finally:
+        server.shutdown()
+        server.server_close()
+    tracing.flush()
+    (span,) = [span for span in spans if span.name == "client.stream"]
+    assert span.end_ns - span.start_ns >= 0.3 * 1e9
@@ -0,0 +1,80 @@
+import threading
+import time
+import pytest
+from matrix.utils import tracing
+
+
+class SlowExporter:
+    def __init__(self, delay=0.0) -> None:
+        self.delay = delay
+        self.batches = []
+
+    def export(self, spans):
+        time.sleep(self.delay)
+        self.batches.append([span.name for span in spans])
+
+
+@pytest.fixture
+def exporter():
+    exporter = SlowExporter()
+    tracing.set_exporter(exporter, max_batch=4)
+    yield exporter
+    tracing.set_exporter(None)
+
+
+def test_spans_are_not_recorded_without_exporter():
+    tracing.set_exporter(None)
+    with tracing.start_span("outer") as span:
+        span.set_attribute("key", "value")
+        assert tracing.current_span() is None
+        assert tracing.inject() == {}
+
+
+def test_nested_spans_share_the_trace(exporter):
+    with tracing.start_span("outer") as outer:
+        with tracing.start_span("inner") as inner:
+            assert tracing.inject()["traceparent"] == inner.context.to_traceparent()
+    assert inner.context.trace_id == outer.context.trace_id
+    assert inner.parent_span_id == outer.context.span_id
+    tracing.flush()
+    assert exporter.batches == [["inner", "outer"]]
+
+
+def test_full_batches_are_exported_in_the_background(exporter):
+    exporter.delay = 0.5
+    start = time.perf_counter()
+    for i in range(10):
+        with tracing.start_span(f"span-{i}"):
+            pass
+    assert time.perf_counter() - start < 0.25
+    tracing.flush()
+    assert [name for batch in exporter.batches for name in batch] == [f"span-{i}" for i in range(10)]
+    assert max(len(batch) for batch in exporter.batches) == 4
+
+
+def test_spans_over_the_queue_limit_are_dropped():
+    exporter = SlowExporter(delay=0.2)
+    tracing.set_exporter(exporter, max_batch=1, max_queue=2)
+    try:
+        for i in range(20):
+            with tracing.start_span(f"span-{i}"):
+                pass
+        assert tracing._processor.dropped > 0
+        tracing.flush()
+        assert sum(len(batch) for batch in exporter.batches) + tracing._processor.dropped == 20
+    finally:
+        tracing.set_exporter(None)
+
+
+def test_local_collector_receives_otlp(exporter):
+    collector = tracing.LocalCollector().start()
+    try:
+        tracing.set_exporter(tracing.OTLPHttpExporter(collector.endpoint))
+        with tracing.start_span("request", {"batch_size": 8}):
+            pass
+        tracing.flush()
+        (span,) = collector.spans
+        assert span["name"] == "request"
+        assert span["attributes"] == [{"key": "batch_size", "value": {"intValue": "8"}}]
+    finally:
+        collector.shutdown()
@@ -0,0 +1,78 @@
+import os
+import numpy as np
+import pytest
+from matrix.utils import loaders
+from matrix.utils.transport import FileRef, read_payload, remove_payload, write_payload
+
+
+@pytest.fixture
+def payload_dir(tmp_path):
+    path = str(tmp_path / "payload")
+    yield path
+    remove_payload(path)
+
+
+def test_round_trip_keeps_structure_and_arrays(payload_dir):
+    data = {
+        "image": [np.arange(12, dtype=np.uint8).reshape(3, 4), np.ones((2, 2), dtype=np.float32)],
+        "text": ["a sentence"],
+        "meta": {"count": 2, "ratio": 0.5, "ok": True, "none": None, "pair": (1, "b")},
+        "raw": b"\x00\x01",
+    }
+    write_payload(payload_dir, data)
+    read = read_payload(payload_dir)
+    np.testing.assert_array_equal(read["image"][0], data["image"][0])
+    assert read["image"][1].dtype == np.float32 and read["image"][1].shape == (2, 2)
+    assert read["text"] == ["a sentence"]
+    assert read["meta"] == {"count": 2, "ratio": 0.5, "ok": True, "none": None, "pair": (1, "b")}
+    np.testing.assert_array_equal(read["raw"], [0, 1])
+
+
+def test_writable_arrays_are_copy_on_write(payload_dir):
+    write_payload(payload_dir, {"image": [np.zeros(4, dtype=np.int64)]})
+    with pytest.raises(ValueError):
+        read_payload(payload_dir)["image"][0] += 1
+    array = read_payload(payload_dir, writable=True)["image"][0]
+    array += 1
+    assert array.tolist() == [1, 1, 1, 1]
+    assert read_payload(payload_dir)["image"][0].tolist() == [0, 0, 0, 0]
+
+
+def test_rewrite_keeps_mapped_arrays_valid(payload_dir):
+    write_payload(payload_dir, {"x": [np.full(1024, 7, dtype=np.int64)]})
+    mapped = read_payload(payload_dir)["x"][0]
+    write_payload(payload_dir, {"x": [np.full(8, 3, dtype=np.int64)]})
+    assert mapped.sum() == 7 * 1024
+    assert read_payload(payload_dir)["x"][0].tolist() == [3] * 8
+    assert len([name for name in os.listdir(payload_dir) if name.endswith(".bin")]) == 1
+
+
+def test_objects_which_are_not_arrays_are_rejected(payload_dir):
+    with pytest.raises(RuntimeError):
+        write_payload(payload_dir, {"video": [object()]})
+
+
+def test_auto_file_loader_reads_payloads(tmp_path, payload_dir, registry):
+    sample = tmp_path / "clip.mp4"
+    sample.write_bytes(b"not really a video")
+    loaders.register_loader("clip", lambda path, **options: ("opened", path), extensions=[".clip"])
+    write_payload(payload_dir, {
+        "image": [np.zeros((2, 2, 3), dtype=np.uint8)],
+        "clip": [FileRef(str(sample), "clip")],
+        "octet-stream": ["/samples/blob.bin"],
+    })
+
+    data = loaders.auto_file_loader(payload_dir, ["image", "clip", "generic"])
+    data["image"][0] += 1 # copy-on-write, preprocessing in place works
+    assert data["clip"] == [("opened", str(sample))]
+    assert data["octet-stream"] == ["/samples/blob.bin"]
+    assert "octet-stream" not in loaders.auto_file_loader(payload_dir, ["image"])
+
+
+def test_load_payload_inputs_keeps_unencodable_files_as_refs(tmp_path, registry):
+    (tmp_path / "a.json").write_text('{"a": [1, 2]}')
+    (tmp_path / "b.handle").write_text("x")
+    loaders.register_loader("handle", lambda path, **options: object(), extensions=[".handle"])
+    inputs = loaders.load_payload_inputs(str(tmp_path), ["json", "handle"])
+    assert inputs["json"] == [{"a": [1, 2]}]
+    assert isinstance(inputs["handle"][0], FileRef) and inputs["handle"][0].path.endswith("b.handle")
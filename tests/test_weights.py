@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from matrix.utils.weights import load_weights_into_model
+
+torch = pytest.importorskip("torch")
+
+
+def test_npz_weights_are_loaded_into_the_model(tmp_path):
+    model = torch.nn.Linear(3, 2)
+    path = str(tmp_path / "weights.npz")
+    np.savez(path, weight=np.ones((2, 3), dtype=np.float32), bias=np.zeros(2, dtype=np.float32))
+    assert load_weights_into_model(model, path) == ([], [])
+    assert model.weight.detach().numpy().tolist() == [[1.0] * 3] * 2
+
+
+def test_npy_weights_are_rejected(tmp_path):
+    path = str(tmp_path / "weights.npy")
+    np.save(path, np.ones((2, 3), dtype=np.float32))
+    with pytest.raises(RuntimeError):
+        load_weights_into_model(torch.nn.Linear(3, 2), path)
+
+
+class _Custom:
+    pass
+
+
+def test_pickled_objects_are_not_loaded_silently(tmp_path, monkeypatch):
+    from matrix.utils import weights
+    from matrix.utils.weights import load_weights
+    warnings = []
+    monkeypatch.setattr(weights.logger, "warning", warnings.append)
+    path = str(tmp_path / "checkpoint.pt")
+    torch.save({"weight": torch.ones(2), "extra": _Custom()}, path)
+    with pytest.raises(Exception):
+        load_weights(path)
+    assert isinstance(load_weights(path, weights_only=False)["extra"], _Custom)
+    assert any("weights_only=False" in message for message in warnings)
@@ -0,0 +1,111 @@
+import gc
+import os
+import time
+import numpy as np
+import pytest
+from conftest import EchoPipeline
+from matrix.workers import ProcessPoolRunner, ZygoteRunner
+
+
+pytestmark = pytest.mark.skipif("fork" not in __import__("multiprocessing").get_all_start_methods(), reason="needs fork")
+
+
+def _shm_segments():
+    return {name for name in os.listdir("/dev/shm") if name.startswith("psm_")} if os.path.isdir("/dev/shm") else set()
+
+
+def test_process_pool_runners_keep_their_own_pipeline(make_pipeline):
+    runner_a = ProcessPoolRunner(make_pipeline(name="A"), workers=1)
+    runner_b = ProcessPoolRunner(make_pipeline(name="B"), workers=1)
+    try:
+        # the workers are forked lazily, on the first submit
+        assert runner_a.run({"x": 1}, {}, {}, {})["name"] == "A"
+        assert runner_b.run({"x": 1}, {}, {}, {})["name"] == "B"
+    finally:
+        runner_a.shutdown()
+        runner_b.shutdown()
+
+
+def test_process_pool_runner_map_keeps_order(make_pipeline):
+    with ProcessPoolRunner(make_pipeline(), workers=2) as runner:
+        outputs = runner.map([{"i": i} for i in range(8)], {}, {}, {})
+    assert [o["inputs"]["i"] for o in outputs] == list(range(8))
+
+
+def test_process_pool_runner_returns_large_arrays_through_shared_memory(make_pipeline):
+    array = np.arange(1024 * 256, dtype=np.float32)
+    with ProcessPoolRunner(make_pipeline(), workers=1, shm_threshold=1024) as runner:
+        output = runner.run({"array": array}, {}, {}, {})
+    np.testing.assert_array_equal(output["inputs"]["array"], array)
+
+
+@pytest.mark.skipif(not os.path.isdir("/dev/shm"), reason="needs /dev/shm")
+def test_dropped_futures_do_not_leak_shared_memory(make_pipeline):
+    before = _shm_segments()
+    with ProcessPoolRunner(make_pipeline(), workers=1, shm_threshold=1024) as runner:
+        futures = [runner.submit({"array": np.ones(4096)}, {}, {}, {}) for _ in range(3)]
+        futures[0].exception()
+        for future in futures:
+            future._future.result()
+        del futures
+        gc.collect()
+    assert _shm_segments() - before == set()
+
+
+def test_process_pool_runner_raises_the_error_of_the_worker(make_pipeline):
+    with ProcessPoolRunner(make_pipeline(), workers=1) as runner:
+        future = runner.submit({"fail": "boom"}, {}, {}, {})
+        assert isinstance(future.exception(), ValueError)
+        with pytest.raises(ValueError, match="boom"):
+            future.result()
+
+
+class SlowPipeline(EchoPipeline):
+    def forward(self, inputs, **kwargs):
+        time.sleep(inputs.get("sleep", 0))
+        return super().forward(inputs, **kwargs)
+
+
+def test_zygote_runners_keep_their_own_pipeline(make_pipeline):
+    with ZygoteRunner(pipeline=make_pipeline(name="A"), workers=1) as runner_a, \
+            ZygoteRunner(factory=lambda: make_pipeline(name="B"), workers=1) as runner_b:
+        assert runner_a.run({"x": 1}, {}, {}, {})["name"] == "A"
+        assert runner_b.run({"x": 1}, {}, {}, {})["name"] == "B"
+
+
+def test_zygote_runner_map_keeps_order(make_pipeline):
+    with ZygoteRunner(pipeline=make_pipeline(name="Z"), workers=3) as runner:
+        outputs = runner.map([{"i": i, "sleep": 0.05 * (i % 3)} for i in range(8)], {}, {}, {})
+    assert [o["inputs"]["i"] for o in outputs] == list(range(8))
+    assert {o["name"] for o in outputs} == {"Z"}
+
+
+def test_zygote_runner_children_do_not_share_state(make_pipeline):
+    class CountingPipeline(EchoPipeline):
+        calls = 0
+
+        def forward(self, inputs, **kwargs):
+            type(self).calls += 1
+            return {"calls": type(self).calls}
+
+    with ZygoteRunner(pipeline=make_pipeline(CountingPipeline), workers=1) as runner:
+        outputs = runner.map([{"x": 1}] * 3, {}, {}, {})
+    # every request starts from the state of the zygote
+    assert [o["inputs"]["calls"] for o in outputs] == [1, 1, 1]
+
+
+def test_zygote_runner_raises_the_error_of_the_child(make_pipeline):
+    with ZygoteRunner(pipeline=make_pipeline(), workers=1) as runner:
+        with pytest.raises(ValueError, match="boom"):
+            runner.run({"fail": "boom"}, {}, {}, {})
+        assert runner.run({"x": 1}, {}, {}, {})["inputs"] == {"x": 1}
+
+
+def test_zygote_runner_kills_children_after_the_timeout(make_pipeline):
+    with ZygoteRunner(pipeline=make_pipeline(SlowPipeline), workers=1) as runner:
+        start = time.monotonic()
+        future = runner.submit({"sleep": 5}, {}, {}, {}, timeout=0.5)
+        assert isinstance(future.exception(timeout=4), TimeoutError)
+        assert time.monotonic() - start < 4
+        # the worker slot is free again
+        assert runner.run({"sleep": 0}, {}, {}, {})["inputs"] == {"sleep": 0}
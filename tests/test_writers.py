@@ -0,0 +1,95 @@
+import os
+import threading
+import numpy as np
+import pytest
+from conftest import EchoPipeline
+import matrix.utils.writers as writers
+from matrix.utils.writers import OutputWriter
+
+
+def test_files_are_renamed_into_place_when_complete(tmp_path, monkeypatch):
+    renames = []
+    replace = os.replace
+
+    def record(source, target):
+        with open(source) as f:
+            renames.append((os.path.basename(source), os.path.basename(target), f.read()))
+        replace(source, target)
+
+    monkeypatch.setattr(writers.os, "replace", record)
+    with OutputWriter(str(tmp_path)) as writer:
+        writer.write_text("out.txt", "done")
+    (temp_name, target, content), = renames
+    assert temp_name.startswith(".out.txt.") and temp_name.endswith(".tmp")
+    assert (target, content) == ("out.txt", "done")
+    assert os.listdir(tmp_path) == ["out.txt"]
+
+
+def test_failed_writes_leave_no_temporary_file(tmp_path, monkeypatch):
+    def fail(source, target):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(writers.os, "replace", fail)
+    writer = OutputWriter(str(tmp_path))
+    writer.write_bytes("out.bin", b"data")
+    with pytest.raises(RuntimeError, match="disk full"):
+        writer.close()
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize("fsync, calls", [("none", 0), ("file", 2), ("dir", 4)])
+def test_fsync_policies(tmp_path, monkeypatch, fsync, calls):
+    synced = []
+    monkeypatch.setattr(writers.os, "fsync", synced.append)
+    with OutputWriter(str(tmp_path), fsync=fsync) as writer:
+        writer.write_json("a.json", {"a": 1})
+        writer.write_array("b.npy", np.arange(3))
+    assert len(synced) == calls
+    assert np.load(tmp_path / "b.npy").tolist() == [0, 1, 2]
+
+
+def test_unknown_fsync_policies_are_rejected(tmp_path):
+    with pytest.raises(RuntimeError):
+        OutputWriter(str(tmp_path), fsync="always")
+
+
+def test_close_drains_the_queue(tmp_path):
+    writer = OutputWriter(str(tmp_path), workers=1, max_pending=2)
+    for i in range(20):
+        writer.write_text(f"{i}.txt", str(i))
+    writer.close()
+    assert sorted(os.listdir(tmp_path)) == sorted(f"{i}.txt" for i in range(20))
+
+
+class WritingPipeline(EchoPipeline):
+    def post_process(self, outputs, **kwargs):
+        self.output_writer.write_text(outputs["name"], "done")
+        return outputs
+
+
+def test_write_errors_reach_run(make_pipeline, tmp_path):
+    pipeline = make_pipeline(WritingPipeline, output_dir=str(tmp_path))
+    with pytest.raises(RuntimeError, match="could not be written"):
+        pipeline.run({"name": "missing/out.txt"}, {}, {}, {})
+    # the error is reported once
+    pipeline.run({"name": "out.txt"}, {}, {}, {})
+    assert (tmp_path / "out.txt").read_text() == "done"
+
+
+def test_output_flush_none_leaves_the_writes_to_flush_outputs(make_pipeline, tmp_path, monkeypatch):
+    release = threading.Event()
+    atomic_write = writers._atomic_write
+
+    def slow_write(*args):
+        release.wait(5)
+        return atomic_write(*args)
+
+    monkeypatch.setattr(writers, "_atomic_write", slow_write)
+    pipeline = make_pipeline(WritingPipeline, output_dir=str(tmp_path), output_flush="none")
+    pipeline.run({"name": "out.txt"}, {}, {}, {})
+    pipeline.run({"name": "missing/out.txt"}, {}, {}, {})
+    assert not (tmp_path / "out.txt").exists()
+    release.set()
+    with pytest.raises(RuntimeError, match="could not be written"):
+        pipeline.flush_outputs()
+    assert (tmp_path / "out.txt").read_text() == "done"